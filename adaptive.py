@@ -0,0 +1,116 @@
+import os
+import time
+import threading
+
+from public import *
+from util import parse_size, format_size
+from logger import printLog
+
+# 自适应并发: 线程池按并发上限 adaptive.max 创建，每个任务 (不使用流水线时为一个测试点，使用流水线时为编译、链接、运行的一个阶段)
+# 开始前须获得许可。每隔 interval 秒依据主机的可用内存、负载和观察到的每个任务的内存峰值重新计算允许同时执行的任务数:
+#   内存允许的任务数 = 正在执行的任务数 + (MemAvailable - reserve) / 每个任务的预计内存
+#   负载允许的任务数 = 正在执行的任务数 + CPU 核心数 * load - 1 分钟平均负载
+# 两者取较小值并限制在 [min, max] 之间。每个任务的预计内存初始为 memory-limit，之后取观察到的峰值 (不超过 memory-limit)。
+
+PeakDecay = 0.95    # 每次计算时观察到的峰值的衰减，使偶尔的高峰不会永久压低并发
+
+def read_meminfo() -> dict: # {key: bytes}
+    info = {}
+    with open('/proc/meminfo', 'r') as fp:
+        for line in fp:
+            key, value = line.split(':', 1)
+            parts = value.split()
+            info[key] = int(parts[0]) * (1024 if len(parts) > 1 and parts[1] == 'kB' else 1)
+    return info
+
+def read_loadavg() -> float:
+    with open('/proc/loadavg', 'r') as fp:
+        return float(fp.read().split()[0])
+
+class AdaptiveLimiter:
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.running = 0
+        self.cpus = os.cpu_count() or 1
+        self.reserve = parse_size(AdaptiveReserve)
+        self.memory_limit = parse_size(MemoryLimit)
+        self.job_memory = float(self.memory_limit)     # 每个任务的预计内存
+        self.stage_peaks = {}                           # 各阶段报告的内存峰值 {stage: bytes}
+        info = read_meminfo()
+        self.baseline = info['MemTotal'] - info['MemAvailable']     # 评测开始前已使用的内存
+        self.limit = None   # 第一次计算后输出初始的并发上限
+        self.samples = []   # [(并发上限, 正在执行的任务数)]
+        self.update()
+        threading.Thread(target=self.monitor, name='adaptive', daemon=True).start()
+
+    # 任务报告其内存峰值 (例如容器的 memory.peak)，比按主机内存估计更准确
+    def observe(self, stage: str, peak: int):
+        with self.cond:
+            self.stage_peaks[stage] = max(peak, self.stage_peaks.get(stage, 0) * PeakDecay)
+
+    def estimate(self, used: int) -> float:
+        # 评测开始后增加的内存平均分给正在执行的任务
+        observed = (used - self.baseline) / self.running if self.running > 0 else 0
+        peak = max([observed] + list(self.stage_peaks.values()))
+        if peak > 0:
+            self.job_memory = max(peak, self.job_memory * PeakDecay)
+        return min(max(self.job_memory, 1 << 20), self.memory_limit)
+
+    def update(self):
+        info = read_meminfo()
+        load = read_loadavg()
+        with self.cond:
+            available = info['MemAvailable'] - self.reserve
+            job_memory = self.estimate(info['MemTotal'] - info['MemAvailable'])
+            by_memory = self.running + int(available // job_memory)
+            by_load = self.running + int(self.cpus * AdaptiveLoad - load)
+            limit = max(AdaptiveMin, min(AdaptiveMax, by_memory, by_load))
+            if limit != self.limit:
+                printLog('adaptive: limit {0}{1} (running {2}, MemAvailable {3}, {4} per job, load {5:.2f}/{6} cpus)'.format(
+                    '' if self.limit is None else '{0} -> '.format(self.limit), limit, self.running, format_size(info['MemAvailable']), format_size(job_memory), load, self.cpus))
+                self.limit = limit
+                self.cond.notify_all()
+            self.samples.append((self.limit, self.running))
+
+    def monitor(self):
+        while True:
+            time.sleep(AdaptiveInterval)
+            try:
+                self.update()
+            except Exception as e:
+                printLog('adaptive: update failed: {0}'.format(str(e)))
+
+    def acquire(self):
+        with self.cond:
+            while self.running >= self.limit:
+                self.cond.wait()
+            self.running += 1
+
+    def release(self):
+        with self.cond:
+            self.running -= 1
+            self.cond.notify()
+
+    def summary(self) -> str:
+        with self.cond:
+            samples = list(self.samples)
+        if len(samples) == 0:
+            return ''
+        limits = [limit for limit, _ in samples]
+        return 'Adaptive concurrency: limit {0}-{1} (average {2:.1f}), average running {3:.1f}, {4} per job.'.format(
+            min(limits), max(limits), sum(limits) / len(limits), sum(r for _, r in samples) / len(samples), format_size(self.job_memory))
+
+limiter = AdaptiveLimiter() if Adaptive else None
+
+# 在获得许可后执行 func，未开启自适应并发时直接执行
+def run_admitted(func, *args):
+    if limiter is None:
+        return func(*args)
+    limiter.acquire()
+    try:
+        return func(*args)
+    finally:
+        limiter.release()
+
+def adaptive_summary() -> str:
+    return limiter.summary() if limiter is not None else ''
@@ -0,0 +1,178 @@
+import os
+import json
+import time
+import shutil
+import statistics
+import threading
+
+from const import *
+from public import *
+from tasks import JavaImage, CdsDir, CdsJar, CdsOptions, run_container, compiler_classpath, compiler_mounts
+from cache import get_compiler_digest
+from util import format_size
+from logger import printLog
+
+# AppCDS (应用类数据共享): 每个编译器构建 (按构建产物与依赖库的哈希) 生成一次归档，之后每个测试点的 java 进程直接映射归档中已解析的类。
+# 生成步骤 (在 JDK 镜像中执行):
+#   1. 将构建目录打包为 compiler.jar (AppCDS 只归档 jar 中的类，类路径为目录时无法使用)
+#   2. 以 -XX:DumpLoadedClassList 编译源文件最大的 app-cds-training 个测试点，合并各次加载的类列表
+#   3. -Xshare:dump 生成 app.jsa，再交替运行有无归档的编译，测量每次启动节省的时间
+# 归档保存在 log-dir 下的 .cds/<哈希> 中，评测时挂载到容器的 /compiler/cds。构建改变后哈希随之改变，不会使用过期的归档；
+# 归档与 JVM 版本或选项不匹配时 -Xshare:auto 静默回退。生成失败时记录在 cds.json 中，该构建之后不再尝试，评测照常使用构建目录。
+
+CdsBase = os.path.realpath(os.path.join(LogDirBase, '.cds'))
+CdsBaseHost = os.path.realpath(os.path.join(LogDirHostBase, '.cds'))
+CdsInfoFile = 'cds.json'
+CdsBenchRuns = 3        # 测量启动时间时有无归档各运行的次数
+CdsKeep = 4             # 保留最近使用的归档数量
+
+CmdCdsTrain = 'java {jvm} -Xshare:off -XX:DumpLoadedClassList={dir}/train/{i}.lst {lib} Compiler {args} {opt} <{dir}/train/{i}.in >/dev/null 2>&1'
+CmdCdsDump = 'java {jvm} -Xshare:dump -XX:SharedClassListFile={dir}/classes.lst -XX:SharedArchiveFile={dir}/app.jsa {lib} >{dir}/dump.log 2>&1'
+CmdCdsBench = 's=$(date +%s%N); java {jvm} {lib} Compiler {args} {opt} <{dir}/train/1.in >/dev/null 2>&1; echo "{mode} $(($(date +%s%N) - s))" >>{dir}/bench.txt'
+
+archives = {}           # {(构建目录, 依赖库目录): 归档信息}，没有可用归档时为 None
+archive_lock = threading.Lock()
+
+def cds_archive(compiler: dict) -> dict:
+    return archives.get((compiler['compiler-build'], compiler['compiler-lib']))
+
+# 训练编译的参数，与评测时的编译类型一致 (多个评测类型时与 judge.compile_type 相同)
+def training_args(i: int) -> str:
+    sy, out = '{0}/train/{1}.sy'.format(CdsDir, i), '{0}/train/{1}'.format(CdsDir, i)
+    targets = [t for t in RunTypes if t != TYPE_INTERPRET]
+    if len(targets) == 0:
+        return '-I ' + sy
+    if all(t == TYPE_LLVM for t in targets):
+        return '-emit-llvm -o {0}.ll {1}'.format(out, sy)
+    if TYPE_LLVM in targets or EmitLLVM:
+        return '-emit-llvm -o {0}.ll -S -o {0}.S {1}'.format(out, sy)
+    return '-S -o {0}.S {1}'.format(out, sy)
+
+# 源文件最大的测试点覆盖编译器的代码最多
+def training_cases(testcases: list) -> list:
+    files = sorted({t['file_src']: t for t in testcases}.values(), key=lambda t: -os.path.getsize(t['file_src']))
+    return files[:max(1, AppCdsTraining)]
+
+# 合并各次训练加载的类，去掉 id (只保留内置类加载器加载的类)
+def merge_class_lists(train_dir: str, count: int) -> list:
+    classes, seen = [], set()
+    for i in range(1, count + 1):
+        path = os.path.join(train_dir, '{0}.lst'.format(i))
+        if not os.path.exists(path):
+            continue
+        with open(path, 'r') as fp:
+            for line in fp:
+                parts = line.split()
+                if len(parts) == 0 or line.startswith('#') or 'source:' in parts:
+                    continue
+                entry = line.strip() if line.startswith('@') else parts[0]
+                if entry not in seen:
+                    seen.add(entry)
+                    classes.append(entry)
+    return classes
+
+def read_bench(path: str) -> dict:
+    times = {'base': [], 'cds': []}
+    with open(path, 'r') as fp:
+        for line in fp:
+            parts = line.split()
+            if len(parts) == 2 and parts[0] in times and parts[1].isdigit():
+                times[parts[0]].append(int(parts[1]) / 1e9)
+    return {mode: statistics.median(t) if len(t) > 0 else None for mode, t in times.items()}
+
+def generate_archive(compiler: dict, testcases: list, local: str, host: str) -> dict:
+    train_dir = os.path.join(local, 'train')
+    os.makedirs(train_dir, exist_ok=True)
+    cases = training_cases(testcases)
+    for i, testcase in enumerate(cases, 1):
+        shutil.copy(testcase['file_src'], os.path.join(train_dir, '{0}.sy'.format(i)))
+        if os.path.exists(testcase['file_in']):
+            shutil.copy(testcase['file_in'], os.path.join(train_dir, '{0}.in'.format(i)))
+        else:
+            open(os.path.join(train_dir, '{0}.in'.format(i)), 'w').close()
+    cds = {'dir_host': host}
+    static_volumes = compiler_mounts(compiler['compiler-build'], compiler['compiler-lib'])
+    static_volumes[host] = {'bind': CdsDir, 'mode': 'rw'}
+    lib, base_lib = compiler_classpath(compiler['compiler-lib'], cds), compiler_classpath(compiler['compiler-lib'])
+    jvm, opt = compiler['jvm-options'], compiler['opt-options']
+    name = 'compiler_{0}_cds'.format(os.getpid())
+    # 训练编译失败 (例如训练用例不能通过编译) 不影响加载的类列表
+    cmd = '; '.join(['jar cf {0} -C /compiler/compiler .'.format(CdsJar)] +
+        [CmdCdsTrain.format(jvm=jvm, dir=CdsDir, i=i, lib=lib, args=training_args(i), opt=opt) for i in range(1, len(cases) + 1)])
+    run_container(DockerClient, JavaImage, cmd, name + '_train', 'cds_train', '/compiler', {}, static_volumes,
+        timeout=TimeoutSecs * (len(cases) + 1), pooled=False)
+    classes = merge_class_lists(train_dir, len(cases))
+    if len(classes) == 0:
+        raise Exception('no class loaded in training')
+    with open(os.path.join(local, 'classes.lst'), 'w') as fp:
+        fp.write('\n'.join(classes) + '\n')
+    bench = []
+    for _ in range(CdsBenchRuns):
+        for mode, run_jvm, run_lib in [('base', jvm, base_lib), ('cds', ' '.join([CdsOptions, jvm]), lib)]:
+            bench.append(CmdCdsBench.format(mode=mode, jvm=run_jvm, lib=run_lib, args=training_args(1), opt=opt, dir=CdsDir))
+    cmd = CmdCdsDump.format(jvm=jvm, dir=CdsDir, lib=lib) + '; r=$?; if [ $r -ne 0 ]; then exit $r; fi; ' + '; '.join(bench)
+    run_container(DockerClient, JavaImage, cmd, name + '_dump', 'cds_dump', '/compiler', {}, static_volumes,
+        timeout=TimeoutSecs * (2 * CdsBenchRuns + 1), pooled=False)
+    times = read_bench(os.path.join(local, 'bench.txt'))
+    return {'ok': True, 'classes': len(classes), 'training': [os.path.join(t['series_name'], t['case_name']) for t in cases],
+        'size': os.path.getsize(os.path.join(local, 'app.jsa')), 'startup': times['base'], 'startup_cds': times['cds'], 'created': time.time()}
+
+# 删除最近最少使用的归档，本进程正在使用的除外
+def prune_archives():
+    using = {info['name'] for info in archives.values() if info is not None}
+    entries = [os.path.join(CdsBase, name) for name in os.listdir(CdsBase)]
+    for path in sorted(entries, key=os.path.getmtime, reverse=True)[CdsKeep:]:
+        if os.path.basename(path) not in using:
+            shutil.rmtree(path, ignore_errors=True)
+
+# 为编译器构建准备归档 (已生成时直接使用)，testcases 为本次评测的测试点，从中选取训练用例。返回归档信息，不可用时为 None
+def prepare_archive(compiler: dict, testcases: list) -> dict:
+    key = (compiler['compiler-build'], compiler['compiler-lib'])
+    with archive_lock:
+        digest = get_compiler_digest(compiler['compiler-build'], compiler['compiler-lib'])
+        if digest is None or len(testcases) == 0:
+            archives[key] = None
+            return None
+        name = digest.split(':')[-1][:16]
+        local, host = os.path.join(CdsBase, name), os.path.join(CdsBaseHost, name)
+        info_file = os.path.join(local, CdsInfoFile)
+        if os.path.exists(info_file):
+            with open(info_file, 'r') as fp:
+                info = json.load(fp)
+            os.utime(local)
+        else:
+            printLog('AppCDS: generating archive for {0} ......'.format(compiler['compiler-build']))
+            shutil.rmtree(local, ignore_errors=True)
+            os.makedirs(local)
+            try:
+                info = generate_archive(compiler, testcases, local, host)
+                printLog('AppCDS: archive {0} generated, {1} classes'.format(name, info['classes']))
+            except Exception as e:
+                info = {'ok': False, 'error': str(e), 'created': time.time()}
+                printLog('AppCDS: generating archive for {0} failed, not using AppCDS: {1}'.format(compiler['compiler-build'], str(e)))
+            with open(info_file, 'w') as fp:
+                json.dump(info, fp=fp)
+            prune_archives()
+        info = dict(info, name=name, dir_host=host, build=compiler['compiler-build']) if info['ok'] else None
+        archives[key] = info
+        return info
+
+# 在评测开始前为本次评测使用的每个编译器构建准备归档
+def setup_app_cds(testcases: list):
+    for compiler in (Variants or [DefaultVariant]):
+        prepare_archive(compiler, testcases)
+
+def format_startup(t) -> str:
+    return '?' if t is None else '{0:.3f}s'.format(t)
+
+def cds_summary() -> str:
+    lines = []
+    for info in archives.values():
+        if info is None:
+            continue
+        saving = ''
+        if info['startup'] and info['startup_cds'] is not None:
+            saving = ', saving {0:.3f}s per JVM ({1:.1%})'.format(info['startup'] - info['startup_cds'], 1 - info['startup_cds'] / info['startup'])
+        lines.append('AppCDS {0}: {1} classes ({2}), training compile {3} -> {4}{5}.'.format(info['build'], info['classes'], format_size(info['size']),
+            format_startup(info['startup']), format_startup(info['startup_cds']), saving))
+    return '\n'.join(lines)
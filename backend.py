@@ -0,0 +1,233 @@
+import docker
+from docker.models.containers import Container
+import os
+import re
+import signal
+import shutil
+import resource
+import tempfile
+import threading
+import subprocess
+
+from public import *
+from pool import get_pool
+from util import parse_size
+from usage import TaskFailed, usage_probe, container_usage, native_usage
+from timing import trace_span
+
+# 执行后端: 评测的各个阶段 (构建、编译、生成 ELF、运行、解释执行) 都描述为
+# "在某个镜像中、以某个工作目录和一组挂载执行一条 shell 命令"，由后端负责实际执行。
+#   docker: 每个阶段一个容器，或在常驻容器池中 exec (container-pool)
+#   native: 在本机直接执行，需要本机安装 JDK、sysy-*.sh 脚本及其工具链，无容器开销
+
+debug_container = False # if true, containers will not be removed after finished.
+
+def wrap_cmd(cmd: str) -> str:
+    return '/bin/sh -c "{0}"'.format(cmd.replace("\"", "\\\""))
+
+# 命令结束后输出容器 cgroup 的统计，子 shell 使命令中的 exit 不影响统计
+def probe_cmd(cmd: str) -> str:
+    return '( {0} ); r=$?; {1}; exit $r'.format(cmd, usage_probe())
+
+# 从容器输出的最后几行中读取资源统计，并结合 docker 记录的 OOMKilled
+def read_container_usage(container: Container) -> dict:
+    try:
+        text = container.logs(stdout=True, stderr=False, tail=64).decode('utf-8', errors='replace')
+        container.reload()
+        return container_usage(text, bool(container.attrs['State'].get('OOMKilled')))
+    except Exception:
+        return None
+
+# 等待容器结束，返回其资源使用 (未统计时为 None)
+def container_wait(container: Container, name: str, timeout: int=None) -> dict:
+    try:
+        with trace_span('container_wait', 'docker', stage=name):
+            exit: dict = container.wait(timeout=timeout or TimeoutSecs)
+        usage = read_container_usage(container) if ResourceUsage else None
+    except Exception as e:
+        try:
+            container.kill()
+        except:
+            pass
+        raise e
+    finally:
+        if not debug_container:
+            with trace_span('container_remove', 'docker', stage=name):
+                container.remove()
+    if exit.get('Error') is not None:
+        raise TaskFailed('{name}: container exit with error {err}'.format(name=name, err=exit['Error']), usage)
+    elif exit['StatusCode'] != 0:
+        raise TaskFailed('{name}: container exit with code {code}'.format(name=name, code=exit['StatusCode']), usage) # you should see logs dir for further information
+    return usage
+
+class DockerBackend:
+    def __init__(self, client: docker.DockerClient):
+        self.client = client
+
+    # static_volumes 为不随测试点变化的挂载 (编译器、依赖库)，容器池按镜像和这些挂载分组。返回任务的资源使用，见 usage.py
+    def run(self, image: str, cmd: str, container_name: str, stage: str, working_dir: str, volumes: dict, static_volumes: dict,
+            timeout: int=None, cpuset: str=None, pooled: bool=True) -> dict:
+        if UseContainerPool and pooled:
+            return get_pool(self.client, image, static_volumes, cpuset).run(stage, cmd, working_dir, volumes, timeout)
+        all_volumes = dict(volumes)
+        all_volumes.update(static_volumes)
+        options = dict(command=wrap_cmd(probe_cmd(cmd) if ResourceUsage else cmd), name=container_name, working_dir=working_dir, volumes=all_volumes, mem_limit=MemoryLimit, cpuset_cpus=cpuset)
+        with trace_span('container_create', 'docker', stage=stage):
+            try:
+                container: Container = self.client.containers.create(image, **options)
+            except docker.errors.ImageNotFound:
+                self.client.images.pull(image)     # 与 containers.run 一致，镜像不存在时先拉取
+                container: Container = self.client.containers.create(image, **options)
+        try:
+            with trace_span('container_start', 'docker', stage=stage):
+                container.start()
+        except Exception:
+            if not debug_container:
+                container.remove(force=True)
+            raise
+        return container_wait(container, stage, timeout)
+
+def parse_cpuset(cpuset: str) -> set:
+    cpus = set()
+    for part in cpuset.split(','):
+        if '-' in part:
+            begin, end = part.split('-')
+            cpus.update(range(int(begin), int(end) + 1))
+        elif part.strip():
+            cpus.add(int(part))
+    return cpus
+
+def host_to_local(path: str) -> str:
+    """评测记录目录在主机上的路径转换为本机路径 (本地执行时两者通常相同)"""
+    path = os.path.realpath(path)
+    host = os.path.realpath(logDirHost)
+    if path == host or path.startswith(host + os.sep):
+        return os.path.join(logDir, os.path.relpath(path, host))
+    return path
+
+# 子进程的 shell 先在 read 处等待，父进程将其加入 cgroup、设置资源限制和 CPU 亲和性后写入一行放行，
+# 之后派生的进程都继承这些设置 (评测为多线程程序，不能使用 preexec_fn 在 fork 之后执行这些操作)
+NativeGate = 'read _gate || exit 1; exec </dev/null\n'
+
+def confine_process(pid: int, cgroup: str, limit: int, timeout: int, cpuset: str):
+    if cgroup is not None:
+        with open(os.path.join(cgroup, 'cgroup.procs'), 'w') as fp:
+            fp.write(str(pid))
+    else:
+        # 没有 cgroup 时用 RLIMIT_DATA 近似容器的内存限制 (JVM/qemu 预留的地址空间不计入)
+        resource.prlimit(pid, resource.RLIMIT_DATA, (limit, limit))
+    resource.prlimit(pid, resource.RLIMIT_CPU, (timeout + 1, timeout + 1))
+    if cpuset:
+        os.sched_setaffinity(pid, parse_cpuset(cpuset))
+
+class NativeBackend:
+    def __init__(self):
+        self.serial = 0
+        self.lock = threading.Lock()
+
+    def _job_cgroup(self, stage: str) -> str:
+        """在 native-cgroup 指定的 (已委派的 cgroup v2) 目录下为任务创建子 cgroup 并设置内存上限，不可用时返回 None"""
+        if not NativeCgroup:
+            return None
+        with self.lock:
+            self.serial += 1
+            path = os.path.join(NativeCgroup, 'job_{0}_{1}_{2}'.format(os.getpid(), stage, self.serial))
+        try:
+            os.makedirs(path)
+            with open(os.path.join(path, 'memory.max'), 'w') as fp:
+                fp.write(str(parse_size(MemoryLimit)))
+            with open(os.path.join(path, 'memory.swap.max'), 'w') as fp:
+                fp.write('0')
+        except OSError:
+            pass
+        return path if os.path.isdir(path) else None
+
+    def run(self, image: str, cmd: str, container_name: str, stage: str, working_dir: str, volumes: dict, static_volumes: dict,
+            timeout: int=None, cpuset: str=None, pooled: bool=True) -> dict:
+        timeout = timeout or TimeoutSecs
+        scratch = tempfile.mkdtemp(prefix='sysy_{0}_'.format(stage))
+        cgroup = self._job_cgroup(stage)
+        try:
+            workdir = scratch + working_dir
+            os.makedirs(workdir, exist_ok=True)
+            # 容器内路径 -> 本机路径: 目录直接使用本机路径 (工作目录下的目录另建符号链接供相对路径访问)，
+            # 文件放入任务的临时目录，可写的文件在结束后拷回
+            mapping, copy_back = {working_dir.rstrip('/'): workdir}, []
+            all_volumes = dict(volumes)
+            all_volumes.update(static_volumes)
+            for host_path, bind in all_volumes.items():
+                is_dir = bind['bind'].endswith('/') or host_path in static_volumes or os.path.isdir(host_to_local(host_path))
+                target, local = bind['bind'].rstrip('/'), host_to_local(host_path)
+                inside = target.startswith(working_dir.rstrip('/') + '/')
+                place = scratch + target
+                if is_dir:
+                    os.makedirs(local, exist_ok=True)
+                    mapping[target] = local
+                    if not inside:
+                        continue
+                os.makedirs(os.path.dirname(place), exist_ok=True)
+                if is_dir or bind.get('mode', 'rw') == 'ro':
+                    os.symlink(local, place)
+                else:
+                    copy_back.append((place, local))
+                if not is_dir:
+                    mapping[target] = place
+            keys = sorted(mapping.keys(), key=len, reverse=True)
+            pattern = re.compile(r'(?<![\w./-])(' + '|'.join(map(re.escape, keys)) + r')(?=[/\s:;\'"<>|)]|$)')
+            native_cmd = pattern.sub(lambda m: mapping[m.group(1)], cmd)
+            with trace_span('process_spawn', 'native', stage=stage):
+                proc = subprocess.Popen(['/bin/sh', '-c', NativeGate + native_cmd], cwd=workdir, start_new_session=True,
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, stdin=subprocess.PIPE)
+                try:
+                    confine_process(proc.pid, cgroup, parse_size(MemoryLimit), timeout, cpuset)
+                    proc.stdin.write(b'\n')
+                    proc.stdin.close()
+                except Exception:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                    os.wait4(proc.pid, 0)
+                    raise
+            # wait4 同时取得进程 (及其已回收的子进程) 的 rusage，超时由计时器杀死整个进程组，与 container.kill() 的语义一致
+            timed_out = threading.Event()
+            def kill():
+                timed_out.set()
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+            timer = threading.Timer(timeout, kill)
+            timer.start()
+            try:
+                with trace_span('process_wait', 'native', stage=stage):
+                    _, status, rusage = os.wait4(proc.pid, 0)
+            finally:
+                timer.cancel()
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)    # 清理残留的子进程
+                except OSError:
+                    pass
+            # 被信号杀死时与 shell/docker 一致，例如 SIGKILL 为 137
+            code = 128 + os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+            proc.returncode = code
+            usage = native_usage(rusage, cgroup)
+            if timed_out.is_set():
+                raise TaskFailed('{name}: timeout after {secs} seconds'.format(name=stage, secs=timeout), usage)
+            for place, local in copy_back:
+                if os.path.exists(place):
+                    shutil.copy(place, local)
+            if code != 0:
+                raise TaskFailed('{name}: process exit with code {code}'.format(name=stage, code=code), usage)
+            return usage
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+            if cgroup is not None:
+                try:
+                    os.rmdir(cgroup)
+                except OSError:
+                    pass
+
+native_backend = NativeBackend()
+
+def get_backend(client: docker.DockerClient):
+    if ExecBackend == 'native':
+        return native_backend
+    return DockerBackend(client)
@@ -0,0 +1,129 @@
+import docker
+import os
+import shlex
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+from public import *
+from tasks import JavaImage, run_container, list_jars
+from judge import prepare_or_record, compile_type, compile_outputs, source_digest
+from cache import compile_key, cache_fetch, cache_store
+from util import add_duration
+from logger import printLog
+
+# 批量编译: 将一组测试点交给同一个 JVM (harness/BatchCompiler.java) 编译，避免每个测试点都启动 JVM。
+# 批次中未完成 (JVM 崩溃、超时) 的测试点不记录结果，之后由 test_one_case 逐个编译。
+# 返回仍需评测的测试点: 准备失败的测试点已记录其他错误，不再评测。
+
+HarnessSrc = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'harness', 'BatchCompiler.java')
+BatchMount = '/batch'   # 评测记录目录在批量编译容器内的挂载点
+
+CmdBuildHarness = 'javac -encoding utf-8 -d {dir} {dir}/BatchCompiler.java'
+CmdBatchCompile = 'java {jvm} -Djava.security.manager=allow -cp {harness} BatchCompiler {list} {result} {timeout} {isolate} {classpath}'
+
+def batch_path(path: str) -> str:
+    return os.path.join(BatchMount, os.path.relpath(path, logDir))
+
+def compile_args(judge: dict, type: str) -> list:
+    out_dir = batch_path(judge['out_dir'])
+    src = batch_path(judge['file_src'])
+    opt = shlex.split(judge['compiler']['opt-options'])
+    if type == 'llvm':
+        return ['-emit-llvm', '-o', os.path.join(out_dir, 'test.ll'), src] + opt
+    if type == 'all' or EmitLLVM:
+        return ['-emit-llvm', '-o', os.path.join(out_dir, 'test.ll'), '-S', '-o', os.path.join(out_dir, 'test.S'), src] + opt
+    return ['-S', '-o', os.path.join(out_dir, 'test.S'), src] + opt
+
+# 同一批次的测试点使用相同的编译器变体
+def compile_chunk(client: docker.DockerClient, index: int, chunk: list, type: str, volumes: dict):
+    compiler = chunk[0]['compiler']
+    static_volumes, classpath = compiler_volumes(compiler)
+    batch_dir = os.path.join(logDir, 'batch')
+    list_file = os.path.join(batch_dir, 'chunk_{0}.txt'.format(index))
+    result_file = os.path.join(batch_dir, 'chunk_{0}.result'.format(index))
+    jobs = {}
+    with open(list_file, 'w') as fp:
+        for judge in chunk:
+            os.makedirs(judge['out_dir'], exist_ok=True)
+            jobs[judge['case_fullname']] = judge
+            fields = [judge['case_fullname'], batch_path(os.path.join(judge['out_dir'], 'compile.log'))] + compile_args(judge, type)
+            fp.write('\t'.join(fields) + '\n')
+    open(result_file, 'w').close()
+    printLog('batch {0}: compiling {1} testcases'.format(index, len(chunk)))
+    # 同一批次中的测试点可能属于超时不同的测试集，取其中最长的
+    timeout = max(judge['timeout'] for judge in chunk)
+    cmd = CmdBatchCompile.format(jvm=compiler['jvm-options'], harness=batch_path(os.path.join(batch_dir, 'harness')), list=batch_path(list_file),
+        result=batch_path(result_file), timeout=timeout, isolate='true' if BatchCompileIsolate else 'false', classpath=classpath)
+    try:
+        run_container(client, JavaImage, cmd, 'compiler_{pid}_batch_{index}'.format(pid=os.getpid(), index=index), 'batch_compile', '/compiler',
+            volumes, static_volumes, timeout=timeout * len(chunk))
+    except Exception as e:
+        printLog('batch {0}: {1}'.format(index, str(e)))
+    with open(result_file, 'r') as fp:
+        for line in fp:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) != 3 or fields[0] not in jobs:
+                continue
+            judge = jobs[fields[0]]
+            judge['precompiled'] = {'status': int(fields[1]), 'time': int(fields[2])}
+            add_duration(judge, 'compile', judge['precompiled']['time'] / 1000)
+            if judge['precompiled']['status'] == 0:
+                cache_store('compile', compile_key(judge['file_src'], type, compiler, source_digest(judge)), compile_outputs(judge, type))
+            printLog('{0} - batch compiled with code {1} in {2} ms'.format(fields[0], fields[1], fields[2]))
+    missing = [name for name, judge in jobs.items() if 'precompiled' not in judge]
+    if len(missing) > 0:
+        printLog('batch {0}: {1} testcases not finished, fall back to per-file compilation'.format(index, len(missing)))
+
+def compiler_volumes(compiler: dict):
+    static_volumes = {os.path.realpath(compiler['compiler-build']): {'bind': '/compiler/compiler', 'mode': 'ro'}}
+    classpath = ['/compiler/compiler']
+    jars = list_jars(compiler['compiler-lib'])
+    if len(jars) > 0:
+        classpath += [os.path.join('/compiler/lib', x) for x in jars]
+        static_volumes[os.path.realpath(compiler['compiler-lib'])] = {'bind': '/compiler/lib', 'mode': 'ro'}
+    return static_volumes, ':'.join(classpath)
+
+def batch_compile(client: docker.DockerClient, testcases: list, targets: list) -> list:
+    type = compile_type(targets)
+    if type is None:
+        return testcases
+    printLog('batch compile begin.')
+    harness_dir = os.path.join(logDir, 'batch', 'harness')
+    os.makedirs(harness_dir, exist_ok=True)
+    shutil.copy(HarnessSrc, harness_dir)
+    volumes = {os.path.realpath(logDirHost): {'bind': BatchMount + '/', 'mode': 'rw'}}
+    static_volumes, _ = compiler_volumes(DefaultVariant)
+    try:
+        run_container(client, JavaImage, CmdBuildHarness.format(dir=batch_path(harness_dir)), 'compiler_{0}_batch_harness'.format(os.getpid()),
+            'batch_harness', '/compiler', volumes, static_volumes)
+    except Exception as e:
+        printLog('batch harness build failed, fall back to per-file compilation: {0}'.format(str(e)))
+        return testcases
+    with ThreadPoolExecutor(max_workers=NumParallel) as pool:
+        prepared = [(testcase, judge) for testcase, judge in zip(testcases, pool.map(prepare_or_record, testcases)) if judge is not None]
+    judges = []
+    for testcase, judge in prepared:
+        testcase['judge'] = judge
+        judges.append(judge)
+    # 已缓存的测试点不参与批量编译
+    misses = []
+    for judge in judges:
+        os.makedirs(judge['out_dir'], exist_ok=True)
+        if cache_fetch('compile', compile_key(judge['file_src'], type, judge['compiler'], source_digest(judge)), compile_outputs(judge, type)):
+            judge['precompiled'] = {'status': 0, 'time': 0}
+            printLog('{0} - compile cache hit.'.format(judge['case_fullname']))
+        else:
+            misses.append(judge)
+    # 按编译器变体分组后再切分批次
+    groups = {}
+    for judge in misses:
+        groups.setdefault(judge['compiler']['name'], []).append(judge)
+    chunks = [judges[i:i + BatchCompileSize] for judges in groups.values() for i in range(0, len(judges), BatchCompileSize)]
+    with ThreadPoolExecutor(max_workers=NumParallel) as pool:
+        futures = [pool.submit(compile_chunk, client, index, chunk, type, volumes)
+            for index, chunk in enumerate(chunks)]
+    for index, future in enumerate(futures):
+        if future.exception() is not None:
+            printLog('batch {0} failed: {1}'.format(index, str(future.exception())))
+    printLog('batch compile finished.')
+    return [testcase for testcase, _ in prepared]
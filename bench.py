@@ -0,0 +1,295 @@
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import zlib
+import argparse
+import resource
+import threading
+import subprocess
+from datetime import datetime
+
+# 评测机自身开销的基准测试: 生成指定规模的合成测试点，用进程内模拟的 docker 客户端 (按配置的延迟模拟各阶段，
+# 并像正确的编译器一样写出编译产物和运行输出) 走完整的 load_testcases → test_one_case → add_result → 报告 流程，
+# 输出吞吐量、每个用例的额外开销、内存峰值和报告生成时间，便于客观比较调度、staging、报告等改动前后的差异。
+#
+#     python3 bench.py config.json --cases 10 100 1000 10000 --io small huge
+#
+# 每个场景 (用例数量 × 输入输出大小) 在单独的子进程中评测，使用配置文件中的 staging、num-parallel、pipeline 等参数；
+# 容器池、批量编译、分布式评测等不经过模拟的 docker 客户端，评测时关闭。
+
+bench_parser = argparse.ArgumentParser(description='SysY compiler judge overhead benchmark')
+bench_parser.add_argument('config', nargs='?', default='', help='base config file (default: built-in minimal config)')
+bench_parser.add_argument('--cases', type=int, nargs='+', default=[10, 100, 1000], help='number of testcases of each scenario')
+bench_parser.add_argument('--io', nargs='+', default=['small'], help='size of .in/.out files: small, medium, large, huge or a size like 256k')
+bench_parser.add_argument('--latency', default='compile=0.05,genelf=0.01,run=0.01,interpret=0.06', help='simulated latency (seconds) of each stage')
+bench_parser.add_argument('--parallel', type=int, default=0, help='override num-parallel')
+bench_parser.add_argument('--wrong', type=float, default=0, help='fraction of testcases with wrong output')
+bench_parser.add_argument('--dir', default='', help='directory of generated testcases and logs (default: <log-dir>/.bench)')
+bench_parser.add_argument('--keep', action='store_true', help='keep log dir of each scenario')
+bench_parser.add_argument('--child', default='', help=argparse.SUPPRESS)   # 子进程: 写入评测指标的文件
+bench_args = bench_parser.parse_args()
+
+IoSizes = {'small': 64, 'medium': 16 << 10, 'large': 1 << 20, 'huge': 32 << 20}
+BenchSeries = 'bench'
+BenchSource = 'int main() {\n    return 0;\n}\n'
+BenchPerf = 'TOTAL: 0H-0M-0S-1000us\n'
+
+# 主进程不导入 public (会读取命令行中的配置并创建评测记录目录)，因此单独解析大小
+def io_size(name: str) -> int:
+    if name in IoSizes:
+        return IoSizes[name]
+    units = {'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30}
+    name = name.strip().lower()
+    if name and name[-1] in units:
+        return int(float(name[:-1]) * units[name[-1]])
+    return int(name)
+
+def parse_latency(text: str) -> dict:
+    latency = {}
+    for item in text.split(','):
+        if item.strip():
+            stage, secs = item.split('=')
+            latency[stage.strip()] = float(secs)
+    return latency
+
+# 用例 name 的输出是否故意写错 (按名称的哈希决定，多次评测结果一致)
+def is_wrong(name: str, fraction: float) -> bool:
+    return fraction > 0 and zlib.crc32(name.encode()) % 10000 < fraction * 10000
+
+# ---------- 模拟的 docker 客户端 ----------
+
+StageName = re.compile(r'^compiler_\d+_(compile|genelf|run|interpret)_')
+
+class FakeContainer:
+    def __init__(self, client, name: str, volumes: dict):
+        self.client = client
+        self.name = name
+        self.id = name
+        self.volumes = {bind['bind'].rstrip('/'): host for host, bind in volumes.items()}
+        match = StageName.match(name)
+        self.stage = match.group(1) if match else ''
+        self.latency = client.latency.get(self.stage, 0)
+        self.started = None
+        self.attrs = {'State': {'OOMKilled': False}}
+        self.status = 'created'
+
+    def start(self):
+        self.started = time.monotonic()
+        self.status = 'running'
+
+    def wait(self, timeout=None) -> dict:
+        remaining = self.started + self.latency - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+        self.client.account(self.latency)
+        self.effects()
+        self.status = 'exited'
+        return {'StatusCode': 0, 'Error': None}
+
+    # 像正确的编译器与程序一样写出各阶段的产物: 程序的输出为其输入，运行脚本在其后追加退出码
+    def effects(self):
+        output = self.volumes.get('/output')
+        if self.stage == 'compile':
+            for name in ['test.ll', 'test.S']:
+                shutil.copyfile(self.volumes['/compiler/test.sy'], os.path.join(output, name))
+            open(os.path.join(output, 'compile.log'), 'w').close()
+        elif self.stage == 'genelf':
+            with open(self.volumes['/compiler/test.elf'], 'w') as fp:
+                fp.write(BenchSource)
+            open(os.path.join(output, 'genelf.log'), 'w').close()
+        elif self.stage in ['run', 'interpret']:
+            path = os.path.join(output, 'output.txt')
+            shutil.copyfile(self.volumes['/compiler/input.txt'], path)
+            with open(path, 'a') as fp:
+                fp.write('1\n' if is_wrong(os.path.basename(os.path.dirname(output)), self.client.wrong) else '0\n')
+            with open(os.path.join(output, 'perf.txt'), 'w') as fp:
+                fp.write(BenchPerf)
+
+    def logs(self, **kwargs) -> bytes:
+        return b''
+
+    def reload(self):
+        pass
+
+    def kill(self):
+        pass
+
+    def remove(self, force=False):
+        pass
+
+class FakeContainers:
+    def __init__(self, client):
+        self.client = client
+
+    def create(self, image: str, command: str=None, name: str='', volumes: dict={}, **kwargs) -> FakeContainer:
+        return FakeContainer(self.client, name, volumes)
+
+class FakeDockerClient:
+    """docker.DockerClient 的替身，只实现 DockerBackend 用到的接口 (不支持容器池)"""
+    def __init__(self, latency: dict, wrong: float):
+        self.latency = latency
+        self.wrong = wrong
+        self.containers = FakeContainers(self)
+        self.lock = threading.Lock()
+        self.simulated = 0.0    # 模拟的各阶段延迟之和 (秒)
+
+    def account(self, secs: float):
+        with self.lock:
+            self.simulated += secs
+
+# ---------- 子进程: 评测一个场景 ----------
+
+if bench_args.child:
+    import docker
+    fake_client = FakeDockerClient(parse_latency(bench_args.latency), bench_args.wrong)
+    docker.from_env = lambda **kwargs: fake_client
+    from options import use_config
+    use_config(bench_args.config)
+
+    from concurrent.futures import ThreadPoolExecutor, wait
+    from const import *
+    from public import *
+    from util import display_result, pretty_result
+    from manifest import load_testcases
+    from judge import test_one_case
+    from pipeline import run_pipeline
+    from adaptive import run_admitted
+    from sink import result_sink
+
+    def run_scenario() -> dict:
+        begin = time.monotonic()
+        testcases = load_testcases(TestcaseSelect, TestcaseExclude)
+        walk_time = time.monotonic() - begin
+        result_sink.set_total(len(testcases))
+        begin = time.monotonic()
+        if Pipeline:
+            run_pipeline(testcases)
+        else:
+            pool = ThreadPoolExecutor(max_workers=AdaptiveMax if Adaptive else NumParallel)
+            wait([pool.submit(run_admitted, test_one_case, testcase) for testcase in testcases])
+            pool.shutdown()
+        judge_time = time.monotonic() - begin
+        begin = time.monotonic()
+        with open(os.path.join(logDir, 'result_' + logName + '.html'), 'w') as fp:
+            for chunk in display_result(result_sink, title=logName):
+                fp.write(chunk)
+        html_time = time.monotonic() - begin
+        begin = time.monotonic()
+        with open(os.path.join(logDir, 'result_' + logName + '.txt'), 'w') as fp:
+            fp.write(pretty_result(result_sink))
+        text_time = time.monotonic() - begin
+        workers = AdaptiveMax if Adaptive else NumParallel
+        passed = sum(r['verdict'] == ACCEPTED for r in result_sink)
+        cases = max(1, len(testcases))
+        return {'cases': len(testcases), 'passed': passed, 'workers': workers, 'walk_time': walk_time, 'judge_time': judge_time,
+            'cases_per_sec': len(testcases) / judge_time if judge_time > 0 else None, 'simulated': fake_client.simulated,
+            # 每个用例占用评测线程的时间中，模拟的阶段延迟之外的部分
+            'overhead': (judge_time * workers - fake_client.simulated) / cases,
+            'html_time': html_time, 'text_time': text_time, 'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            'log_dir': logDir}
+
+    metrics = run_scenario()
+    result_sink.close()
+    with open(bench_args.child, 'w') as fp:
+        json.dump(metrics, fp=fp)
+    sys.exit(0)
+
+# ---------- 主进程: 生成测试点并依次评测各场景 ----------
+
+import prettytable
+
+def load_base_config() -> dict:
+    if not bench_args.config:
+        return {'run-type': 'llvm', 'num-parallel': 8}
+    with open(bench_args.config, 'r') as fp:
+        return json.load(fp)
+
+# 生成 cases 个用例，输入为 size 字节的数字行，答案为输入加上退出码 0。各用例通过硬链接共用同一份内容
+def generate_tree(base: str, cases: int, size: int) -> str:
+    tree = os.path.join(base, 'trees', '{0}_{1}'.format(cases, size))
+    if os.path.exists(os.path.join(tree, '.done')):
+        return tree
+    shutil.rmtree(tree, ignore_errors=True)
+    series = os.path.join(tree, BenchSeries)
+    os.makedirs(series)
+    line = ' '.join(['12345'] * 10) + '\n'
+    blobs = {'.sy': os.path.join(tree, 'blob.sy'), '.in': os.path.join(tree, 'blob.in'), '.out': os.path.join(tree, 'blob.out')}
+    with open(blobs['.sy'], 'w') as fp:
+        fp.write(BenchSource)
+    with open(blobs['.in'], 'w') as fp:
+        fp.write((line * (size // len(line) + 1))[:max(size - 1, 0)] + '\n')
+    shutil.copyfile(blobs['.in'], blobs['.out'])
+    with open(blobs['.out'], 'a') as fp:
+        fp.write('0\n')
+    for i in range(cases):
+        for ext, blob in blobs.items():
+            path = os.path.join(series, 'case_{0:05d}{1}'.format(i, ext))
+            try:
+                os.link(blob, path)
+            except OSError:
+                shutil.copyfile(blob, path)
+    open(os.path.join(tree, '.done'), 'w').close()
+    return tree
+
+def scenario_config(base_config: dict, base: str, tree: str) -> str:
+    compiler = os.path.join(base, 'compiler')
+    os.makedirs(compiler, exist_ok=True)
+    log_dir = os.path.join(base, 'logs')
+    config = dict(base_config)
+    config.update({'compiler-src': compiler, 'compiler-build': compiler, 'compiler-lib': '', 'testcase-base': tree, 'testcase-base-host': tree,
+        'testcase-select': [BenchSeries], 'rebuild-compiler': False, 'log-dir': log_dir, 'log-dir-host': log_dir, 'backend': 'docker', 'container-pool': False,
+        'batch-compile': 0, 'workers': [], 'rpi-addresses': [], 'variants': [], 'app-cds': False, 'benchmark': {}})
+    if bench_args.parallel > 0:
+        config['num-parallel'] = bench_args.parallel
+    path = os.path.join(base, 'config.json')
+    with open(path, 'w') as fp:
+        json.dump(config, fp=fp, indent=4)
+    return path
+
+def run_child(config_path: str, base: str, name: str) -> dict:
+    metrics_path = os.path.join(base, 'metrics.json')
+    if os.path.exists(metrics_path):
+        os.remove(metrics_path)
+    with open(os.path.join(base, name + '.log'), 'w') as log:
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__), config_path, '--child', metrics_path,
+            '--latency', bench_args.latency, '--wrong', str(bench_args.wrong)], stdout=log, stderr=subprocess.STDOUT)
+    if proc.returncode != 0 or not os.path.exists(metrics_path):
+        raise Exception('scenario {0} failed with code {1}, see {2}'.format(name, proc.returncode, os.path.join(base, name + '.log')))
+    with open(metrics_path, 'r') as fp:
+        return json.load(fp)
+
+def format_secs(secs) -> str:
+    return '?' if secs is None else '{0:.3f}s'.format(secs)
+
+def main():
+    base_config = load_base_config()
+    base = os.path.realpath(bench_args.dir or os.path.join(base_config.get('log-dir', 'logs'), '.bench'))
+    rows = []
+    table = prettytable.PrettyTable(field_names=['cases', 'io', 'passed', 'workers', 'cases/s', 'overhead/case', 'walk', 'html report', 'text report', 'peak rss'])
+    for io in bench_args.io:
+        for cases in bench_args.cases:
+            size = io_size(io)
+            name = '{0}_{1}'.format(cases, io)
+            print('generating {0} testcases ({1} bytes each) ......'.format(cases, size), file=sys.stderr, flush=True)
+            tree = generate_tree(base, cases, size)
+            config_path = scenario_config(base_config, base, tree)
+            print('judging {0} ......'.format(name), file=sys.stderr, flush=True)
+            metrics = run_child(config_path, base, name)
+            if not bench_args.keep:
+                shutil.rmtree(metrics['log_dir'], ignore_errors=True)
+            rows.append(dict(metrics, io=io, io_size=size))
+            table.add_row([cases, io, metrics['passed'], metrics['workers'], '?' if metrics['cases_per_sec'] is None else '{0:.1f}'.format(metrics['cases_per_sec']),
+                '{0:.1f}ms'.format(metrics['overhead'] * 1000), format_secs(metrics['walk_time']), format_secs(metrics['html_time']),
+                format_secs(metrics['text_time']), '{0:.1f}m'.format(metrics['peak_rss'] / (1 << 20))])
+    print(table)
+    print('simulated latency: {0}'.format(bench_args.latency))
+    # 保存本次结果，供比较改动前后的数据
+    result_file = os.path.join(base, 'bench_{0}.json'.format(datetime.now().strftime('%Y_%m_%d_%H_%M_%S')))
+    with open(result_file, 'w') as fp:
+        json.dump({'latency': parse_latency(bench_args.latency), 'config': base_config, 'scenarios': rows}, fp=fp)
+    print('results saved to {0}'.format(result_file))
+
+main()
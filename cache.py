@@ -0,0 +1,160 @@
+import os
+import shutil
+import hashlib
+import threading
+
+import tasks
+from public import *
+from tasks import SysyImage
+from util import hash_file, hash_tree, parse_size
+from logger import printLog
+
+# 内容寻址的编译产物缓存:
+#   compile/<key>/  以编译器、源程序、编译参数的哈希为键，保存 test.ll / test.S / compile.log
+#   elf/<key>/      以汇编代码、目标架构和工具链 (镜像 ID) 的哈希为键，保存 test.elf / genelf.log
+# 每次命中时更新条目目录的修改时间，超出容量时按修改时间淘汰最久未使用的条目 (LRU)。
+
+CacheDir = os.path.realpath(ArtifactCacheDir)
+CacheLimit = parse_size(ArtifactCacheSize)
+
+compiler_digests = {}   # {(构建目录, 依赖库目录): 哈希}
+compiler_digest_lock = threading.Lock()
+
+def get_compiler_digest(build_dir: str, lib_dir: str) -> str:
+    """编译器构建产物 (class 目录或 compiler.jar) 与依赖库的哈希，构建目录不可访问时返回 None"""
+    key = (build_dir, lib_dir)
+    with compiler_digest_lock:
+        if key not in compiler_digests:
+            fingerprint = tasks.compiler_fingerprint(build_dir, lib_dir)
+            if fingerprint is not None:
+                # 本进程构建 (或确认未改变) 的编译器，直接使用该构建目录的指纹，无需再哈希构建目录
+                compiler_digests[key] = 'build:' + fingerprint
+            elif not os.path.isdir(build_dir):
+                printLog('artifact cache: compiler build {0} is not accessible, cache disabled'.format(build_dir))
+                compiler_digests[key] = ''
+            else:
+                hasher = hash_tree(build_dir)
+                if lib_dir and os.path.isdir(lib_dir):
+                    hash_tree(lib_dir, hasher)
+                compiler_digests[key] = hasher.hexdigest()
+                printLog('artifact cache: compiler digest {0} ({1})'.format(compiler_digests[key], build_dir))
+        return compiler_digests[key] or None
+
+# 守护进程中编译器可能在两次提交之间重新构建，每次提交开始时重新计算其哈希
+def forget_compiler_digest(build_dir: str, lib_dir: str):
+    with compiler_digest_lock:
+        compiler_digests.pop((build_dir, lib_dir), None)
+
+# compiler 为编译器变体 {compiler-build, compiler-lib, opt-options, jvm-options}；
+# sy_digest 为测试点清单中记录的源程序哈希，没有时 (如分布式评测的 worker) 重新哈希源程序
+def compile_key(sy_path: str, type: str, compiler: dict=DefaultVariant, sy_digest: str=None) -> str:
+    if not ArtifactCache:
+        return None
+    digest = get_compiler_digest(compiler['compiler-build'], compiler['compiler-lib'])
+    if digest is None:
+        return None
+    hasher = hashlib.sha256()
+    for part in [digest, type, str(EmitLLVM), compiler['opt-options'], compiler['jvm-options']]:
+        hasher.update(part.encode('utf-8') + b'\0')
+    hasher.update((sy_digest or hash_file(sy_path).hexdigest()).encode('utf-8'))
+    return hasher.hexdigest()
+
+toolchain_digest = None    # 生成 ELF 的工具链的标识，每次评测解析一次
+toolchain_digest_lock = threading.Lock()
+
+def get_toolchain_digest() -> str:
+    """docker 后端为 SysyImage 的镜像 ID (镜像重新构建后 ID 改变)，native 后端为本机 sysy-asm2elf.sh 的哈希；无法解析时返回 None"""
+    global toolchain_digest
+    with toolchain_digest_lock:
+        if toolchain_digest is None:
+            try:
+                if DockerClient is not None:
+                    toolchain_digest = DockerClient.images.get(SysyImage).id
+                else:
+                    toolchain_digest = 'native:' + hash_file(shutil.which('sysy-asm2elf.sh')).hexdigest()
+                printLog('artifact cache: toolchain digest {0}'.format(toolchain_digest))
+            except Exception as e:
+                printLog('artifact cache: cannot resolve toolchain {0}, elf cache disabled: {1}'.format(SysyImage, str(e)))
+                toolchain_digest = ''
+        return toolchain_digest or None
+
+# 守护进程中镜像可能在两次提交之间重新构建，每次提交开始时重新解析
+def forget_toolchain_digest():
+    global toolchain_digest
+    with toolchain_digest_lock:
+        toolchain_digest = None
+
+def elf_key(asm_path: str, arch: str) -> str:
+    if not ArtifactCache:
+        return None
+    digest = get_toolchain_digest()
+    if digest is None:
+        return None
+    hasher = hashlib.sha256()
+    for part in [digest, arch]:
+        hasher.update(part.encode('utf-8') + b'\0')
+    hash_file(asm_path, hasher)
+    return hasher.hexdigest()
+
+def entry_dir(kind: str, key: str) -> str:
+    return os.path.join(CacheDir, kind, key[:2], key)
+
+# 命中时将缓存的文件复制到目标位置 (files 为 {缓存中的文件名: 目标路径})，返回是否命中
+def cache_fetch(kind: str, key: str, files: dict) -> bool:
+    if key is None:
+        return False
+    entry = entry_dir(kind, key)
+    if not all(os.path.exists(os.path.join(entry, name)) for name in files):
+        return False
+    try:
+        for name, dst in files.items():
+            shutil.copy(os.path.join(entry, name), dst)
+        os.utime(entry)
+    except OSError:
+        return False
+    return True
+
+def cache_store(kind: str, key: str, files: dict):
+    if key is None:
+        return
+    entry = entry_dir(kind, key)
+    if os.path.exists(entry):
+        return
+    tmp = '{0}.tmp.{1}.{2}'.format(entry, os.getpid(), threading.get_ident())
+    try:
+        os.makedirs(tmp)
+        for name, src in files.items():
+            if os.path.exists(src):
+                shutil.copy(src, os.path.join(tmp, name))
+        os.rename(tmp, entry)
+    except OSError:
+        pass    # 其他线程已写入相同的条目
+    finally:
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp, ignore_errors=True)
+
+def evict_cache():
+    if not ArtifactCache or not os.path.isdir(CacheDir):
+        return
+    entries = []
+    total = 0
+    for kind in os.listdir(CacheDir):
+        for prefix in os.listdir(os.path.join(CacheDir, kind)):
+            prefix_dir = os.path.join(CacheDir, kind, prefix)
+            for key in os.listdir(prefix_dir):
+                if '.tmp.' in key:
+                    continue
+                entry = os.path.join(prefix_dir, key)
+                size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), size, entry))
+                total += size
+    if total <= CacheLimit:
+        return
+    evicted = 0
+    for _, size, entry in sorted(entries):
+        if total <= CacheLimit:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+        evicted += 1
+    printLog('artifact cache: evicted {0} entries, {1} bytes remain'.format(evicted, total))
@@ -0,0 +1,89 @@
+import os
+import glob
+import json
+import html
+import math
+import prettytable
+
+from const import *
+from util import parse_perf_time, format_perf_time, format_case
+
+# 与之前的评测结果对比运行时间: 加速比 = 旧时间 / 新时间，新时间超过旧时间 (1 + threshold) 倍记为性能回退
+
+# path 为 result_*.json(l) 文件或评测记录目录，被中断的评测只有 result_*.jsonl
+def load_results(path: str) -> list:
+    if os.path.isdir(path):
+        files = sorted(glob.glob(os.path.join(path, 'result_*.json'))) or sorted(glob.glob(os.path.join(path, 'result_*.jsonl')))
+        if len(files) == 0:
+            raise Exception('no result_*.json found in {0}'.format(path))
+        path = files[-1]
+    with open(path, 'r') as fp:
+        if path.endswith('.jsonl'):
+            return [json.loads(line) for line in fp if line.strip()]
+        return json.load(fp)
+
+def result_time(result: dict):
+    t = result.get('perf_time')
+    if t is None and result.get('perf'):
+        t = parse_perf_time(result['perf'])     # 旧版本的结果没有 perf_time
+    return t
+
+def compare_results(results: list, previous: list, threshold: float) -> dict:
+    # 变体 (variants) 与评测类型的结果只与之前相同变体、相同评测类型的结果对比
+    old = {(r['series_name'], r['case_name'], r.get('variant', ''), r.get('target', '')): r for r in previous}
+    rows, speedups, regressions = [], [], []
+    for r in sorted(results, key=lambda r: (r['series_name'], r['case_name'], r.get('variant', ''), r.get('target', ''))):
+        key = (r['series_name'], r['case_name'], r.get('variant', ''), r.get('target', ''))
+        if key not in old:
+            continue
+        old_time, new_time = result_time(old[key]), result_time(r)
+        row = {'series_name': r['series_name'], 'case_name': format_case(r), 'old_verdict': old[key]['verdict'], 'new_verdict': r['verdict'],
+            'old_time': old_time, 'new_time': new_time, 'speedup': None, 'regression': False}
+        both_accepted = old[key]['verdict'] == ACCEPTED and r['verdict'] == ACCEPTED
+        if both_accepted and old_time and new_time:
+            row['speedup'] = old_time / new_time
+            speedups.append(row['speedup'])
+            if new_time > old_time * (1 + threshold):
+                row['regression'] = True
+                regressions.append(row)
+        rows.append(row)
+    geomean = math.exp(sum(map(math.log, speedups)) / len(speedups)) if len(speedups) > 0 else None
+    return {'rows': rows, 'geomean': geomean, 'regressions': regressions, 'threshold': threshold}
+
+def format_speedup(speedup) -> str:
+    return '' if speedup is None else 'x{0:.3f}'.format(speedup)
+
+def comparison_summary(comparison: dict) -> str:
+    return 'Compared {0} testcases, geometric mean speedup {1}, {2} regressions beyond {3:.1%}.'.format(
+        len(comparison['rows']), format_speedup(comparison['geomean']) or 'n/a', len(comparison['regressions']), comparison['threshold'])
+
+def comparison_text(comparison: dict) -> str:
+    table = prettytable.PrettyTable(field_names=['series', 'case_name', 'old verdict', 'new verdict', 'old time', 'new time', 'speedup', 'flag'])
+    for row in comparison['rows']:
+        table.add_row((row['series_name'], row['case_name'], row['old_verdict'], row['new_verdict'], format_perf_time(row['old_time']),
+            format_perf_time(row['new_time']), format_speedup(row['speedup']), 'REGRESSION' if row['regression'] else ''))
+    lines = [str(table), comparison_summary(comparison)]
+    for row in comparison['regressions']:
+        lines.append('  regression: {0}/{1} {2} -> {3}'.format(row['series_name'], row['case_name'], format_perf_time(row['old_time']), format_perf_time(row['new_time'])))
+    return '\n'.join(lines)
+
+def comparison_html(comparison: dict) -> str:
+    table_rows = []
+    for row in comparison['rows']:
+        cells = [row['series_name'], row['case_name'], row['old_verdict'], row['new_verdict'], format_perf_time(row['old_time']),
+            format_perf_time(row['new_time']), format_speedup(row['speedup'])]
+        cells = [html.escape(str(s)) for s in cells]
+        if row['regression']:
+            cells[6] = "<font color=\"red\">" + cells[6] + "</font>"
+        elif row['speedup'] is not None and row['speedup'] > 1:
+            cells[6] = "<font color=\"green\">" + cells[6] + "</font>"
+        table_rows.append('<tr>{0}</tr>'.format(''.join(['<td>{0}</td>'.format(s) for s in cells])))
+    regressions = ''.join(['<li>{0}/{1}: {2} -> {3}</li>'.format(html.escape(r['series_name']), html.escape(r['case_name']),
+        format_perf_time(r['old_time']), format_perf_time(r['new_time'])) for r in comparison['regressions']])
+    return '''<h3>Comparison</h3>
+<p>{summary}</p>
+<ul>{regressions}</ul>
+<table border="1">
+<tr> <th>series</th> <th>name</th> <th>old verdict</th> <th>new verdict</th> <th>old time</th> <th>new time</th> <th>speedup</th> </tr>
+{body}
+</table>'''.format(summary=html.escape(comparison_summary(comparison)), regressions=regressions, body='\n'.join(table_rows))
@@ -4,6 +4,8 @@ WRONG_ANSWER    = 'WRONG_ANSWER'
 BUILD_FAILED    = 'BUILD_FAILED'
 COMPILE_ERROR   = 'COMPILE_ERROR'
 RUNTIME_ERROR   = 'RUNTIME_ERROR'
+MEMORY_LIMIT    = 'MEMORY_LIMIT'
+OUTPUT_LIMIT    = 'OUTPUT_LIMIT'
 OTHER_ERROR     = 'OTHER_ERROR'
 
 # 评测类型
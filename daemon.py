@@ -0,0 +1,347 @@
+import os
+import sys
+import json
+import time
+import queue
+import signal
+import hmac
+import argparse
+import threading
+import socketserver
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from options import use_config
+
+# 守护进程模式: 常驻进程保持 docker 连接、容器池、编译产物缓存和测试点索引，通过本地 HTTP 或 Unix socket 接收评测请求，
+# 逐个用例以 JSON Lines 流式返回结果。多个提交同时排队时按轮转方式分配评测线程，每个提交轮流评测一个测试点。
+#
+#     python3 daemon.py config.json --port 9200
+#     python3 daemon.py config.json --socket /tmp/sysy-judge.sock
+#
+# API:
+#   GET    /                    评测类型、并发数和排队中的提交
+#   POST   /submissions         提交评测，返回流 (chunked, application/x-ndjson):
+#                               第一行 {submission, total}，之后每完成一个用例一行评测结果，最后一行 {submission, summary, wall_time, cancelled}
+#   DELETE /submissions/<id>    取消提交中尚未开始的测试点 (客户端断开连接时同样取消)
+# 请求 (均可省略，缺省使用配置文件中的同名参数):
+#   {"name": ..., "series": [...], "exclude": [...], "compiler-src": ..., "compiler-build": ..., "compiler-lib": ..., "opt-options": ..., "jvm-options": ...}
+#   给出 compiler-src 时先 (增量) 构建到 compiler-build，构建期间不会开始使用同一构建目录的提交。
+# 守护进程会构建并运行请求中给出的编译器，配置文件中必须设置 daemon-token，所有请求须在 X-Judge-Token 头中带有该令牌。
+
+daemon_parser = argparse.ArgumentParser(description='SysY compiler judge daemon')
+daemon_parser.add_argument('config', help='config file of the daemon')
+daemon_parser.add_argument('--host', default='127.0.0.1')
+daemon_parser.add_argument('--port', type=int, default=9200)
+daemon_parser.add_argument('--socket', default='', help='listen on a unix socket instead of tcp')
+daemon_args = daemon_parser.parse_args()
+use_config(daemon_args.config)
+
+from const import *
+from public import *
+from util import get_summary
+from manifest import load_testcases, record_durations
+from tasks import build_compiler
+from judge import prepare_testcase, test_one_case, add_error_result
+from adaptive import run_admitted
+from schedule import order_testcases, save_history
+from cache import forget_compiler_digest, forget_toolchain_digest, evict_cache
+from appcds import prepare_archive
+from pool import shutdown_pools
+from sink import result_sink
+from timing import reset_trace
+from logger import printLog
+
+if RunType in [TYPE_RPI, TYPE_RPI_ELF]:
+    raise Exception('daemon does not support run-type {0}'.format(RunType))
+if len(RunTypes) > 1:
+    raise Exception('daemon does not support multiple run-types')
+if not DaemonToken:
+    raise Exception('daemon requires daemon-token in its config')
+
+class Submission:
+    def __init__(self, serial: int, request: dict, testcases: list):
+        self.id = 'submission_{0:04d}'.format(serial)
+        self.name = request.get('name', '')
+        self.compiler = {
+            'name': '',
+            'compiler-build': request.get('compiler-build', CompilerBuild),
+            'compiler-lib': request.get('compiler-lib', CompilerLib),
+            'opt-options': request.get('opt-options', OptOptions),
+            'jvm-options': request.get('jvm-options', JvmOptions),
+        }
+        self.pending = deque(testcases)
+        self.total = len(testcases)
+        self.running = 0
+        self.finished = []          # 已完成的评测结果
+        self.results = queue.Queue()    # 交给流式响应的结果，None 表示结束
+        self.cancelled = False
+        self.closed = False
+        self.begin = time.monotonic()
+
+    def status(self) -> dict:
+        return {'id': self.id, 'name': self.name, 'total': self.total, 'done': len(self.finished), 'running': self.running, 'queued': len(self.pending)}
+
+submissions = {}        # 未结束的提交 {id: Submission}
+queued = []             # 有待评测测试点的提交，按轮转顺序
+build_users = {}        # 各编译器构建目录正在使用它的提交数 {compiler-build: count}
+building = set()        # 正在构建的编译器构建目录
+submission_cond = threading.Condition()
+submission_serial = 0
+
+build_lock = threading.Lock()   # 构建容器的名称只与进程号有关，同一时刻只构建一个编译器
+history_lock = threading.Lock()
+
+# 结束提交: 释放编译器构建目录并通知流式响应，调用者须持有 submission_cond
+def close_submission(submission: Submission):
+    if submission.closed:
+        return
+    submission.closed = True
+    build = submission.compiler['compiler-build']
+    build_users[build] -= 1
+    submissions.pop(submission.id, None)
+    if not submissions:
+        # 守护进程不生成 trace 文件和报告，没有正在评测的提交时清空，避免常驻进程中的事件和索引无限增长
+        reset_trace()
+        result_sink.reset_index()
+    submission_cond.notify_all()
+    submission.results.put(None)
+
+def pattern_list(request: dict, key: str, default: list) -> list:
+    patterns = request.get(key, default)
+    if isinstance(patterns, str):
+        return [patterns]
+    if not isinstance(patterns, list) or not all(isinstance(p, str) for p in patterns):
+        raise ValueError('{0} must be a string or a list of strings'.format(key))
+    return patterns
+
+def submit(request: dict) -> Submission:
+    global submission_serial
+    # 测试点清单只重新哈希大小或修改时间变化的文件，series 可以使用与 testcase-select 相同的通配符、标签和正则表达式
+    series = pattern_list(request, 'series', TestcaseSelect)
+    testcases = load_testcases(series, pattern_list(request, 'exclude', TestcaseExclude))
+    with submission_cond:
+        submission_serial += 1
+        submission = Submission(submission_serial, request, testcases)
+    build, src = submission.compiler['compiler-build'], request.get('compiler-src', '')
+    with submission_cond:
+        # 构建期间不开始使用同一构建目录的提交；重新构建须等待正在使用该目录的提交结束
+        while build in building or (src and build_users.get(build, 0) > 0):
+            submission_cond.wait()
+        if src:
+            building.add(build)
+        else:
+            build_users[build] = build_users.get(build, 0) + 1
+    if src:
+        try:
+            os.makedirs(build, exist_ok=True)
+            with build_lock:
+                build_compiler(DockerClient, src, build, submission.compiler['compiler-lib'])
+        except Exception:
+            with submission_cond:
+                building.discard(build)
+                submission_cond.notify_all()
+            raise
+        with submission_cond:
+            building.discard(build)
+            build_users[build] = build_users.get(build, 0) + 1
+            submission_cond.notify_all()
+    try:
+        forget_compiler_digest(build, submission.compiler['compiler-lib'])
+        forget_toolchain_digest()
+        if AppCds:
+            prepare_archive(submission.compiler, testcases)
+        if ScheduleHistory:
+            submission.pending = deque(order_testcases(testcases))
+    except Exception:
+        with submission_cond:
+            close_submission(submission)    # 释放构建目录，否则之后重新构建该目录的提交会一直等待
+        raise
+    printLog('daemon: {0}{1}: {2} testcases from {3}, compiler {4}'.format(submission.id, ' ({0})'.format(submission.name) if submission.name else '',
+        len(testcases), ', '.join(series), build))
+    with submission_cond:
+        submissions[submission.id] = submission
+        if submission.pending:
+            queued.append(submission)
+            submission_cond.notify_all()
+        else:
+            close_submission(submission)
+    return submission
+
+def cancel(submission: Submission):
+    with submission_cond:
+        if submission.closed:
+            return
+        printLog('daemon: {0} cancelled, {1} testcases not started'.format(submission.id, len(submission.pending)))
+        submission.cancelled = True
+        submission.pending.clear()
+        if submission in queued:
+            queued.remove(submission)
+        if submission.running == 0:
+            close_submission(submission)
+
+# 轮转: 从队首的提交取一个测试点，该提交还有测试点时移到队尾
+def next_job():
+    with submission_cond:
+        while len(queued) == 0:
+            submission_cond.wait()
+        submission = queued.pop(0)
+        testcase = submission.pending.popleft()
+        submission.running += 1
+        if submission.pending:
+            queued.append(submission)
+        return submission, testcase
+
+def judge_case(submission: Submission, testcase: dict) -> dict:
+    testcase = dict(testcase, log_subdir=submission.id)    # 索引中的测试点被多个提交共用
+    judge = None
+    try:
+        judge = prepare_testcase(testcase)
+        judge['compiler'] = submission.compiler
+        testcase['judge'] = judge
+        test_one_case(testcase)
+        with open(os.path.join(judge['work_dir'], 'result.json'), 'r') as fp:
+            return json.load(fp)
+    except Exception as e:
+        comment = str(e)
+        printLog('Daemon error ({0}/{1}): {2}'.format(submission.id, testcase['case_name'], comment))
+        if judge is not None:
+            add_error_result(judge, OTHER_ERROR, comment)
+            with open(os.path.join(judge['work_dir'], 'result.json'), 'r') as fp:
+                return json.load(fp)
+        result = {'series_name': testcase['series_name'], 'case_name': testcase['case_name'], 'verdict': OTHER_ERROR,
+            'comment': comment, 'perf': '', 'perf_time': None, 'stdin': '', 'stdout': '', 'answer': ''}
+        result_sink.append(result)
+        return result
+
+def dispatcher():
+    while True:
+        submission, testcase = next_job()
+        result = run_admitted(judge_case, submission, testcase)
+        with submission_cond:
+            submission.finished.append(result)
+            submission.results.put(result)
+            submission.running -= 1
+            if submission.running == 0 and not submission.pending:
+                close_submission(submission)
+
+def finish_submission(submission: Submission) -> dict:
+    if ScheduleHistory and not submission.cancelled:
+        with history_lock:
+            save_history(submission.finished)
+    record_durations(submission.finished)
+    evict_cache()
+    summary = get_summary(submission.finished)
+    printLog('daemon: {0} finished. {1}'.format(submission.id, summary))
+    return {'submission': submission.id, 'summary': summary, 'wall_time': time.monotonic() - submission.begin, 'cancelled': submission.cancelled}
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def reply(self, code: int, body: bytes, content_type: str='text/plain'):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def reply_json(self, obj):
+        self.reply(200, json.dumps(obj).encode(), 'application/json')
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def authorized(self) -> bool:
+        if hmac.compare_digest(self.headers.get('X-Judge-Token', '').encode(), DaemonToken.encode()):
+            return True
+        self.read_body()
+        self.reply(401, b'unauthorized')
+        return False
+
+    def write_line(self, obj):
+        data = (json.dumps(obj) + '\n').encode()
+        self.wfile.write('{0:x}\r\n'.format(len(data)).encode() + data + b'\r\n')
+        self.wfile.flush()
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        if self.path != '/':
+            self.reply(404, b'not found')
+            return
+        with submission_cond:
+            status = [s.status() for s in submissions.values()]
+        self.reply_json({'run-type': RunType, 'parallel': AdaptiveMax if Adaptive else NumParallel, 'submissions': status})
+
+    def do_DELETE(self):
+        if not self.authorized():
+            return
+        submission = submissions.get(self.path[len('/submissions/'):]) if self.path.startswith('/submissions/') else None
+        if submission is None:
+            self.reply(404, b'not found')
+            return
+        cancel(submission)
+        self.reply(200, b'cancelled')
+
+    def do_POST(self):
+        if not self.authorized():
+            return
+        body = self.read_body()
+        if self.path != '/submissions':
+            self.reply(404, b'not found')
+            return
+        try:
+            submission = submit(json.loads(body or b'{}'))
+        except ValueError as e:
+            self.reply(400, str(e).encode())
+            return
+        except Exception as e:
+            printLog('daemon: submission failed: {0}'.format(str(e)))
+            self.reply(500, str(e).encode())
+            return
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            self.write_line({'submission': submission.id, 'total': submission.total})
+            while True:
+                result = submission.results.get()
+                if result is None:
+                    break
+                self.write_line(result)
+            self.write_line(finish_submission(submission))
+            self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            cancel(submission)  # 客户端断开连接，不再评测剩余的测试点
+
+    def log_message(self, format, *args):
+        pass    # 评测过程已记录在日志中
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+if __name__ == '__main__':
+    if RebuildCompiler:
+        build_compiler(DockerClient, CompilerSrc, CompilerBuild, CompilerLib)
+    for i in range(AdaptiveMax if Adaptive else NumParallel):
+        threading.Thread(target=dispatcher, name='dispatcher-{0}'.format(i), daemon=True).start()
+    if daemon_args.socket:
+        if os.path.exists(daemon_args.socket):
+            os.remove(daemon_args.socket)
+        server = UnixHTTPServer(daemon_args.socket, Handler)
+        address = daemon_args.socket
+    else:
+        server = ThreadingHTTPServer((daemon_args.host, daemon_args.port), Handler)
+        address = '{0}:{1}'.format(daemon_args.host, daemon_args.port)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    printLog('daemon listening on {0}, run-type {1}, {2} parallel, log {3}'.format(address, RunType, NumParallel, logName))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        printLog('daemon: shutting down')
+    finally:
+        server.server_close()
+        shutdown_pools()
+        evict_cache()
+        result_sink.close()
+        logFile.close()
@@ -0,0 +1,270 @@
+import os
+import io
+import time
+import queue
+import tarfile
+import threading
+import requests
+from urllib import parse
+
+from const import *
+from public import *
+from util import add_result, hash_file, hash_tree, stage_durations
+from judge import prepare_testcase, add_testcase_error
+from timing import trace_span
+from logger import printLog
+
+# 分布式评测: 协调端 (本进程) 将测试点分发给多台机器上的 worker.py，每个 worker 使用自己的 docker 或 native 后端评测。
+# 协议 (HTTP):
+#   GET  /                    {"run-type": ..., "parallel": ...}，同时用于健康检查
+#   GET  /compiler/<digest>   编译器是否已上传 (200 / 404)
+#   PUT  /compiler/<digest>   上传编译器构建产物和依赖库 (tar.gz，含 build/ 和 lib/)
+#   GET  /file/<digest>       测试点文件是否已上传 (200 / 404)
+#   PUT  /file/<digest>       上传一个测试点文件 (.sy/.in/.out)，digest 为内容的 sha256
+#   POST /judge               评测一个测试点，请求为测试点文件的 digest 和编译选项，返回评测结果
+# 所有请求都须在 X-Judge-Token 头中带有与 worker 配置相同的 worker-token，否则返回 401。
+# 每个 worker 开启与其 parallel 相同数量的连接，从公共队列领取测试点，评测快的 worker 自然领取更多测试点。
+
+API_INFO        = '/'
+API_COMPILER    = '/compiler/'
+API_FILE        = '/file/'
+API_JUDGE       = '/judge'
+TOKEN_HEADER    = 'X-Judge-Token'
+
+CONNECT_TIMEOUT = 5
+HEALTH_TIMEOUT = 2
+HEALTH_INTERVAL = 5
+WORKER_RETRIES = 2              # worker 连接失败时，测试点交给其他 worker 重试的次数
+WORKER_UNAVAILABLE_SECS = 60    # 所有 worker 都不可用超过该时间后，剩余的测试点记为其他错误
+
+# 一个测试点在 worker 上最长的评测时间: 编译、链接、运行 (性能测试重复运行) 各自的超时之和，按超时最长的测试集计算
+def judge_timeout() -> int:
+    return max([TimeoutSecs] + list(SeriesTimeout.values())) * (2 + BenchmarkWarmup + BenchmarkRuns) + 60
+
+def worker_session() -> requests.Session:
+    session = requests.Session()
+    session.headers[TOKEN_HEADER] = WorkerToken
+    return session
+
+class Worker:
+    def __init__(self, address: str):
+        self.address = address
+        self.admitted = threading.Event()   # 健康检查通过后才会领取测试点
+        self.parallel = 0                   # 0 表示尚未连接过，连接成功后启动相应数量的评测线程
+        self.lock = threading.Lock()
+        self.shipped = set()                # 已上传的编译器
+        self.files = set()                  # 已上传的测试点文件
+        self.done = 0
+        self.busy = 0.0
+
+    def url(self, api: str) -> str:
+        return parse.urljoin(self.address, api)
+
+    def probe(self, session: requests.Session) -> dict:
+        try:
+            resp = session.get(url=self.url(API_INFO), timeout=HEALTH_TIMEOUT)
+            return resp.json() if resp.status_code == 200 else None
+        except (requests.RequestException, ValueError):
+            return None
+
+    def admit(self):
+        if not self.admitted.is_set():
+            printLog('worker {0} admitted'.format(self.address))
+            self.admitted.set()
+
+    def evict(self, reason: str):
+        if self.admitted.is_set():
+            printLog('worker {0} evicted: {1}'.format(self.address, reason))
+            self.admitted.clear()
+
+class WorkerJob:
+    def __init__(self, testcase: dict):
+        self.testcase = testcase
+        self.judge = None
+        self.attempts = 0
+
+workers = []
+worker_jobs = queue.Queue()     # 等待分配给 worker 的测试点
+
+# 编译器构建产物按 (构建目录, 依赖库目录) 打包一次，{key: (digest, tar.gz)}
+compiler_archives = {}
+compiler_archive_lock = threading.Lock()
+
+def compiler_archive(compiler: dict):
+    key = (compiler['compiler-build'], compiler['compiler-lib'])
+    with compiler_archive_lock:
+        if key not in compiler_archives:
+            hasher = hash_tree(compiler['compiler-build'])
+            if compiler['compiler-lib']:
+                hash_tree(compiler['compiler-lib'], hasher)
+            buf = io.BytesIO()
+            with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+                tar.add(compiler['compiler-build'], arcname='build')
+                if compiler['compiler-lib']:
+                    tar.add(compiler['compiler-lib'], arcname='lib')
+            compiler_archives[key] = (hasher.hexdigest(), buf.getvalue())
+            printLog('distributed: packed compiler {0} ({1} bytes)'.format(compiler['compiler-build'], len(buf.getvalue())))
+        return compiler_archives[key]
+
+def check_response(resp: requests.Response, action: str, ident: str):
+    if resp.status_code != 200:
+        raise Exception("Failed {0} {1} (code={2}): \n{3}".format(action, ident, resp.status_code, resp.text))
+
+# 每个 worker 只上传一次编译器
+def ship_compiler(session: requests.Session, worker: Worker, compiler: dict) -> str:
+    digest, archive = compiler_archive(compiler)
+    with worker.lock:
+        if digest not in worker.shipped:
+            resp = session.get(url=worker.url(API_COMPILER + digest), timeout=(CONNECT_TIMEOUT, HEALTH_TIMEOUT))
+            if resp.status_code != 200:
+                printLog('distributed: shipping compiler {0} to {1}'.format(digest[:12], worker.address))
+                resp = session.put(url=worker.url(API_COMPILER + digest), data=archive, timeout=(CONNECT_TIMEOUT, judge_timeout()))
+                check_response(resp, 'ship compiler to', worker.address)
+            worker.shipped.add(digest)
+    return digest
+
+# 测试点文件按内容 sha256 上传，每个 worker 只上传一次，上传时从文件流式读取，不整个读入内存
+def ship_file(session: requests.Session, worker: Worker, path: str) -> str:
+    if not os.path.exists(path):
+        return None
+    digest = hash_file(path).hexdigest()
+    with worker.lock:
+        if digest in worker.files:
+            return digest
+    resp = session.get(url=worker.url(API_FILE + digest), timeout=(CONNECT_TIMEOUT, HEALTH_TIMEOUT))
+    if resp.status_code != 200:
+        with open(path, 'rb') as fp:
+            resp = session.put(url=worker.url(API_FILE + digest), data=fp, timeout=(CONNECT_TIMEOUT, judge_timeout()))
+        check_response(resp, 'ship {0} to'.format(os.path.basename(path)), worker.address)
+    with worker.lock:
+        worker.files.add(digest)
+    return digest
+
+def judge_on_worker(session: requests.Session, worker: Worker, job: WorkerJob):
+    if job.judge is None:
+        job.judge = prepare_testcase(job.testcase)
+    judge = job.judge
+    compiler = judge['compiler']
+    payload = {
+        'series_name': judge['series_name'], 'case_name': judge['case_name'], 'variant': judge.get('variant', ''),
+        'compiler': ship_compiler(session, worker, compiler), 'opt-options': compiler['opt-options'], 'jvm-options': compiler['jvm-options'],
+        'sy': ship_file(session, worker, judge['file_src']), 'in': ship_file(session, worker, judge['file_in']),
+        'out': ship_file(session, worker, judge['file_ans']),
+    }
+    begin = time.monotonic()
+    with trace_span('remote', 'distributed', case=judge['case_fullname'], worker=worker.address):
+        resp = session.post(url=worker.url(API_JUDGE), json=payload, timeout=(CONNECT_TIMEOUT, judge_timeout()))
+    check_response(resp, 'judge', '{0} @ {1}'.format(judge['case_fullname'], worker.address))
+    result = resp.json()
+    result['worker'] = worker.address
+    add_result(judge['work_dir'], result, judge.get('variant', ''))
+    with worker.lock:
+        worker.done += 1
+        worker.busy += time.monotonic() - begin
+
+def fail_job(job: WorkerJob, comment: str):
+    judge = job.judge
+    if judge is None:
+        # 准备测试点时出错 (或尚未准备)，不再重新放入测试点文件，直接记录结果
+        printLog('Distributed error ({0}/{1}): {2}'.format(job.testcase['series_name'], job.testcase['case_name'], comment))
+        add_testcase_error(job.testcase, OTHER_ERROR, comment)
+        return
+    printLog('Distributed error ({0}): {1}'.format(judge['case_fullname'], comment))
+    add_result(judge['work_dir'], {
+        'series_name': judge['series_name'], 'case_name': judge['case_name'], 'verdict': OTHER_ERROR,
+        'comment': comment, 'perf': '', 'perf_time': None, 'stdin': '', 'stdout': '', 'answer': '', 'durations': stage_durations(judge)
+    }, judge.get('variant', ''))
+
+# 连接错误时将该 worker 移出并把测试点交给其他 worker 重试，其他错误记为其他错误。调用者之后须调用 worker_jobs.task_done()
+def handle_failure(worker: Worker, job: WorkerJob, e: Exception):
+    if isinstance(e, (requests.ConnectionError, requests.Timeout)):
+        worker.evict(str(e))
+        job.attempts += 1
+        if job.attempts <= WORKER_RETRIES:
+            printLog('Retry {0} on another worker ({1}/{2})'.format(job.testcase['case_name'], job.attempts, WORKER_RETRIES))
+            worker_jobs.put(job)
+            return
+    fail_job(job, str(e))
+
+def worker_thread(worker: Worker):
+    session = worker_session()
+    while True:
+        worker.admitted.wait()
+        job = worker_jobs.get()
+        if not worker.admitted.is_set():
+            worker_jobs.put(job)    # 等待期间被移出，测试点留给其他 worker
+            worker_jobs.task_done()
+            continue
+        try:
+            judge_on_worker(session, worker, job)
+        except Exception as e:
+            handle_failure(worker, job, e)
+        finally:
+            worker_jobs.task_done()
+
+# 检查 worker 是否可用: 评测类型必须与本次评测一致。首次连接成功时按其并发数启动评测线程
+def check_worker(session: requests.Session, worker: Worker):
+    info = worker.probe(session)
+    if info is None:
+        worker.evict('health check failed')
+        return
+    if info.get('run-type') != RunType:
+        worker.evict('run-type {0} does not match {1}'.format(info.get('run-type'), RunType))
+        return
+    if worker.parallel == 0:
+        worker.parallel = max(1, int(info.get('parallel', 1)))
+        for i in range(worker.parallel):
+            threading.Thread(target=worker_thread, args=(worker,), name='worker-{0}-{1}'.format(worker.address, i), daemon=True).start()
+        printLog('worker {0}: {1} parallel'.format(worker.address, worker.parallel))
+    worker.admit()
+
+# 定期检查所有 worker (包括已移出的)，恢复的重新加入；长时间没有可用的 worker 时放弃剩余的测试点
+def worker_monitor():
+    session = worker_session()
+    unavailable_since = None
+    while True:
+        time.sleep(HEALTH_INTERVAL)
+        for worker in workers:
+            check_worker(session, worker)
+        if any(worker.admitted.is_set() for worker in workers):
+            unavailable_since = None
+        elif unavailable_since is None:
+            unavailable_since = time.monotonic()
+        elif time.monotonic() - unavailable_since > WORKER_UNAVAILABLE_SECS:
+            while True:
+                try:
+                    job = worker_jobs.get_nowait()
+                except queue.Empty:
+                    break
+                fail_job(job, 'No available worker')
+                worker_jobs.task_done()
+
+def run_distributed(testcases: list):
+    if RunType in [TYPE_RPI, TYPE_RPI_ELF]:
+        raise Exception('distributed judging does not support run-type {0}'.format(RunType))
+    if len(RunTypes) > 1:
+        raise Exception('distributed judging does not support multiple run-types')
+    if not WorkerToken:
+        raise Exception('distributed judging requires worker-token')
+    session = worker_session()
+    for address in Workers:
+        worker = Worker(address)
+        check_worker(session, worker)
+        if not worker.admitted.is_set():
+            printLog('Invalid worker address: {0}'.format(address))  # 之后由健康检查重新加入
+        workers.append(worker)
+    threading.Thread(target=worker_monitor, name='worker-monitor', daemon=True).start()
+    for testcase in testcases:
+        worker_jobs.put(WorkerJob(testcase))
+    worker_jobs.join()
+
+def worker_parallel() -> int:
+    return sum(worker.parallel for worker in workers)
+
+# 各 worker 完成的测试点数量和吞吐量
+def distributed_summary(wall_time: float) -> str:
+    lines = []
+    for worker in workers:
+        rate = worker.done / wall_time if wall_time > 0 else 0.0
+        lines.append('Worker {0}: {1} testcases, {2:.2f} testcases/s, {3} parallel.'.format(worker.address, worker.done, rate, worker.parallel))
+    return '\n'.join(lines)
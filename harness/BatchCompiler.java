@@ -0,0 +1,126 @@
+import java.io.File;
+import java.io.FileOutputStream;
+import java.io.PrintStream;
+import java.io.PrintWriter;
+import java.lang.reflect.InvocationTargetException;
+import java.lang.reflect.Method;
+import java.net.URL;
+import java.net.URLClassLoader;
+import java.nio.charset.StandardCharsets;
+import java.nio.file.Files;
+import java.nio.file.Paths;
+import java.security.Permission;
+import java.util.ArrayList;
+import java.util.Arrays;
+import java.util.List;
+
+/**
+ * 批量编译: 在同一个 JVM 中依次对多个 .sy 文件调用 Compiler.main
+ *
+ * 用法: java -Djava.security.manager=allow -cp harness BatchCompiler list result timeout isolate classpath
+ *   list     任务列表, 每行一个任务: name \t compile.log \t arg1 \t arg2 ...
+ *   result   每完成一个任务追加一行: name \t status \t millis
+ *   timeout  单个任务的超时时间 (秒), 超时后整个批次退出, 未完成的任务由评测机逐个重新编译
+ *   isolate  为 true 时每个任务使用独立的 ClassLoader (静态变量不会在任务之间残留)
+ */
+public class BatchCompiler {
+    static final int STATUS_TIMEOUT = 124;
+
+    static class ExitTrap extends SecurityException {
+        final int status;
+
+        ExitTrap(int status) {
+            super("System.exit(" + status + ")");
+            this.status = status;
+        }
+    }
+
+    static volatile boolean trapExit = true;
+
+    public static void main(String[] argv) throws Exception {
+        List<String> jobs = Files.readAllLines(Paths.get(argv[0]), StandardCharsets.UTF_8);
+        long timeout = Long.parseLong(argv[2]);
+        boolean isolate = Boolean.parseBoolean(argv[3]);
+        List<URL> urls = new ArrayList<>();
+        for (String path : argv[4].split(":")) {
+            if (!path.isEmpty()) {
+                urls.add(new File(path).toURI().toURL());
+            }
+        }
+        ClassLoader parent = BatchCompiler.class.getClassLoader().getParent();
+        ClassLoader shared = isolate ? null : new URLClassLoader(urls.toArray(new URL[0]), parent);
+        // 拦截学生编译器中的 System.exit, 将其转换为任务的退出码
+        System.setSecurityManager(new SecurityManager() {
+            @Override
+            public void checkPermission(Permission perm) {
+            }
+
+            @Override
+            public void checkPermission(Permission perm, Object context) {
+            }
+
+            @Override
+            public void checkExit(int status) {
+                if (trapExit) {
+                    throw new ExitTrap(status);
+                }
+            }
+        });
+        PrintStream err = System.err;
+        try (PrintWriter result = new PrintWriter(new FileOutputStream(argv[1], true), true)) {
+            for (String line : jobs) {
+                if (line.isEmpty()) {
+                    continue;
+                }
+                String[] fields = line.split("\t");
+                String[] args = Arrays.copyOfRange(fields, 2, fields.length);
+                ClassLoader loader = isolate ? new URLClassLoader(urls.toArray(new URL[0]), parent) : shared;
+                long begin = System.nanoTime();
+                int status;
+                try (PrintStream log = new PrintStream(new FileOutputStream(fields[1]), true)) {
+                    System.setErr(log);
+                    status = runOne(loader, args, timeout);
+                } finally {
+                    System.setErr(err);
+                }
+                long millis = (System.nanoTime() - begin) / 1000000;
+                result.println(fields[0] + "\t" + status + "\t" + millis);
+                if (status == STATUS_TIMEOUT) {
+                    trapExit = false;
+                    Runtime.getRuntime().halt(STATUS_TIMEOUT);
+                }
+            }
+        }
+        trapExit = false;
+        Runtime.getRuntime().halt(0);
+    }
+
+    static int runOne(ClassLoader loader, String[] args, long timeout) throws InterruptedException {
+        int[] status = {0};
+        Thread thread = new Thread(() -> {
+            try {
+                Method main = Class.forName("Compiler", true, loader).getMethod("main", String[].class);
+                main.invoke(null, (Object) args);
+            } catch (InvocationTargetException e) {
+                status[0] = exitStatus(e.getCause());
+            } catch (Throwable e) {
+                status[0] = exitStatus(e);
+            }
+        }, "compile");
+        thread.setContextClassLoader(loader);
+        thread.start();
+        thread.join(timeout * 1000);
+        if (thread.isAlive()) {
+            return STATUS_TIMEOUT;
+        }
+        return status[0];
+    }
+
+    static int exitStatus(Throwable e) {
+        if (e instanceof ExitTrap) {
+            return ((ExitTrap) e).status;
+        }
+        e.printStackTrace();    // 与 JVM 对未捕获异常的处理一致: 打印栈并以 1 退出
+        return 1;
+    }
+}
@@ -1,30 +1,171 @@
-import os, stat, shutil
+import os, stat, time, json, shutil, queue, tarfile
 
 from const import *
 from tasks import *
-from util import answer_check, add_result
+from util import answer_check, add_result, read_excerpt, read_perf_time, bench_stats, begin_stage, end_stage, stage_durations, target_label, link_or_copy, hash_file, \
+    format_size, parse_size
 from public import *
 from rpi import submit_to_rpi
+from adaptive import limiter
+from appcds import cds_archive
+from cache import compile_key, elf_key, cache_fetch, cache_store
+from timing import trace_span, trace_event
 from logger import printLog
 
-judge_type = RunType
-
 remove_elf_after_run = True
 
-# testcase: {series_name, case_name, file_src, file_in, file_ans}
-# judge_context: {series_name, case_name, work_dir, out_dir, work_dir_host, out_dir_host, 
-#   file_src, file_src_host, file_in, file_in_host, file_ans, file_out, file_perf}
-def test_one_case(testcase: dict):
-    global judge_type
+# 容器池只能访问评测记录目录下的文件，此时直接挂载原文件退化为链接
+staging = 'link' if Staging == 'bind' and UseContainerPool else Staging
+# 非 copy 模式下编译和运行的输出直接使用 output 目录中的文件，不再复制到用例目录
+outputs_in_place = staging != 'copy'
+
+# 性能测试的运行槽位: 每个槽位对应一组独占的 CPU (cpuset-cpus)，槽位数量即性能测试运行的并发上限
+bench_slots = queue.Queue()
+for cpuset in (CpusetCpus or [None] * BenchmarkParallel):
+    bench_slots.put(cpuset)
+
+def is_benchmark(judge: dict) -> bool:
+    return judge['series_name'] in BenchmarkSeries and judge['target'] in [TYPE_LLVM, TYPE_QEMU_ARM, TYPE_QEMU_RISCV]
+
+# 运行目标程序，性能测试用例在独占的槽位上重复运行 (预热 + 计时)。返回资源使用
+def run_target(judge: dict, code_path_host: str) -> dict:
+    if not is_benchmark(judge):
+        return run_testcase(DockerClient, judge['case_fullname'], code_path_host, judge['file_in_host'], judge['out_dir_host'], judge['target'],
+            timeout=judge['timeout'], output_limit=judge['output_limit'])
+    judge['bench_repeat'] = BenchmarkWarmup + BenchmarkRuns
+    cpuset = bench_slots.get()
+    try:
+        return run_testcase(DockerClient, judge['case_fullname'], code_path_host, judge['file_in_host'], judge['out_dir_host'], judge['target'],
+            repeat=judge['bench_repeat'], cpuset=cpuset, timeout=judge['timeout'], output_limit=judge['output_limit'])
+    finally:
+        bench_slots.put(cpuset)
+
+# 检查每一次运行的输出，统计预热之后各次运行的计时. (correct, comment, bench, 不一致的输出文件)
+def check_benchmark(judge: dict):
+    times = []
+    for i in range(1, judge['bench_repeat'] + 1):
+        file_out = os.path.join(judge['out_dir'], 'output_{0}.txt'.format(i))
+        correct, comment = answer_check(judge['file_ans'], file_out)
+        if not correct:
+            return False, 'Run {0}: {1}'.format(i, comment), None, file_out
+        if i > BenchmarkWarmup:
+            times.append(read_perf_time(os.path.join(judge['out_dir'], 'perf_{0}.txt'.format(i))))
+    return True, 'Correct! ({0} runs)'.format(BenchmarkRuns), bench_stats(times), judge['file_out']
+
+# 各评测类型对应的编译类型
+compile_types = {
+    TYPE_LLVM: 'llvm',
+    TYPE_QEMU_ARM: 'arm',
+    TYPE_RPI: 'arm',
+    TYPE_RPI_ELF: 'arm',
+    TYPE_QEMU_RISCV: 'riscv',
+}
+
+# 一组评测类型所需的编译类型: 同时需要 LLVM IR 和汇编时由一次编译同时生成 ('all')，没有需要编译的评测类型 (只有解释执行) 时为 None。
+# qemu-arm 与 qemu-riscv 的编译命令相同，只编译一次
+def compile_type(targets: list) -> str:
+    types = sorted({compile_types[t] for t in targets if t in compile_types})
+    if len(types) == 0:
+        return None
+    if 'llvm' in types and len(types) > 1:
+        return 'all'
+    return types[0]
+
+# 编译阶段写入 output 目录的文件，用于产物缓存 {文件名: 路径}
+def compile_outputs(judge: dict, type: str) -> dict:
+    names = ['compile.log']
+    if type in ['llvm', 'all'] or EmitLLVM:
+        names.append('test.ll')
+    if type != 'llvm':
+        names.append('test.S')
+    return {name: os.path.join(judge['out_dir'], name) for name in names}
+
+# 生成 ELF，汇编代码未改变时直接使用缓存的 ELF
+def genelf_cached(judge: dict, arch: str):
+    key = elf_key(judge['file_asm'], arch)
+    files = {'test.elf': judge['file_elf'], 'genelf.log': os.path.join(judge['out_dir'], 'genelf.log')}
+    if cache_fetch('elf', key, files):
+        printLog('{0} - elf cache hit.'.format(judge['case_fullname']))
+        return
+    record_usage(judge, 'genelf', genelf_testcase(DockerClient, judge['case_fullname'], judge['file_asm_host'], judge['file_elf_host'], judge['out_dir_host'], arch,
+        timeout=judge['timeout']))
+    cache_store('elf', key, files)
+
+# 各任务的资源使用记录在 judge['resources']，并将内存峰值提供给自适应并发
+def record_usage(judge: dict, task: str, usage: dict):
+    if usage is None:
+        return
+    judge.setdefault('resources', {})[task] = usage
+    if limiter is not None and usage['peak_rss']:
+        limiter.observe(task, usage['peak_rss'])
+
+# 任务因内存不足被杀死时记录 MEMORY_LIMIT 评测结果 (附观察到的内存峰值) 并返回 True。
+# e 为任务失败时抛出的异常 (TaskFailed 带有资源使用)，任务成功时为 None (例如运行脚本捕获了被杀死的程序的退出码)
+def memory_limit_exceeded(judge: dict, task: str, e: Exception=None) -> bool:
+    if e is not None:
+        record_usage(judge, task, getattr(e, 'usage', None))
+    usage = judge.get('resources', {}).get(task)
+    if usage is None or not usage['oom_killed']:
+        return False
+    comment = '{0}: memory limit exceeded (peak {1} of {2})'.format(task, '?' if usage['peak_rss'] is None else format_size(usage['peak_rss']), MemoryLimit)
+    printLog('Memory limit exceeded ({0}): {1}'.format(judge['case_fullname'], comment))
+    add_error_result(judge, MEMORY_LIMIT, comment)
+    return True
+
+# 程序输出超出限制被终止时记录 OUTPUT_LIMIT 评测结果 (附终止前写入的字节数) 并返回 True。
+# 程序被 SIGPIPE 终止后退出码非零，解释执行时任务本身失败，因此在异常处理中同样需要检查
+def output_limit_exceeded(judge: dict, task: str) -> bool:
+    path = os.path.join(judge['out_dir'], OutputLimitFile)
+    if not os.path.exists(path):
+        return False
+    with open(path, 'r') as fp:
+        written = fp.read().strip() or '?'
+    comment = '{0}: output limit exceeded ({1} bytes written before termination, limit {2} bytes)'.format(task, written, judge['output_limit'])
+    printLog('Output limit exceeded ({0}): {1}'.format(judge['case_fullname'], comment))
+    add_error_result(judge, OUTPUT_LIMIT, comment)
+    return True
+
+# 测试点的输出大小上限 (字节): output-limit 与答案大小的 output-limit-ratio 倍中较小的一个，0 表示不限制
+def output_limit(file_ans: str) -> int:
+    limits = [parse_size(OutputLimit)]
+    if OutputLimitRatio > 0 and os.path.exists(file_ans):
+        limits.append(max(int(os.path.getsize(file_ans) * OutputLimitRatio), parse_size(OutputLimitMin)))
+    limits = [limit for limit in limits if limit > 0]
+    return min(limits) if len(limits) > 0 else 0
+
+# 测试点清单中记录的源程序哈希，用作编译缓存的键时无需重新哈希
+def source_digest(judge: dict) -> str:
+    return judge.get('testcase', {}).get('hashes', {}).get('.sy')
+
+# 测试点文件的哈希，测试点文件没有保存在评测记录中时供 --changed-since 比较 (优先使用测试点清单中的哈希)
+def write_testcase_digest(judge: dict, testcase: dict):
+    digest = dict(testcase.get('hashes', {}))
+    for key, ext in [('file_src', '.sy'), ('file_in', '.in'), ('file_ans', '.out')]:
+        if 'hashes' not in testcase and os.path.exists(testcase[key]):
+            digest[ext] = hash_file(testcase[key]).hexdigest()
+    with open(os.path.join(judge['work_dir'], 'testcase.json'), 'w') as fp:
+        json.dump(digest, fp=fp)
+
+# 解析测试点的目录和文件名，并将测试点文件放入评测记录目录 (复制、链接，或直接使用原文件)
+def prepare_testcase(testcase: dict) -> dict:
+    if 'staged' in testcase:
+        return variant_judge(testcase['staged'], testcase['variant'])
     judge = dict()
+    judge['compiler'] = DefaultVariant
     series_name, case_name = judge['series_name'], judge['case_name'] = testcase['series_name'], testcase['case_name']
-    judge['case_fullname'] = os.path.join(testcase['series_name'], testcase['case_name'])
-    printLog('{0} start.'.format(judge['case_fullname']))
+    # 守护进程模式下每次提交的评测记录在以提交编号命名的子目录中，同一用例可以同时在多个提交中评测
+    subdir = testcase.get('log_subdir', '')
+    judge['case_fullname'] = os.path.join(subdir, testcase['series_name'], testcase['case_name'])
+    # 多个评测类型时 target 在编译之后由 fan_out 为每个评测类型分别设置
+    judge['targets'] = RunTypes
+    judge['target'] = RunTypes[0] if len(RunTypes) == 1 else None
+    judge['timeout'] = SeriesTimeout.get(series_name, TimeoutSecs)
+    judge['output_limit'] = output_limit(testcase['file_ans'])
     # Resolve dir and filenames
-    judge['work_dir'] = os.path.join(logDir, series_name, case_name)
+    judge['work_dir'] = os.path.join(logDir, subdir, series_name, case_name)
     judge['out_dir'] = os.path.join(judge['work_dir'], 'output')
     # dirs on host (pass to docker -v)
-    judge['work_dir_host'] = os.path.join(logDirHost, series_name, case_name)
+    judge['work_dir_host'] = os.path.join(logDirHost, subdir, series_name, case_name)
     judge['out_dir_host'] = os.path.join(judge['work_dir_host'], 'output')
     os.makedirs(judge['work_dir'], mode=0o755, exist_ok=True)
     judge['file_src']       = os.path.join(judge['work_dir'], case_name + '.sy')
@@ -34,118 +175,313 @@ def test_one_case(testcase: dict):
     judge['file_ans']       = os.path.join(judge['work_dir'], case_name + '.out')
     judge['file_out']       = os.path.join(judge['work_dir'], 'output.txt')
     judge['file_perf']      = os.path.join(judge['work_dir'], 'perf.txt')
+    if outputs_in_place:
+        judge['file_out']   = os.path.join(judge['out_dir'], 'output.txt')
+        judge['file_perf']  = os.path.join(judge['out_dir'], 'perf.txt')
 
     # Prepare given files
-    shutil.copy(testcase['file_src'], judge['file_src'])
-    if not os.path.exists(testcase['file_in']):
-        open(judge['file_in'], 'w').close() # create an empty file
-    else:
-        shutil.copy(testcase['file_in'], judge['file_in'])
-    shutil.copy(testcase['file_ans'], judge['file_ans'])
-    # Compile Testcase
-    if judge_type == TYPE_INTERPRET:
-        try:
-            run_interpreter(DockerClient, judge['case_fullname'], CompilerBuild, judge['file_src_host'], judge['file_in_host'], judge['out_dir_host'])
-            shutil.copy(os.path.join(judge['out_dir'], 'output.txt'), judge['file_out'])
-            shutil.copy(os.path.join(judge['out_dir'], 'perf.txt'), judge['file_perf'])
-        except Exception as e:
-            verdict = RUNTIME_ERROR
-            comment = str(e)
-            printLog('Interpret Error({0}): {1}'.format(judge['case_fullname'], comment))
-            add_result(judge['work_dir'], {
-                'series_name': series_name, 'case_name': case_name, 'verdict': verdict, 
-                'comment': comment, 'perf': '', 'stdin': '', 'stdout': '', 'answer': ''
-            })
-            return
-    else:
-        try:
-            if judge_type == TYPE_LLVM:
-                compile_testcase(DockerClient, judge['case_fullname'], CompilerBuild, judge['file_src_host'], judge['out_dir_host'], lib_path=CompilerLib, type='llvm')
-            elif judge_type == TYPE_QEMU_ARM or judge_type == TYPE_RPI or judge_type == TYPE_RPI_ELF:
-                compile_testcase(DockerClient, judge['case_fullname'], CompilerBuild, judge['file_src_host'], judge['out_dir_host'], lib_path=CompilerLib, type='arm')
-            elif judge_type == TYPE_QEMU_RISCV:
-                compile_testcase(DockerClient, judge['case_fullname'], CompilerBuild, judge['file_src_host'], judge['out_dir_host'], lib_path=CompilerLib, type='riscv')
+    with trace_span('prepare', 'judge', case=judge['case_fullname']):
+        if staging == 'copy':
+            shutil.copy(testcase['file_src'], judge['file_src'])
+        else:
+            link_or_copy(testcase['file_src'], judge['file_src'])
+        if not os.path.exists(testcase['file_in']):
+            open(judge['file_in'], 'w').close() # create an empty file
+        elif staging == 'bind':
+            # 较大的输入和答案直接以只读方式挂载原文件
+            judge['file_in'] = testcase['file_in']
+            judge['file_in_host'] = os.path.join(TestcaseBaseHost, os.path.relpath(testcase['file_in'], os.path.realpath(TestcaseBaseDir)))
+        elif staging == 'link':
+            link_or_copy(testcase['file_in'], judge['file_in'])
+        else:
+            shutil.copy(testcase['file_in'], judge['file_in'])
+        if staging == 'bind':
+            judge['file_ans'] = testcase['file_ans']
+        elif staging == 'link':
+            link_or_copy(testcase['file_ans'], judge['file_ans'])
+        else:
+            shutil.copy(testcase['file_ans'], judge['file_ans'])
+        # 挂载的原文件和硬链接会随测试点原地修改，评测记录中的文件不能代表评测时的内容，记录哈希供 --changed-since 比较
+        if staging != 'copy':
+            write_testcase_digest(judge, testcase)
+    judge['testcase'] = testcase
+    return judge
+
+# 变体共用已放入评测记录的测试点文件，编译和运行的输出在用例目录下以变体名称命名的子目录中
+def variant_judge(staged: dict, variant: dict) -> dict:
+    judge = {key: value for key, value in staged.items() if key not in ['durations', 'stage_begin', 'resources']}
+    name = judge['variant'] = variant['name']
+    judge['compiler'] = variant
+    judge['case_fullname'] = os.path.join(staged['case_fullname'], name)
+    judge['work_dir'] = os.path.join(staged['work_dir'], name)
+    judge['out_dir'] = os.path.join(judge['work_dir'], 'output')
+    judge['work_dir_host'] = os.path.join(staged['work_dir_host'], name)
+    judge['out_dir_host'] = os.path.join(judge['work_dir_host'], 'output')
+    os.makedirs(judge['work_dir'], mode=0o755, exist_ok=True)
+    # 编译阶段只创建了共用的输出目录；树莓派评测类型不经过挂载，由这里创建各评测类型的输出目录
+    os.makedirs(judge['out_dir'], exist_ok=True)
+    judge['file_out'] = os.path.join(judge['out_dir'] if outputs_in_place else judge['work_dir'], 'output.txt')
+    judge['file_perf'] = os.path.join(judge['out_dir'] if outputs_in_place else judge['work_dir'], 'perf.txt')
+    return judge
+
+# 多个评测类型时，编译之后每个评测类型一个评测上下文，共用编译产物，链接和运行的输出在用例目录下以评测类型命名的子目录中。
+# 编译的耗时和资源使用只计入第一个评测类型的结果
+def target_judge(judge: dict, target: str, first: bool) -> dict:
+    judge = {key: value for key, value in judge.items() if key != 'stage_begin' and (first or key not in ['durations', 'resources'])}
+    for key in ['durations', 'resources']:
+        if key in judge:
+            judge[key] = dict(judge[key])
+    judge['target'] = target
+    judge['case_fullname'] = os.path.join(judge['case_fullname'], target)
+    judge['work_dir'] = os.path.join(judge['work_dir'], target)
+    judge['out_dir'] = os.path.join(judge['work_dir'], 'output')
+    judge['work_dir_host'] = os.path.join(judge['work_dir_host'], target)
+    judge['out_dir_host'] = os.path.join(judge['work_dir_host'], 'output')
+    os.makedirs(judge['work_dir'], mode=0o755, exist_ok=True)
+    # 编译阶段只创建了共用的输出目录；树莓派评测类型不经过挂载，由这里创建各评测类型的输出目录
+    os.makedirs(judge['out_dir'], exist_ok=True)
+    judge['file_out'] = os.path.join(judge['out_dir'] if outputs_in_place else judge['work_dir'], 'output.txt')
+    judge['file_perf'] = os.path.join(judge['out_dir'] if outputs_in_place else judge['work_dir'], 'perf.txt')
+    return judge
+
+def fan_out(judge: dict) -> list:
+    if judge['target'] is not None:
+        return [judge]
+    return [target_judge(judge, target, i == 0) for i, target in enumerate(judge['targets'])]
+
+# 通过的用例只保留结果 (keep-artifacts 为 failed)，或将其余文件打包为 artifacts.tar.gz (compress)
+def prune_artifacts(judge: dict):
+    if KeepArtifacts not in ['failed', 'compress']:
+        return
+    if not os.path.exists(os.path.join(judge['work_dir'], 'testcase.json')):
+        write_testcase_digest(judge, judge['testcase'])
+    keep = ['result.json', 'testcase.json']
+    names = [name for name in os.listdir(judge['work_dir']) if name not in keep]
+    if KeepArtifacts == 'compress':
+        with tarfile.open(os.path.join(judge['work_dir'], 'artifacts.tar.gz'), 'w:gz') as tar:
+            for name in names:
+                tar.add(os.path.join(judge['work_dir'], name), arcname=name)
+    for name in names:
+        path = os.path.join(judge['work_dir'], name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+# 多个评测类型在编译之前 (或编译时) 出错时，每个评测类型记录一条结果
+def add_error_result(judge: dict, verdict: str, comment: str):
+    if judge['target'] is None:
+        end_stage(judge)
+        for target in fan_out(judge):
+            add_error_result(target, verdict, comment)
+        return
+    add_result(judge['work_dir'], {
+        'series_name': judge['series_name'], 'case_name': judge['case_name'], 'verdict': verdict, 
+        'comment': comment, 'perf': '', 'perf_time': None, 'stdin': '', 'stdout': '', 'answer': '', 'durations': stage_durations(judge),
+        'resources': judge.get('resources', {})
+    }, judge.get('variant', ''), target_label(judge))
+
+# 准备测试点失败 (如复制测试点文件出错) 时没有评测上下文，按测试点记录结果 (多个评测类型时每个评测类型一条)，使结果数量与预期一致
+def add_testcase_error(testcase: dict, verdict: str, comment: str):
+    work_dir = os.path.join(logDir, testcase.get('log_subdir', ''), testcase['series_name'], testcase['case_name'])
+    variant = testcase['variant']['name'] if 'variant' in testcase else ''
+    if variant:
+        work_dir = os.path.join(work_dir, variant)
+    for target in RunTypes:
+        label = target if len(RunTypes) > 1 else ''
+        os.makedirs(os.path.join(work_dir, label), exist_ok=True)
+        add_result(os.path.join(work_dir, label), {
+            'series_name': testcase['series_name'], 'case_name': testcase['case_name'], 'verdict': verdict,
+            'comment': comment, 'perf': '', 'perf_time': None, 'stdin': '', 'stdout': '', 'answer': ''
+        }, variant, label)
+
+# 准备测试点，出错时为其记录其他错误并返回 None
+def prepare_or_record(testcase: dict) -> dict:
+    try:
+        return prepare_testcase(testcase)
+    except Exception as e:
+        comment = 'prepare: {0}'.format(str(e))
+        printLog('Prepare error ({0}/{1}): {2}'.format(testcase['series_name'], testcase['case_name'], comment))
+        add_testcase_error(testcase, OTHER_ERROR, comment)
+        return None
+
+# 评测分为编译、链接 (生成 ELF)、运行、检查答案四个阶段。
+# 每个阶段返回 True 表示进入下一阶段，返回 False 表示评测结果已经记录 (或已提交给树莓派异步评测)。
+# 多个评测类型时只编译一次，之后的阶段对 fan_out 得到的每个评测类型分别执行。
+
+def stage_compile(judge: dict) -> bool:
+    unsupported = [t for t in judge['targets'] if t not in compile_types and t != TYPE_INTERPRET]
+    if len(unsupported) > 0:
+        printLog('Not Supported Judge Type: {0}'.format(', '.join(unsupported)))
+        return False
+    type = compile_type(judge['targets'])
+    if type is None:
+        return True     # 解释执行在运行阶段完成
+    case_name = judge['case_name']
+    try:
+        precompiled = judge.get('precompiled')
+        if precompiled is None:
+            os.makedirs(judge['out_dir'], exist_ok=True)
+            compiler = judge['compiler']
+            key = compile_key(judge['file_src'], type, compiler, source_digest(judge))
+            if cache_fetch('compile', key, compile_outputs(judge, type)):
+                printLog('{0} - compile cache hit.'.format(judge['case_fullname']))
             else:
-                printLog('Not Supported Judge Type: {0}'.format(judge_type))
-                return
-        except Exception as e:
-            verdict = COMPILE_ERROR
-            comment = str(e)
-            printLog('Compile error ({0}): {1}'.format(judge['case_fullname'], comment))
-            add_result(judge['work_dir'], {
-                'series_name': series_name, 'case_name': case_name, 'verdict': verdict, 
-                'comment': comment, 'perf': '', 'stdin': '', 'stdout': '', 'answer': ''
-            })
-            return
-        # Get compiled target of testcase
-        if judge_type == TYPE_LLVM:
+                record_usage(judge, 'compile', compile_testcase(DockerClient, judge['case_fullname'], compiler['compiler-build'], judge['file_src_host'], judge['out_dir_host'],
+                    lib_path=compiler['compiler-lib'], type=type, jvm_options=compiler['jvm-options'], opt_options=compiler['opt-options'], cds=cds_archive(compiler),
+                    timeout=judge['timeout']))
+                cache_store('compile', key, compile_outputs(judge, type))
+        elif precompiled['status'] != 0:
+            raise Exception('compile: batch exit with code {0}'.format(precompiled['status']))
+    except Exception as e:
+        if memory_limit_exceeded(judge, 'compile', e):
+            return False
+        comment = str(e)
+        printLog('Compile error ({0}): {1}'.format(judge['case_fullname'], comment))
+        add_error_result(judge, COMPILE_ERROR, comment)
+        return False
+    # Get compiled target of testcase
+    if outputs_in_place:
+        if type in ['llvm', 'all']:
+            judge['file_ll'] = os.path.join(judge['out_dir'], 'test.ll')
+            judge['file_ll_host'] = os.path.join(judge['out_dir_host'], 'test.ll')
+        if type != 'llvm':
+            judge['file_asm'] = os.path.join(judge['out_dir'], 'test.S')
+            judge['file_asm_host'] = os.path.join(judge['out_dir_host'], 'test.S')
+    else:
+        if type in ['llvm', 'all']:
             judge['file_ll'] = os.path.join(judge['work_dir'], case_name + '.ll') # LLVM
             judge['file_ll_host'] = os.path.join(judge['work_dir_host'], case_name + '.ll')
             shutil.copy(os.path.join(judge['out_dir'], 'test.ll'), judge['file_ll'])
-        else:
+        if type != 'llvm':
             judge['file_asm'] = os.path.join(judge['work_dir'], case_name + '.S') # ARM
             judge['file_asm_host'] = os.path.join(judge['work_dir_host'], case_name + '.S')
             shutil.copy(os.path.join(judge['out_dir'], 'test.S'), judge['file_asm'])
-        printLog('{0} compiled.'.format(judge['case_fullname']))
-        # Run target code
+    printLog('{0} compiled.'.format(judge['case_fullname']))
+    return True
+
+def stage_link(judge: dict) -> bool:
+    target = judge['target']
+    if target not in [TYPE_QEMU_ARM, TYPE_QEMU_RISCV, TYPE_RPI_ELF]:
+        return True
+    case_name = judge['case_name']
+    try:
+        judge['file_elf'] = os.path.join(judge['work_dir'], case_name + '.elf')
+        judge['file_elf_host'] = os.path.join(judge['work_dir_host'], case_name + '.elf')
+        open(judge['file_elf'], 'w').close()    # create an empty elf
+        genelf_cached(judge, 'arm' if target == TYPE_RPI_ELF else target.split('-')[1])
+        os.chmod(judge['file_elf'], os.stat(judge['file_elf']).st_mode | stat.S_IEXEC)
+    except Exception as e:
+        if memory_limit_exceeded(judge, 'genelf', e):
+            return False
+        comment = str(e)
+        printLog('Runtime error ({0}): {1}'.format(judge['case_fullname'], comment))
+        add_error_result(judge, RUNTIME_ERROR, comment)
+        return False
+    return True
+
+def copy_run_outputs(judge: dict):
+    if not outputs_in_place:
+        shutil.copy(os.path.join(judge['out_dir'], 'output.txt'), judge['file_out'])
+        shutil.copy(os.path.join(judge['out_dir'], 'perf.txt'), judge['file_perf'])
+
+def stage_run(judge: dict) -> bool:
+    target = judge['target']
+    if target == TYPE_INTERPRET:
         try:
-            if judge_type == TYPE_LLVM:
-                run_testcase(DockerClient, judge['case_fullname'], judge['file_ll_host'], judge['file_in_host'], judge['out_dir_host'], 'llvm')
-                shutil.copy(os.path.join(judge['out_dir'], 'output.txt'), judge['file_out'])
-                shutil.copy(os.path.join(judge['out_dir'], 'perf.txt'), judge['file_perf'])
-            elif judge_type == TYPE_QEMU_ARM or judge_type == TYPE_QEMU_RISCV:
-                judge['file_elf'] = os.path.join(judge['work_dir'], case_name + '.elf')
-                judge['file_elf_host'] = os.path.join(judge['work_dir_host'], case_name + '.elf')
-                open(judge['file_elf'], 'w').close()    # create an empty elf
-                genelf_testcase(DockerClient, judge['case_fullname'], judge['file_asm_host'], judge['file_elf_host'], judge['out_dir_host'], judge_type.split('-')[1])
-                os.chmod(judge['file_elf'], os.stat(judge['file_elf']).st_mode | stat.S_IEXEC)
-                run_testcase(DockerClient, judge['case_fullname'], judge['file_elf_host'], judge['file_in_host'], judge['out_dir_host'], judge_type)
-                shutil.copy(os.path.join(judge['out_dir'], 'output.txt'), judge['file_out'])
-                shutil.copy(os.path.join(judge['out_dir'], 'perf.txt'), judge['file_perf'])
-            elif judge_type == TYPE_RPI:
-                submit_to_rpi(judge, read_out_and_check)
-                return  # get result is async
-            elif judge_type == TYPE_RPI_ELF:
-                judge['file_elf'] = os.path.join(judge['work_dir'], case_name + '.elf')
-                judge['file_elf_host'] = os.path.join(judge['work_dir_host'], case_name + '.elf')
-                open(judge['file_elf'], 'w').close()    # create an empty elf
-                genelf_testcase(DockerClient, judge['case_fullname'], judge['file_asm_host'], judge['file_elf_host'], judge['out_dir_host'])
-                submit_to_rpi(judge, read_out_and_check)
-                return
-            else:
-                printLog('Not Supported Judge Type: {0}'.format(judge_type))
-                return
+            compiler = judge['compiler']
+            record_usage(judge, 'interpret', run_interpreter(DockerClient, judge['case_fullname'], compiler['compiler-build'], judge['file_src_host'], judge['file_in_host'],
+                judge['out_dir_host'], lib_path=compiler['compiler-lib'], jvm_options=compiler['jvm-options'], opt_options=compiler['opt-options'], cds=cds_archive(compiler),
+                timeout=judge['timeout'], output_limit=judge['output_limit']))
+            copy_run_outputs(judge)
         except Exception as e:
-            verdict = RUNTIME_ERROR
+            if memory_limit_exceeded(judge, 'interpret', e) or output_limit_exceeded(judge, 'interpret'):
+                return False
             comment = str(e)
-            printLog('Runtime error ({0}): {1}'.format(judge['case_fullname'], comment))
-            add_result(judge['work_dir'], {
-                'series_name': series_name, 'case_name': case_name, 'verdict': verdict, 
-                'comment': comment, 'perf': '', 'stdin': '', 'stdout': '', 'answer': ''})
-            return
-        read_out_and_check(judge)
+            printLog('Interpret Error({0}): {1}'.format(judge['case_fullname'], comment))
+            add_error_result(judge, RUNTIME_ERROR, comment)
+            return False
+        return not (memory_limit_exceeded(judge, 'interpret') or output_limit_exceeded(judge, 'interpret'))
+    # Run target code
+    try:
+        if target == TYPE_LLVM:
+            record_usage(judge, 'run', run_target(judge, judge['file_ll_host']))
+            copy_run_outputs(judge)
+        elif target == TYPE_QEMU_ARM or target == TYPE_QEMU_RISCV:
+            record_usage(judge, 'run', run_target(judge, judge['file_elf_host']))
+            copy_run_outputs(judge)
+        elif target == TYPE_RPI or target == TYPE_RPI_ELF:
+            submit_to_rpi(judge, read_out_and_check)
+            return False  # get result is async
+        else:
+            printLog('Not Supported Judge Type: {0}'.format(target))
+            return False
+    except Exception as e:
+        if memory_limit_exceeded(judge, 'run', e) or output_limit_exceeded(judge, 'run'):
+            return False
+        comment = str(e)
+        printLog('Runtime error ({0}): {1}'.format(judge['case_fullname'], comment))
+        add_error_result(judge, RUNTIME_ERROR, comment)
+        return False
+    # 运行脚本记录了程序的退出码，程序被杀死 (或因输出超出限制被终止) 时容器本身正常结束
+    return not (memory_limit_exceeded(judge, 'run') or output_limit_exceeded(judge, 'run'))
+
+# 执行一个阶段并记录其耗时
+def run_stage(judge: dict, name: str, stage) -> bool:
+    begin_stage(judge, name)
+    try:
+        return stage(judge)
+    finally:
+        end_stage(judge, name)
+
+target_stages = [('link', stage_link), ('run', stage_run)]
+
+# testcase: {series_name, case_name, file_src, file_in, file_ans[, judge, log_subdir]}
+# judge_context: {series_name, case_name, targets, target, work_dir, out_dir, work_dir_host, out_dir_host, 
+#   file_src, file_src_host, file_in, file_in_host, file_ans, file_out, file_perf[, precompiled, durations, stage_begin, resources]}
+def test_one_case(testcase: dict):
+    if 'queued_at' in testcase:
+        trace_event('queue', 'queue', testcase['queued_at'], time.monotonic(), {'case': os.path.join(testcase['series_name'], testcase['case_name'])})
+    # 批量编译阶段已经准备好的测试点直接使用其评测上下文
+    judge = testcase['judge'] if 'judge' in testcase else prepare_or_record(testcase)
+    if judge is None:
+        return
+    printLog('{0} start.'.format(judge['case_fullname']))
+    if not run_stage(judge, 'compile', stage_compile):
+        return
+    for target in fan_out(judge):
+        if all(run_stage(target, name, stage) for name, stage in target_stages):
+            read_out_and_check(target)
 
 def read_out_and_check(judge: dict):
+    begin_stage(judge, 'check')
     if remove_elf_after_run:
         if 'file_elf' in judge.keys() and os.path.exists(judge['file_elf']):
             os.remove(judge['file_elf'])
-    with open(judge['file_perf'], 'r') as fp:
-        perf_text = fp.read()
-    correct, comment = answer_check(judge['file_ans'], judge['file_out'])
+    perf_text = read_excerpt(judge['file_perf'])
+    perf_time = read_perf_time(judge['file_perf'])
+    bench, file_out = None, judge['file_out']
+    if judge.get('bench_repeat', 1) > 1:
+        correct, comment, bench, file_out = check_benchmark(judge)
+        if bench is not None and bench['median'] is not None:
+            perf_time = bench['median']
+    else:
+        correct, comment = answer_check(judge['file_ans'], judge['file_out'])
+    durations = stage_durations(judge)
     if not correct:
-        with open(judge['file_in'], 'r') as fp:
-            stdin_text = fp.read()
-        with open(judge['file_out'], 'r') as fp:
-            stdout_text = fp.read()
-        with open(judge['file_ans'], 'r') as fp:
-            answer_text = fp.read()
+        stdin_text = read_excerpt(judge['file_in'])
+        stdout_text = read_excerpt(file_out)
+        answer_text = read_excerpt(judge['file_ans'])
         add_result(judge['work_dir'], {
             'series_name': judge['series_name'], 'case_name': judge['case_name'], 'verdict': WRONG_ANSWER, 
-            'comment': comment, 'perf': perf_text, 'stdin': stdin_text, 'stdout': stdout_text, 'answer': answer_text
-        })
+            'comment': comment, 'perf': perf_text, 'perf_time': perf_time, 'bench': bench, 'stdin': stdin_text, 'stdout': stdout_text, 'answer': answer_text,
+            'durations': durations, 'resources': judge.get('resources', {})
+        }, judge.get('variant', ''), target_label(judge))
     else:
         add_result(judge['work_dir'], {
             'series_name': judge['series_name'], 'case_name': judge['case_name'], 'verdict': ACCEPTED, 
-            'comment': comment, 'perf': perf_text, 'stdin': '', 'stdout': '', 'answer': ''
-        })
+            'comment': comment, 'perf': perf_text, 'perf_time': perf_time, 'bench': bench, 'stdin': '', 'stdout': '', 'answer': '',
+            'durations': durations, 'resources': judge.get('resources', {})
+        }, judge.get('variant', ''), target_label(judge))
+        prune_artifacts(judge)
 
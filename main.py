@@ -1,41 +1,160 @@
-import os, json
-from concurrent.futures import ThreadPoolExecutor
+import os, json, time, signal
+from concurrent.futures import ThreadPoolExecutor, wait
 
 from const import *
 from public import *
-from util import pretty_result, walk_testcase, display_result, archive_source
+from util import pretty_result, display_result, archive_source
+import tasks
 from tasks import build_compiler
+from pool import shutdown_pools
 from judge import test_one_case
+from batch import batch_compile
+from pipeline import run_pipeline
+from adaptive import run_admitted, adaptive_summary
+from appcds import setup_app_cds, cds_summary
+from distributed import run_distributed, worker_parallel, distributed_summary
+from schedule import order_testcases, save_history, schedule_summary
+from rerun import select_testcases
+from manifest import load_testcases, shard_testcases, record_durations
+from variant import expand_variants, variant_matrix, variant_text, variant_html
+from target import target_matrix, target_text, target_html
+from sink import result_sink
+from timing import trace_summary_text, trace_summary_html, write_chrome_trace
+from cache import evict_cache
+from compare import load_results, compare_results, comparison_text, comparison_html
 from rpi import setup_rpi, wait_rpi_all
+from logger import printLog
 
 # 初始化树莓派
 setup_rpi(RpiAddresses)
 
 if RebuildCompiler:
-    build_compiler(DockerClient, CompilerSrc, CompilerBuild, CompilerLib)
+    rebuilt = build_compiler(DockerClient, CompilerSrc, CompilerBuild, CompilerLib)
+    # 在评测记录中保存所测试的编译器构建的指纹
+    with open(os.path.join(logDir, 'compiler.json'), 'w') as fp:
+        json.dump({'fingerprint': tasks.compiler_fingerprint(CompilerBuild, CompilerLib), 'rebuilt': rebuilt}, fp=fp)
 
 if CacheSource:
     archive_source(CompilerSrc, os.path.join(logDir, "src.tar.gz"))
 
-testcases = walk_testcase(TestcaseBaseDir, TestcaseSelect)
+testcases = load_testcases(TestcaseSelect, TestcaseExclude)
+if Shard:
+    testcases = shard_testcases(testcases, Shard)
+carried = []
+if Variants:
+    testcases = expand_variants(testcases)
+elif RerunFailed or ChangedSince:
+    testcases, carried = select_testcases(testcases)
+if ScheduleHistory:
+    testcases = order_testcases(testcases)
+# 在评测计时开始前为编译器构建准备 AppCDS 归档 (分布式评测时编译在 worker 上进行)
+if AppCds and not Workers:
+    setup_app_cds(testcases)
 
-# # 使用线程池运行测试点
-with ThreadPoolExecutor(max_workers=NumParallel) as pool:
-    pool.map(test_one_case, testcases)
+# SIGTERM 与 Ctrl-C 相同处理: 停止提交新的测试点，用已完成的结果生成部分报告
+signal.signal(signal.SIGTERM, signal.default_int_handler)
+result_sink.set_total(len(testcases) * len(RunTypes))  # 多个评测类型时每个测试点有多条结果
+judge_begin = time.monotonic()
+interrupted = False
 
-wait_rpi_all()
+try:
+    if BatchCompileSize > 0 and not Workers:
+        testcases = batch_compile(DockerClient, testcases, RunTypes)
 
+    if Workers:
+        run_distributed(testcases)
+    elif Pipeline:
+        run_pipeline(testcases)
+    else:
+        # # 使用线程池运行测试点
+        # 开启自适应并发时线程数为上限 adaptive.max，实际同时评测的测试点数量由 run_admitted 控制
+        pool = ThreadPoolExecutor(max_workers=AdaptiveMax if Adaptive else NumParallel)
+        futures = []
+        for testcase in testcases:
+            testcase['queued_at'] = time.monotonic()
+            futures.append(pool.submit(run_admitted, test_one_case, testcase))
+        try:
+            wait(futures)
+        except KeyboardInterrupt:
+            # 不再开始新的测试点，正在评测的测试点在后台结束
+            for future in futures:
+                future.cancel()
+            pool.shutdown(wait=False)
+            raise
+        pool.shutdown()
+
+    wait_rpi_all()
+except KeyboardInterrupt:
+    interrupted = True
+    printLog('Interrupted, writing partial report with {0} finished testcases.'.format(len(result_sink)))
+wall_time = time.monotonic() - judge_begin
+shutdown_pools()
+evict_cache()
+
+if ScheduleHistory and not interrupted:
+    save_history(result_sink)
+record_durations(result_sink)
+schedule_text = schedule_summary(wall_time, result_sink, worker_parallel() if Workers else AdaptiveMax if Adaptive else NumParallel)
+if Workers:
+    schedule_text = '\n'.join([schedule_text, distributed_summary(wall_time)])
+if Adaptive:
+    schedule_text = '\n'.join([schedule_text, adaptive_summary()])
+if AppCds and cds_summary():
+    schedule_text = '\n'.join([schedule_text, cds_summary()])
+printLog(schedule_text)
+if Trace:
+    write_chrome_trace(os.path.join(logDir, 'trace_' + logName + '.json'))
+
+# 合并沿用的之前的结果
+for r in carried:
+    result_sink.append(r)
+
+# 与之前的评测结果对比运行时间
+comparison = None
+if CompareWith:
+    try:
+        comparison = compare_results(result_sink, load_results(CompareWith), RegressionThreshold)
+        with open(os.path.join(logDir, 'compare_' + logName + '.json'), 'w') as fp:
+            json.dump(comparison, fp=fp)
+    except Exception as e:
+        printLog('Compare with {0} failed: {1}'.format(CompareWith, str(e)))
+
+# 各变体的结果对比
+matrix = None
+if Variants:
+    matrix = variant_matrix(result_sink)
+    with open(os.path.join(logDir, 'variants_' + logName + '.json'), 'w') as fp:
+        json.dump(matrix, fp=fp)
+
+# 多个评测类型的结果对比
+targets = None
+if len(RunTypes) > 1:
+    targets = target_matrix(result_sink)
+    with open(os.path.join(logDir, 'targets_' + logName + '.json'), 'w') as fp:
+        json.dump(targets, fp=fp)
+
+# 报告均按 (测试集, 用例名称) 顺序从 result_*.jsonl 逐条读取生成
 with open(os.path.join(logDir, 'result_' + logName + '.html'), 'w') as fp:
-    fp.write(display_result(results, title=logName))
+    for chunk in display_result(result_sink, title=logName, extra='<p>{0}</p>'.format(schedule_text) + (trace_summary_html() if Trace else '') + (target_html(targets) if targets else '')
+            + (variant_html(matrix) if matrix else '')
+            + (comparison_html(comparison) if comparison else '')):
+        fp.write(chunk)
 
 with open(os.path.join(logDir, 'result_' + logName + '.json'), 'w') as fp:
-    json.dump(results, fp=fp)
+    fp.write('[')
+    for i, r in enumerate(result_sink):
+        fp.write((', ' if i > 0 else '') + json.dumps(r))
+    fp.write(']')
 
-result = pretty_result(results)
+result = "\n".join([pretty_result(result_sink), schedule_text] + ([trace_summary_text()] if Trace else []) + ([target_text(targets)] if targets else [])
+    + ([variant_text(matrix)] if matrix else []))
+if comparison:
+    result = "\n".join([result, comparison_text(comparison)])
 print(result)
 with open(os.path.join(logDir, 'result_' + logName + '.txt'), 'w') as fp:
     fp.write(result)
 
 print("log name: {0}".format(logName))
+result_sink.close()
 # close log file
 logFile.close()
\ No newline at end of file
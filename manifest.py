@@ -0,0 +1,261 @@
+import os
+import re
+import json
+import fnmatch
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from public import *
+from util import hash_file
+from schedule import HistorySmoothing
+from logger import printLog
+
+# 测试点清单: 每个 testcase-base 一个 JSON 文件，记录各测试点 .sy/.in/.out 的大小、修改时间和内容哈希，
+# .sy 头部注释中的标签 (// tags: perf, large) 以及历史耗时。每次评测只 stat 测试点文件，大小或修改时间变化的文件才重新哈希。
+# 选择测试点 (测试集、通配符、标签、正则表达式)、按预计耗时切分 --shard、编译缓存的键和 --changed-since 的比较都使用清单中的信息。
+# {version, cases: {series/case: {series, case, src, files: {ext: {size, mtime, sha256}}, tags, duration}}}
+
+ManifestVersion = 1
+TestcaseExts = ['.sy', '.in', '.out']
+TagComment = re.compile(r'//\s*tags?\s*:(.*)$')
+
+manifest = None
+manifest_lock = threading.Lock()
+
+def manifest_path() -> str:
+    if TestcaseManifest:
+        return TestcaseManifest
+    base = os.path.realpath(TestcaseBaseDir)
+    return os.path.join(LogDirBase, '.manifest', hashlib.sha1(base.encode('utf-8')).hexdigest()[:16] + '.json')
+
+def load_manifest() -> dict:
+    try:
+        with open(manifest_path(), 'r') as fp:
+            data = json.load(fp)
+        if data.get('version') == ManifestVersion:
+            return data
+    except (OSError, ValueError):
+        pass
+    return {'version': ManifestVersion, 'cases': {}}
+
+def save_manifest(data: dict):
+    path = manifest_path()
+    os.makedirs(os.path.dirname(os.path.realpath(path)), exist_ok=True)
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as fp:
+        json.dump(data, fp=fp)
+    os.replace(tmp_path, path)
+
+def get_manifest() -> dict:
+    global manifest
+    if manifest is None:
+        manifest = load_manifest()
+    return manifest
+
+# .sy 开头的注释行中的标签，遇到第一行代码为止
+def parse_tags(path: str) -> list:
+    tags = set()
+    with open(path, 'r', errors='replace') as fp:
+        for line in fp:
+            line = line.strip()
+            if not line:
+                continue
+            if not line.startswith('//'):
+                break
+            m = TagComment.match(line)
+            if m:
+                tags.update(t for t in re.split(r'[\s,]+', m.group(1)) if t)
+    return sorted(tags)
+
+def list_series_dirs() -> list:
+    return sorted(name for name in os.listdir(TestcaseBaseDir)
+        if not name.startswith('.') and os.path.isdir(os.path.join(TestcaseBaseDir, name)))
+
+# 扫描一个测试集目录，返回需要重新哈希的文件数量
+def scan_series(cases: dict, series: str) -> int:
+    dir = os.path.join(TestcaseBaseDir, series)
+    stats = {}
+    with os.scandir(dir) as it:
+        for entry in it:
+            if entry.is_file():
+                stats[entry.name] = entry.stat()
+    found, jobs = {}, []
+    for file in sorted(stats):
+        if not file.endswith('.sy'):
+            continue
+        name = file.split('.')[0]
+        key = '/'.join([series, name])
+        old = cases.get(key, {})
+        entry = {'series': series, 'case': name, 'src': file, 'files': {}, 'tags': old.get('tags', []), 'duration': old.get('duration')}
+        for ext in TestcaseExts:
+            st = stats.get(file if ext == '.sy' else name + ext)
+            if st is None:
+                continue
+            info = {'size': st.st_size, 'mtime': st.st_mtime_ns}
+            prev = old.get('files', {}).get(ext)
+            if prev is not None and prev['size'] == info['size'] and prev['mtime'] == info['mtime']:
+                info['sha256'] = prev['sha256']
+            else:
+                jobs.append((entry, ext, os.path.join(dir, file if ext == '.sy' else name + ext)))
+            entry['files'][ext] = info
+        found[key] = (entry, old)
+    with ThreadPoolExecutor(max_workers=NumParallel) as pool:
+        digests = list(pool.map(lambda job: hash_file(job[2]).hexdigest(), jobs))
+    for (entry, ext, path), digest in zip(jobs, digests):
+        entry['files'][ext]['sha256'] = digest
+        if ext == '.sy':
+            entry['tags'] = parse_tags(path)
+    for key, (entry, old) in found.items():
+        # 源程序或输入内容改变后历史耗时不再适用
+        if any(entry['files'].get(ext, {}).get('sha256') != old.get('files', {}).get(ext, {}).get('sha256') for ext in ['.sy', '.in']):
+            entry['duration'] = None
+        cases[key] = entry
+    for key in [key for key, entry in cases.items() if entry['series'] == series and key not in found]:
+        del cases[key]
+    return len(jobs)
+
+def check_series(series: str):
+    if os.path.isabs(series) or '..' in series.split('/'):
+        raise ValueError('invalid series {0!r}'.format(series))
+
+def is_glob(pattern: str) -> bool:
+    return any(c in pattern for c in '*?[')
+
+def is_series(pattern: str) -> bool:
+    """不含通配符的测试集名称 (可以是 testcase-base 下的多级目录)"""
+    return not pattern.startswith(('tag:', 're:')) and not is_glob(pattern) and os.path.isdir(os.path.join(TestcaseBaseDir, pattern))
+
+# 需要扫描的测试集: 测试集名称和前缀确定的 series/case 通配符只扫描对应目录，其余模式扫描 testcase-base 下的所有测试集
+def series_to_scan(patterns: list) -> list:
+    series = set()
+    for pattern in patterns:
+        if pattern.startswith(('tag:', 're:')):
+            return list_series_dirs()
+        check_series(pattern)
+        if is_series(pattern):
+            series.add(pattern)
+            continue
+        if '/' not in pattern and not is_glob(pattern):
+            raise ValueError('testcase series {0!r} not found'.format(pattern))
+        prefix = pattern.rsplit('/', 1)[0] if '/' in pattern else ''
+        if not prefix or is_glob(prefix):
+            return list_series_dirs()
+        if not os.path.isdir(os.path.join(TestcaseBaseDir, prefix)):
+            raise ValueError('testcase series {0!r} not found'.format(prefix))
+        series.add(prefix)
+    return sorted(series)
+
+# 模式: 测试集名称 (functional)、series/case 通配符 (functional/0*)、测试集通配符 (perf*)、tag:标签、re:正则表达式 (匹配 series/case)，
+# 返回判断测试点 (key 为 series/case) 是否匹配的函数
+def compile_pattern(pattern: str):
+    if pattern.startswith('tag:'):
+        tag = pattern[len('tag:'):]
+        return lambda key, entry: tag in entry['tags']
+    if pattern.startswith('re:'):
+        try:
+            regex = re.compile(pattern[len('re:'):])
+        except re.error as e:
+            raise ValueError('invalid pattern {0!r}: {1}'.format(pattern, str(e)))
+        return lambda key, entry: regex.search(key) is not None
+    if is_series(pattern):
+        return lambda key, entry: entry['series'] == pattern
+    if '/' in pattern:
+        return lambda key, entry: fnmatch.fnmatchcase(key, pattern)
+    return lambda key, entry: fnmatch.fnmatchcase(entry['series'], pattern)
+
+def make_testcase(key: str, entry: dict) -> dict:
+    dir = os.path.join(TestcaseBaseDir, entry['series'])
+    return {'series_name': entry['series'], 'case_name': entry['case'],
+        'file_src': os.path.realpath(os.path.join(dir, entry['src'])),
+        'file_in': os.path.realpath(os.path.join(dir, entry['case'] + '.in')),
+        'file_ans': os.path.realpath(os.path.join(dir, entry['case'] + '.out')),
+        'hashes': {ext: info['sha256'] for ext, info in entry['files'].items()},
+        'size': sum(info['size'] for ext, info in entry['files'].items() if ext != '.out'),
+        'tags': entry['tags'], 'expected': entry['duration']}
+
+def load_testcases(patterns: list, exclude: list=[]) -> list: # [{series_name, case_name, file_src, file_in, file_ans, hashes, size, tags, expected}]
+    """更新清单中涉及的测试集，返回匹配 patterns 且不匹配 exclude 的测试点"""
+    matchers = [(pattern, compile_pattern(pattern)) for pattern in patterns]    # 正则表达式有误时在扫描前报错
+    excluders = [compile_pattern(pattern) for pattern in exclude]
+    with manifest_lock:
+        data = get_manifest()
+        cases = data['cases']
+        count = len(cases)
+        scanned = series_to_scan(patterns)
+        rehashed = sum(scan_series(cases, series) for series in scanned)
+        # 删除已不存在的测试集
+        missing = {entry['series'] for entry in cases.values()}
+        missing = {series for series in missing if not os.path.isdir(os.path.join(TestcaseBaseDir, series))}
+        for key in [key for key, entry in cases.items() if entry['series'] in missing]:
+            del cases[key]
+        if rehashed > 0 or len(cases) != count or not os.path.exists(manifest_path()):
+            save_manifest(data)
+        selected = set()
+        for pattern, matcher in matchers:
+            matched = [key for key, entry in cases.items() if matcher(key, entry)]
+            if len(matched) == 0:
+                printLog('manifest: pattern {0!r} matches no testcase'.format(pattern))
+            selected.update(matched)
+        selected = sorted(selected, key=lambda key: (cases[key]['series'], cases[key]['case']))
+        selected = [key for key in selected if not any(excluder(key, cases[key]) for excluder in excluders)]
+        testcases = [make_testcase(key, cases[key]) for key in selected]
+    printLog('manifest: {0} testcases in {1} series, {2} files rehashed, {3} selected'.format(
+        sum(1 for entry in cases.values() if entry['series'] in scanned), len(scanned), rehashed, len(testcases)))
+    return testcases
+
+def parse_shard(shard: str):
+    m = re.match(r'^(\d+)/(\d+)$', shard)
+    if m is None or not 1 <= int(m.group(1)) <= int(m.group(2)):
+        raise ValueError('invalid shard {0!r}, expected I/N with 1 <= I <= N'.format(shard))
+    return int(m.group(1)), int(m.group(2))
+
+# 按预计耗时切分，从长到短依次分给当前预计总耗时最少的分片 (耗时相同时按名称顺序)。
+# 各 CI 任务必须得到相同的切分，因此只使用各任务共有的输入: 文件大小，以及显式配置的 testcase-manifest (共享的清单) 中的历史耗时；
+# log-dir 下的清单只属于本机 (每个任务只记录自己分片的耗时)，其中的耗时不参与切分。
+# 没有历史耗时的测试点以已知测试点的 耗时/文件大小 比例估计
+def shard_testcases(testcases: list, shard: str) -> list:
+    index, count = parse_shard(shard)
+    if not TestcaseManifest:
+        if any(t['expected'] is not None for t in testcases):
+            printLog('manifest: warning: ignoring durations in the local manifest {0} for --shard, they differ between machines; '
+                'set testcase-manifest to a shared file to balance shards by history'.format(manifest_path()))
+        testcases = [dict(t, expected=None) for t in testcases]
+    known = [t for t in testcases if t['expected'] is not None]
+    known_size = sum(t['size'] for t in known)
+    rate = sum(t['expected'] for t in known) / known_size if known_size > 0 else 1.0
+    estimate = lambda t: t['expected'] if t['expected'] is not None else t['size'] * rate
+    loads = [0.0] * count
+    assigned = []
+    for testcase in sorted(testcases, key=lambda t: (-estimate(t), t['series_name'], t['case_name'])):
+        i = min(range(count), key=lambda i: (loads[i], i))
+        loads[i] += estimate(testcase)
+        if i == index - 1:
+            assigned.append(testcase)
+    # 没有任何历史耗时时按文件大小 (字节) 切分
+    unit = '{0:.2f}s' if len(known) > 0 else '{0:.0f} bytes'
+    printLog('manifest: shard {0}/{1} has {2} of {3} testcases, expected {4} (shards {5} - {6})'.format(
+        index, count, len(assigned), len(testcases), unit.format(loads[index - 1]), unit.format(min(loads)), unit.format(max(loads))))
+    return sorted(assigned, key=lambda t: (t['series_name'], t['case_name']))
+
+# 评测结束后更新清单中的历史耗时 (同一测试点各变体、各评测类型的耗时相加)。
+# 分片评测只得到部分测试点的耗时，写入共享的清单会使之后启动的任务与其他任务的切分不同，因此不记录
+def record_durations(results: list):
+    if Shard:
+        printLog('manifest: durations of a --shard run are not recorded')
+        return
+    totals = {}
+    for r in results:
+        if not r.get('durations') or r.get('carried_from'):
+            continue
+        key = '/'.join([r['series_name'], r['case_name']])
+        totals[key] = totals.get(key, 0.0) + sum(r['durations'].values())
+    with manifest_lock:
+        data = get_manifest()
+        for key, t in totals.items():
+            entry = data['cases'].get(key)
+            if entry is None:
+                continue
+            old = entry['duration']
+            entry['duration'] = t if old is None else old * (1 - HistorySmoothing) + t * HistorySmoothing
+        save_manifest(data)
@@ -0,0 +1,29 @@
+import argparse
+
+# 评测命令行参数。main.py 直接使用命令行参数；worker.py、daemon.py、bench.py 等有自己命令行参数的工具
+# 在导入 public 之前调用 use_config 指定配置文件，其余参数取缺省值。
+
+parser = argparse.ArgumentParser(description='SysY compiler judge')
+parser.add_argument('config', nargs='?', default='config.json', help='config file (default: config.json)')
+rerun_group = parser.add_mutually_exclusive_group()
+rerun_group.add_argument('--rerun-failed', metavar='LOG_DIR', default='', help='only judge testcases not ACCEPTED in a previous log dir')
+rerun_group.add_argument('--changed-since', metavar='LOG_DIR', default='', help='only judge testcases whose .sy/.in/.out changed since a previous log dir')
+parser.add_argument('--select', metavar='PATTERN', action='append', help='select testcases by series, series/case glob, tag:NAME or re:REGEX (overrides testcase-select, repeatable)')
+parser.add_argument('--exclude', metavar='PATTERN', action='append', help='exclude testcases matching PATTERN (overrides testcase-exclude, repeatable)')
+parser.add_argument('--shard', metavar='I/N', default='', help='only judge the I-th (1-based) of N shards balanced by expected runtime')
+
+args = None
+
+def use_config(config_file: str):
+    """ 使用指定的配置文件，不读取命令行参数 """
+    global args
+    if args is not None:
+        raise Exception('config already loaded from {0}'.format(args.config))
+    args = parser.parse_args([config_file])
+
+def load_args():
+    """ 返回评测参数，未调用 use_config 时从命令行读取 """
+    global args
+    if args is None:
+        args = parser.parse_args()
+    return args
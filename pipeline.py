@@ -0,0 +1,86 @@
+import time
+import queue
+import threading
+
+from const import *
+from public import *
+from judge import prepare_testcase, run_stage, stage_compile, stage_link, stage_run, read_out_and_check, add_error_result, add_testcase_error, fan_out
+from timing import trace_event
+from adaptive import run_admitted
+from logger import printLog
+
+# 流水线调度: 编译 (JVM, 内存占用大)、链接、运行 (qemu, CPU 占用大)、检查答案四个阶段
+# 各自拥有独立的有界队列和并发数，使编译与运行互相重叠，并可单独限制运行阶段的并发以获得稳定的性能数据。
+
+def compile_step(testcase: dict):
+    if 'judge' not in testcase:
+        testcase['judge'] = prepare_testcase(testcase)
+    judge = testcase['judge']
+    printLog('{0} start.'.format(judge['case_fullname']))
+    # 多个评测类型时编译产物分别交给各评测类型的链接、运行阶段
+    return fan_out(judge) if run_stage(judge, 'compile', stage_compile) else None
+
+def link_step(judge: dict):
+    return judge if run_stage(judge, 'link', stage_link) else None
+
+def run_step(judge: dict):
+    return judge if run_stage(judge, 'run', stage_run) else None
+
+def check_step(judge: dict):
+    read_out_and_check(judge)
+    return None
+
+# (阶段名称, 执行函数, 并发数)
+Stages = [
+    ('compile', compile_step, NumParallelCompile),
+    ('link', link_step, NumParallelLink),
+    ('run', run_step, NumParallelRun),
+    ('check', check_step, NumParallelCheck),
+]
+
+Done = object()     # 队列结束标记
+
+def stage_worker(name: str, func, inbox: queue.Queue, outbox: queue.Queue):
+    while True:
+        item = inbox.get()
+        if item is Done:
+            inbox.put(Done)     # 让同一阶段的其他线程也能退出
+            return
+        trace_event('queue_' + name, 'queue', item.pop('queued_at'), time.monotonic(), {'case': item.get('case_fullname', item['case_name'])})
+        try:
+            # 检查答案只读取文件，不受自适应并发的限制
+            out = func(item) if name == 'check' else run_admitted(func, item)
+        except Exception as e:
+            # 阶段内未处理的异常不能让流水线停止，记为其他错误
+            judge = item.get('judge', item)
+            comment = '{0}: {1}'.format(name, str(e))
+            printLog('Pipeline error ({0}): {1}'.format(judge.get('case_fullname', judge['case_name']), comment))
+            if 'work_dir' in judge:
+                add_error_result(judge, OTHER_ERROR, comment)
+            else:
+                add_testcase_error(item, OTHER_ERROR, comment)     # 准备测试点时出错，没有评测上下文
+            continue
+        if out is not None and outbox is not None:
+            for judge in (out if isinstance(out, list) else [out]):
+                judge['queued_at'] = time.monotonic()
+                outbox.put(judge)
+
+def run_pipeline(testcases: list):
+    queues = [queue.Queue(maxsize=max(1, 2 * workers)) for _, _, workers in Stages]
+    stage_threads = []
+    for i, (name, func, workers) in enumerate(Stages):
+        outbox = queues[i + 1] if i + 1 < len(queues) else None
+        threads = [threading.Thread(target=stage_worker, args=(name, func, queues[i], outbox), name='{0}-{1}'.format(name, j), daemon=True)
+            for j in range(max(1, workers))]
+        for t in threads:
+            t.start()
+        stage_threads.append(threads)
+    printLog('pipeline: {0}'.format(', '.join(['{0}={1}'.format(name, workers) for name, _, workers in Stages])))
+    for testcase in testcases:
+        testcase['queued_at'] = time.monotonic()
+        queues[0].put(testcase)
+    # 逐级关闭: 前一阶段的线程全部结束后，再向下一阶段发送结束标记
+    for i, threads in enumerate(stage_threads):
+        queues[i].put(Done)
+        for t in threads:
+            t.join()
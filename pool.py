@@ -0,0 +1,196 @@
+import docker
+from docker.models.containers import Container
+import os
+import time
+import threading
+from logger import printLog
+
+from public import *
+from usage import TaskFailed, usage_probe, probe_output, delta_usage, empty_usage
+from timing import trace_span
+
+# 常驻容器池: 每个 (镜像, 静态挂载) 组合维护一组长期运行的容器，各阶段通过 exec 执行，
+# 避免每个测试点反复创建/启动/删除容器。每个容器同一时刻只执行一个任务。
+
+PoolWorkDir = '/scratch'    # 容器内每个任务的临时工作目录的父目录
+PoolLogDir = '/logs'        # 评测记录目录在容器内的挂载点
+PollInterval = 0.05         # 轮询 exec 状态的间隔 (秒)
+
+def host_to_pool_path(path: str) -> str:
+    """将评测记录目录下的主机路径转换为池容器内的路径"""
+    rel = os.path.relpath(os.path.realpath(path), os.path.realpath(logDirHost))
+    if rel.startswith('..'):
+        raise Exception('path {0} is not under log dir {1}'.format(path, logDirHost))
+    return os.path.join(PoolLogDir, rel)
+
+def quote(s: str) -> str:
+    return "'" + s.replace("'", "'\\''") + "'"
+
+class ContainerPool:
+    def __init__(self, client: docker.DockerClient, image: str, volumes: dict, size: int, cpuset: str=None):
+        self.client = client
+        self.image = image
+        self.cpuset = cpuset
+        self.volumes = dict(volumes)  # 静态挂载 (例如编译器构建目录)
+        self.volumes[os.path.realpath(logDirHost)] = {'bind': PoolLogDir, 'mode': 'rw'}
+        self.size = size
+        self.idle = []
+        self.lock = threading.Lock()
+        self.available = threading.Condition(self.lock)   # 有空闲容器或可以新建容器时通知等待者
+        self.created = 0
+        self.serial = 0
+        self.containers = []
+        self.probes = {}    # 每个容器上一次的 cgroup 统计 {container id: lines}，作为下一个任务的起点
+
+    def _create(self) -> Container:
+        with self.lock:
+            self.serial += 1
+            name = 'compiler_{pid}_pool_{image}_{id}_{serial}'.format(pid=os.getpid(), image=self.image.replace(':', '_').replace('/', '_'),
+                id=id(self) & 0xffff, serial=self.serial)
+        printLog('pool: starting container {0}'.format(name))
+        container: Container = self.client.containers.run(self.image, command='tail -f /dev/null', detach=True, name=name,
+            volumes=self.volumes, mem_limit=MemoryLimit, cpuset_cpus=self.cpuset)
+        with self.lock:
+            self.containers.append(container)
+        return container
+
+    def acquire(self) -> Container:
+        with self.available:
+            while not self.idle and self.created >= self.size:
+                self.available.wait()
+            if self.idle:
+                return self.idle.pop()
+            self.created += 1
+        try:
+            return self._create()
+        except Exception:
+            with self.available:
+                self.created -= 1
+                self.available.notify()
+            raise
+
+    def release(self, container: Container):
+        with self.available:
+            self.idle.append(container)
+            self.available.notify()
+
+    def discard(self, container: Container):
+        """回收损坏的容器 (崩溃、OOM、超时)，并唤醒一个等待者重新创建"""
+        printLog('pool: recycling container {0}'.format(container.name))
+        try:
+            container.remove(force=True)
+        except Exception:
+            pass
+        with self.lock:
+            if container in self.containers:
+                self.containers.remove(container)
+            self.created -= 1
+            self.available.notify()
+        self.probes.pop(container.id, None)
+
+    def shutdown(self):
+        with self.lock:
+            containers, self.containers = self.containers, []
+            self.idle = []
+            self.created = 0
+            self.available.notify_all()
+        for container in containers:
+            try:
+                container.remove(force=True)
+            except Exception:
+                pass
+
+    def usage(self, container: Container, oom_killed: bool) -> dict:
+        """任务的资源使用: 容器 cgroup 的统计与上一个任务结束时之差。内存峰值为整个容器的累计值，不统计"""
+        try:
+            api = self.client.api
+            exec_id = api.exec_create(container.id, ['/bin/sh', '-c', usage_probe()])['Id']
+            after = probe_output(api.exec_start(exec_id).decode('utf-8', errors='replace'))
+        except Exception:
+            usage = empty_usage()   # 容器已被杀死
+            usage['oom_killed'] = oom_killed
+            return usage
+        before = self.probes.get(container.id, [])
+        self.probes[container.id] = after
+        return delta_usage(before, after, oom_killed)
+
+    def run(self, name: str, cmd: str, working_dir: str, volumes: dict, timeout: int=None) -> dict:
+        """在池中的一个容器内执行命令，volumes 为该任务原本需要的挂载 (主机路径 -> 容器路径)。返回任务的资源使用"""
+        with trace_span('pool_acquire', 'docker', stage=name):
+            container = self.acquire()
+        healthy = True
+        try:
+            script = self._script(cmd, working_dir, volumes)
+            api = self.client.api
+            with trace_span('exec_start', 'docker', stage=name):
+                exec_id = api.exec_create(container.id, ['/bin/sh', '-c', script])['Id']
+                api.exec_start(exec_id, detach=True)
+            timeout = timeout or TimeoutSecs
+            deadline = time.monotonic() + timeout
+            with trace_span('exec_wait', 'docker', stage=name):
+                while True:
+                    info = api.exec_inspect(exec_id)
+                    if not info['Running']:
+                        break
+                    if time.monotonic() > deadline:
+                        healthy = False     # 与 container.kill() 语义一致: 直接杀死整个容器
+                        raise Exception('{name}: timeout after {secs} seconds'.format(name=name, secs=timeout))
+                    time.sleep(PollInterval)
+            code = info['ExitCode']
+            container.reload()
+            oom_killed = bool(container.attrs['State'].get('OOMKilled'))
+            if container.status != 'running' or oom_killed or code is None or code == 137:
+                healthy = False
+            usage = self.usage(container, oom_killed) if ResourceUsage else None
+            if code != 0:
+                raise TaskFailed('{name}: container exit with code {code}'.format(name=name, code=code), usage)
+            return usage
+        finally:
+            if healthy:
+                self.release(container)
+            else:
+                self.discard(container)
+
+    def _script(self, cmd: str, working_dir: str, volumes: dict) -> str:
+        # 每个任务使用独立的临时目录，原本挂载到工作目录下的文件映射到临时目录中
+        scratch = os.path.join(PoolWorkDir, 'job_{0}'.format(threading.get_ident()))
+        static_targets = [v['bind'].rstrip('/') for v in self.volumes.values()]
+        prepare, finish = ['rm -rf {0}'.format(quote(scratch)), 'mkdir -p {0}'.format(quote(scratch))], []
+        for host_path, bind in volumes.items():
+            is_dir = bind['bind'].endswith('/')  # 以 '/' 结尾的挂载点为目录 (如 /output/)
+            target, mode = bind['bind'].rstrip('/'), bind.get('mode', 'rw')
+            if target in static_targets:
+                continue
+            src = host_to_pool_path(host_path)
+            if target == working_dir or target.startswith(working_dir.rstrip('/') + '/'):
+                dst = os.path.join(scratch, os.path.relpath(target, working_dir))
+            else:
+                dst = target
+            prepare.append('mkdir -p {0}'.format(quote(os.path.dirname(dst))))
+            if is_dir:
+                prepare.append('mkdir -p {1} && rm -rf {0} && ln -s {1} {0}'.format(quote(dst), quote(src)))
+            elif mode == 'ro':
+                prepare.append('ln -s {1} {0}'.format(quote(dst), quote(src)))
+            else:
+                # 可写的单个文件 (如 ELF): 执行结束后拷回
+                prepare.append('rm -f {0}'.format(quote(dst)))
+                finish.append('cp -f {0} {1} 2>/dev/null'.format(quote(dst), quote(src)))
+        return ' && '.join(prepare) + ' && cd {0} && ( {1} ); r=$?; {2} cd / && rm -rf {0}; exit $r'.format(
+            quote(scratch), cmd, ''.join([s + '; ' for s in finish]))
+
+Pools = {}
+PoolsLock = threading.Lock()
+
+def get_pool(client: docker.DockerClient, image: str, volumes: dict, cpuset: str=None) -> ContainerPool:
+    key = (image, tuple(sorted((k, v['bind'], v.get('mode', 'rw')) for k, v in volumes.items())), cpuset)
+    with PoolsLock:
+        if key not in Pools:
+            Pools[key] = ContainerPool(client, image, volumes, NumParallel, cpuset)
+        return Pools[key]
+
+def shutdown_pools():
+    with PoolsLock:
+        pools = list(Pools.values())
+        Pools.clear()
+    for pool in pools:
+        pool.shutdown()
@@ -1,13 +1,14 @@
 import docker
 import os, sys, json, shutil
 from datetime import datetime
+from options import load_args
 
-DockerClient = docker.from_env()
+args = load_args()
 
-ConfigFile = 'config.json'
-
-if len(sys.argv) >= 2:
-    ConfigFile = sys.argv[1]
+ConfigFile = args.config
+RerunFailed = args.rerun_failed
+ChangedSince = args.changed_since
+Shard = args.shard
 
 with open(ConfigFile, 'r') as fp:
     config: dict = json.load(fp)
@@ -23,24 +24,83 @@ CompilerBuild = config['compiler-build']  # path to compiler build artifact
 CompilerFileName = 'compiler.jar'  # name of executable jar
 
 TestcaseBaseDir = config['testcase-base']
-TestcaseSelect = config['testcase-select']
+TestcaseSelect = args.select or config['testcase-select']    # 测试集名称、series/case 通配符、tag:标签 或 re:正则表达式
+TestcaseExclude = args.exclude or get_config('testcase-exclude', [])
+TestcaseManifest = get_config('testcase-manifest', '')   # 测试点清单文件，缺省在 log-dir/.manifest 下按 testcase-base 区分
+TestcaseBaseHost = get_config('testcase-base-host', TestcaseBaseDir)   # 测试用例根目录在主机上的路径 (staging 为 bind 时使用)
+Staging = get_config('staging', 'copy')     # 测试点文件放入评测记录的方式: copy, link (reflink/硬链接), bind (直接挂载原文件)
+KeepArtifacts = get_config('keep-artifacts', 'all')  # all: 保留所有用例的文件; failed: 通过的用例只保留结果; compress: 通过的用例打包压缩
 NumParallel = config['num-parallel']
+Pipeline = get_config('pipeline', False)   # 按阶段流水线调度
+NumParallelCompile = get_config('num-parallel-compile', NumParallel)
+NumParallelLink = get_config('num-parallel-link', NumParallel)
+NumParallelRun = get_config('num-parallel-run', NumParallel)
+NumParallelCheck = get_config('num-parallel-check', NumParallel)
+ScheduleHistory = get_config('schedule-history', True)   # 按历史耗时最长优先调度
+Trace = get_config('trace', True)   # 记录各阶段耗时，生成耗时汇总和 Chrome trace
+Adaptive = get_config('adaptive', {})   # 自适应并发 {min, max, reserve, load, interval}，缺省时使用固定的并发数
+AdaptiveMin = Adaptive.get('min', 1)
+AdaptiveMax = Adaptive.get('max', NumParallel)
+AdaptiveReserve = Adaptive.get('reserve', '512m')   # 为系统保留的可用内存
+AdaptiveLoad = Adaptive.get('load', 1.0)            # 每个 CPU 核心的目标负载
+AdaptiveInterval = Adaptive.get('interval', 1.0)    # 重新计算并发上限的间隔 (秒)
 
 RebuildCompiler = config['rebuild-compiler']
 
-RunType = config['run-type']
+# 评测类型，可以是列表 (例如 ["llvm", "qemu-arm", "qemu-riscv"])，每个测试点只编译一次，产物分别交给各评测类型链接、运行
+RunTypes = config['run-type'] if isinstance(config['run-type'], list) else [config['run-type']]
+RunType = RunTypes[0]
 
 CacheSource = get_config('cache-source', False)
 RpiAddresses = get_config('rpi-addresses', [])
+RpiProtocol = get_config('rpi-protocol', 'split')    # split: 分别上传目标代码、输入并取回结果; combined: 一个请求完成 (需树莓派端支持)
+RpiPrefetch = get_config('rpi-prefetch', True)       # combined 协议下，在树莓派运行当前任务时预先上传下一个任务
+RpiHealthInterval = get_config('rpi-health-interval', 10)  # 树莓派健康检查的间隔 (秒)
+Workers = get_config('workers', [])     # 分布式评测: worker.py 的地址列表，例如 ["http://10.0.0.2:9100"]
+WorkerToken = get_config('worker-token', '')    # 协调端与 worker 共享的令牌，worker 只接受带有该令牌的请求
+DaemonToken = get_config('daemon-token', '')    # 守护进程只接受带有该令牌的请求
 LogDirBase = get_config('log-dir', 'logs')
 LogDirHostBase = get_config('log-dir-host', LogDirBase)
-TimeoutSecs = get_config('timeout', 60)
+# 超时 (秒): 一个数值，或按测试集分别配置 {"functional": 10, "performance": 120, "default": 60}
+Timeout = get_config('timeout', 60)
+TimeoutSecs = Timeout.get('default', 60) if isinstance(Timeout, dict) else Timeout
+SeriesTimeout = {k: v for k, v in Timeout.items() if k != 'default'} if isinstance(Timeout, dict) else {}
 
 JvmOptions = get_config('jvm-options', "")
 OptOptions = get_config('opt-options', "")
 
+# A/B 对比: 每个测试点在所有变体下分别编译运行 [{name, compiler-build, compiler-lib, opt-options, jvm-options}]，省略的字段使用上面的配置
+DefaultVariant = {'name': '', 'compiler-build': CompilerBuild, 'compiler-lib': CompilerLib, 'opt-options': OptOptions, 'jvm-options': JvmOptions}
+Variants = [dict(DefaultVariant, **v) for v in get_config('variants', [])]
+
+Benchmark = get_config('benchmark', {})    # 性能测试模式 {series, warmup, runs, parallel}
+BenchmarkSeries = Benchmark.get('series', [])
+BenchmarkWarmup = Benchmark.get('warmup', 1)
+BenchmarkRuns = Benchmark.get('runs', 5)
+BenchmarkParallel = Benchmark.get('parallel', 1)
+CpusetCpus = get_config('cpuset-cpus', [])   # 性能测试容器独占的 CPU 集合列表，例如 ["2", "3"] 或 ["2-3", "4-5"]
+
+CompareWith = get_config('compare-with', '')  # 之前的 result_*.json 或评测记录目录
+RegressionThreshold = get_config('regression-threshold', 0.05)
+
 MemoryLimit = get_config('memory-limit', '256m')
+OutputLimit = get_config('output-limit', 0)     # 运行时程序输出大小的上限 (如 '64m')，超出后立即终止程序，0 表示不限制
+OutputLimitRatio = get_config('output-limit-ratio', 0)   # 按答案大小限制输出: 答案文件大小的倍数 (不小于 output-limit-min)，0 表示不使用
+OutputLimitMin = get_config('output-limit-min', '4k')
+UseContainerPool = get_config('container-pool', False)
+BatchCompileSize = get_config('batch-compile', 0)    # 每个批次的测试点数量, 0 表示不使用批量编译
+BatchCompileIsolate = get_config('batch-compile-isolate', True)
+ArtifactCache = get_config('artifact-cache', False)
+ArtifactCacheDir = get_config('artifact-cache-dir', os.path.join(LogDirBase, '.cache'))
+ArtifactCacheSize = get_config('artifact-cache-size', '2g')
+AppCds = get_config('app-cds', False)    # 为每个编译器构建生成 AppCDS 归档，加快每个测试点 JVM 的启动
+AppCdsTraining = get_config('app-cds-training', 3)  # 生成归档时训练编译的测试点数量
+ExecBackend = get_config('backend', 'docker')     # docker 或 native (本机直接执行)
+NativeCgroup = get_config('native-cgroup', '')   # native 后端用于限制内存的 cgroup v2 目录 (需已委派给当前用户)
 EmitLLVM = get_config('emit-llvm', False)
+ResourceUsage = get_config('resource-usage', True)  # 统计每个任务的内存峰值和 CPU 时间 (容器内读取 cgroup 统计文件)
+
+DockerClient = docker.from_env() if ExecBackend == 'docker' else None
 
 logName = datetime.now().strftime('%Y_%m_%d_%H_%M_%S') + "_" + str(os.getpid())
 logDir = os.path.realpath(os.path.join(LogDirBase, logName))
@@ -51,4 +111,3 @@ shutil.copy(ConfigFile, os.path.join(logDir, os.path.basename(ConfigFile)))
 
 logFile = open(os.path.join(logDir, logName + '.log'), 'a')
 
-results = [] # {series, name, verdict, comment, perf, stdin, stdout, answer}
@@ -0,0 +1,118 @@
+import os
+import glob
+import json
+import shutil
+
+from const import *
+from public import *
+from compare import load_results
+from util import files_identical, hash_file
+from logger import printLog
+
+# 依据之前的评测记录只评测部分用例: --rerun-failed 重新评测未通过的用例，--changed-since 重新评测测试点文件有改动的用例。
+# 其余用例沿用之前的结果 (标记 carried_from)，与本次结果合并生成报告。
+
+def resolve_log_dir(path: str) -> str:
+    """接受评测记录目录的路径，或 log-dir 下的评测记录名称"""
+    if not os.path.isdir(path) and os.path.isdir(os.path.join(LogDirBase, path)):
+        path = os.path.join(LogDirBase, path)
+    if not os.path.isdir(path):
+        raise Exception('log dir {0} not found'.format(path))
+    return os.path.realpath(path)
+
+# 读取之前的评测结果 {(series, case): result}。评测中断时没有 result_*.json，以各用例目录下的 result.json 补充
+def load_previous(log_dir: str) -> dict:
+    previous = {}
+    try:
+        for r in load_results(log_dir):
+            previous[(r['series_name'], r['case_name'])] = r
+    except Exception as e:
+        printLog('{0}, using per-case result.json'.format(str(e)))
+    for path in glob.glob(os.path.join(log_dir, '*', '*', 'result.json')):
+        try:
+            with open(path, 'r') as fp:
+                r = json.load(fp)
+        except (OSError, ValueError):
+            continue
+        previous.setdefault((r['series_name'], r['case_name']), r)
+    return previous
+
+# 评测记录中没有保存测试点文件时 (staging 为 bind 或 keep-artifacts 删除了通过的用例文件)，与 testcase.json 中的哈希比较
+def digest_changed(testcase: dict, digest: dict) -> bool:
+    if 'hashes' in testcase:
+        return testcase['hashes'] != digest     # 测试点清单中的哈希，无需重新哈希测试点文件
+    for key, ext in [('file_src', '.sy'), ('file_in', '.in'), ('file_ans', '.out')]:
+        exists = os.path.exists(testcase[key])
+        if exists != (ext in digest):
+            return True
+        if exists and hash_file(testcase[key]).hexdigest() != digest[ext]:
+            return True
+    return False
+
+def testcase_changed(testcase: dict, log_dir: str) -> bool:
+    """与评测记录中保存的 .sy/.in/.out 副本比较"""
+    case_dir = os.path.join(log_dir, testcase['series_name'], testcase['case_name'])
+    digest_path = os.path.join(case_dir, 'testcase.json')
+    if os.path.exists(digest_path):
+        with open(digest_path, 'r') as fp:
+            return digest_changed(testcase, json.load(fp))
+    for key, ext in [('file_src', '.sy'), ('file_in', '.in'), ('file_ans', '.out')]:
+        old = os.path.join(case_dir, testcase['case_name'] + ext)
+        if not os.path.exists(old):
+            return True
+        if not os.path.exists(testcase[key]):
+            if key == 'file_in' and os.path.getsize(old) == 0:
+                continue    # 没有输入文件时评测记录中为空文件
+            return True
+        if not files_identical(testcase[key], old):
+            return True
+    return False
+
+# 评测记录中测试点文件副本的哈希 (与 testcase.json 格式相同)，没有输入文件时评测记录中为空文件
+def copied_digest(case_dir: str, case_name: str) -> dict:
+    digest = {}
+    for ext in ['.sy', '.in', '.out']:
+        path = os.path.join(case_dir, case_name + ext)
+        if os.path.exists(path) and not (ext == '.in' and os.path.getsize(path) == 0):
+            digest[ext] = hash_file(path).hexdigest()
+    return digest
+
+# 沿用的用例不放入测试点文件，只在本次评测记录中写入结果和评测时测试点文件的哈希，使本次记录也可作为之后 --changed-since 的基准
+def carry_over(testcase: dict, log_dir: str, result: dict):
+    old_dir = os.path.join(log_dir, testcase['series_name'], testcase['case_name'])
+    work_dir = os.path.join(logDir, testcase['series_name'], testcase['case_name'])
+    os.makedirs(work_dir, exist_ok=True)
+    with open(os.path.join(work_dir, 'result.json'), 'w') as fp:
+        json.dump(result, fp=fp)
+    if os.path.exists(os.path.join(old_dir, 'testcase.json')):
+        shutil.copy(os.path.join(old_dir, 'testcase.json'), work_dir)
+        return
+    # --changed-since 沿用的用例未改变，直接使用测试点清单中的哈希；--rerun-failed 的用例可能已改变，使用之前评测记录中的副本
+    digest = testcase['hashes'] if ChangedSince and 'hashes' in testcase else copied_digest(old_dir, testcase['case_name'])
+    with open(os.path.join(work_dir, 'testcase.json'), 'w') as fp:
+        json.dump(digest, fp=fp)
+
+# 返回 (需要评测的用例, 沿用的结果)
+def select_testcases(testcases: list):
+    if len(RunTypes) > 1:
+        raise Exception('--rerun-failed and --changed-since are not supported with multiple run-types')
+    log_dir = resolve_log_dir(RerunFailed or ChangedSince)
+    previous = load_previous(log_dir)
+    selected, carried = [], []
+    for testcase in testcases:
+        old = previous.get((testcase['series_name'], testcase['case_name']))
+        if old is None:
+            rerun = True
+        elif RerunFailed:
+            rerun = old['verdict'] != ACCEPTED
+        else:
+            rerun = testcase_changed(testcase, log_dir)
+        if rerun:
+            selected.append(testcase)
+        else:
+            result = dict(old, carried_from=old.get('carried_from') or os.path.basename(log_dir))
+            carry_over(testcase, log_dir, result)
+            carried.append(result)
+    printLog('{0}: judging {1} testcases, {2} carried over from {3}'.format(
+        '--rerun-failed' if RerunFailed else '--changed-since', len(selected), len(carried), log_dir))
+    return selected, carried
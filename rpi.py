@@ -1,96 +1,265 @@
+import os
+import time
+import queue
+import threading
 import requests
 from urllib import parse
-from concurrent.futures import ThreadPoolExecutor
-import queue
 from const import RUNTIME_ERROR
 
+from public import *
 from logger import printLog
-from util import add_result
+from util import add_result, begin_stage, end_stage, stage_durations, target_label
 
 API_UPLOAD_ELF  = "/elf"
 API_UPLOAD_ASM  = "/asm"
 API_INPUT       = "/input"
 API_OUTPUT      = "/output"
 API_PERF        = "/perf"
+# combined 协议: 目标代码和输入放在同一个请求中，返回 {"output": ..., "perf": ...}
+#   POST /run?type=elf|asm&target=<目标代码字节数>  请求体为目标代码 + 输入，上传后立即运行
+#   POST /stage?id=<任务>&type=...&target=...     只上传 (预取)，POST /run?id=<任务> 运行已上传的任务
+API_RUN         = "/run"
+API_STAGE       = "/stage"
 
 REQUEST_TIMEOUT = 300
+HEALTH_TIMEOUT = 2
+RPI_RETRIES = 2             # 树莓派连接失败时，任务换一块板子重试的次数
+RPI_UNAVAILABLE_SECS = 60   # 所有树莓派都不可用超过该时间后，剩余的任务记为运行错误
+
+class RaspberryPi:
+    def __init__(self, address: str):
+        self.address = address
+        self.admitted = threading.Event()   # 健康检查通过后才会领取任务
+
+    def url(self, api: str, **params) -> str:
+        url = parse.urljoin(self.address, api)
+        return url + '?' + parse.urlencode(params) if params else url
+
+    def probe(self, session: requests.Session) -> bool:
+        try:
+            session.get(url=self.address, timeout=HEALTH_TIMEOUT)
+            return True
+        except requests.RequestException:
+            return False
+
+    def admit(self):
+        if not self.admitted.is_set():
+            printLog('rpi {0} admitted'.format(self.address))
+            self.admitted.set()
+
+    def evict(self, reason: str):
+        if self.admitted.is_set():
+            printLog('rpi {0} evicted: {1}'.format(self.address, reason))
+            self.admitted.clear()
 
-def run_testcase_on_pi(rpi_address: str, judge: dict):
-    rpi_testcase_ident = 'rpi {name} @ {addr}'.format(name=judge['case_fullname'], addr=rpi_address)
-    api_upload = API_UPLOAD_ELF if 'file_elf' in judge.keys() else API_UPLOAD_ASM
-    file_upload = judge['file_elf'] if 'file_elf' in judge.keys() else judge['file_asm']
+class RpiJob:
+    serial = 0
+    serial_lock = threading.Lock()
+
+    def __init__(self, judge: dict, callback):
+        self.judge = judge
+        self.callback = callback
+        self.attempts = 0
+        with RpiJob.serial_lock:
+            RpiJob.serial += 1
+            self.id = '{0}_{1}'.format(os.getpid(), RpiJob.serial)
+
+def check_response(resp: requests.Response, action: str, ident: str):
+    if resp.status_code != 200:
+        raise Exception("Failed {0} {1} (code={2}): \n{3}".format(action, ident, resp.status_code, resp.text))
+
+def target_of(judge: dict):
+    if 'file_elf' in judge.keys():
+        return 'elf', judge['file_elf']
+    return 'asm', judge['file_asm']
+
+def run_testcase_on_pi(session: requests.Session, rpi: RaspberryPi, judge: dict):
+    rpi_testcase_ident = 'rpi {name} @ {addr}'.format(name=judge['case_fullname'], addr=rpi.address)
+    target_type, file_upload = target_of(judge)
+    api_upload = API_UPLOAD_ELF if target_type == 'elf' else API_UPLOAD_ASM
     # 发送 POST 请求传文件
     with open(file_upload, "rb") as fp:
         printLog('--- {0} uploading target ---'.format(rpi_testcase_ident))
-        resp = requests.post(url=parse.urljoin(rpi_address, api_upload), data=fp, timeout=REQUEST_TIMEOUT)
+        resp = session.post(url=rpi.url(api_upload), data=fp, timeout=REQUEST_TIMEOUT)
         printLog('--- {0} upload target returns {1}:\n{2}\n------'.format(rpi_testcase_ident, resp.status_code, resp.text))
-        if resp.status_code != 200:
-            raise Exception("Failed upload target to {0} (code={1}): \n{2}".format(rpi_testcase_ident, resp.status_code, resp.text))
+        check_response(resp, 'upload target to', rpi_testcase_ident)
     # 发送 POST 请求传输入
     with open(judge['file_in'], "rb") as fp:
         printLog('--- {0} sending input ---'.format(rpi_testcase_ident))
-        resp = requests.post(url=parse.urljoin(rpi_address, API_INPUT), data=fp, timeout=REQUEST_TIMEOUT)
+        resp = session.post(url=rpi.url(API_INPUT), data=fp, timeout=REQUEST_TIMEOUT)
         printLog('--- {0} input returns {1}:\n{2}\n------'.format(rpi_testcase_ident, resp.status_code, resp.text))
-        if resp.status_code != 200:
-            raise Exception("Failed input to {0} (code={1}): \n{2}".format(rpi_testcase_ident, resp.status_code, resp.text))
+        check_response(resp, 'input to', rpi_testcase_ident)
     # 下载输出文件和性能文件
     with open(judge['file_out'], "w") as fp:
         printLog('--- {0} retriving output ---'.format(rpi_testcase_ident))
-        resp = requests.get(url=parse.urljoin(rpi_address, API_OUTPUT), timeout=REQUEST_TIMEOUT)
+        resp = session.get(url=rpi.url(API_OUTPUT), timeout=REQUEST_TIMEOUT)
         printLog('--- {0} get output returns {1}: {2} bytes ---'.format(rpi_testcase_ident, resp.status_code, len(resp.text)))
         fp.write(resp.text)
-        if resp.status_code != 200:
-            raise Exception("Failed get output from {0} (code={1})".format(rpi_testcase_ident, resp.status_code))
+        check_response(resp, 'get output from', rpi_testcase_ident)
     with open(judge['file_perf'], "w") as fp:
         printLog('--- {0} retriving perf ---'.format(rpi_testcase_ident))
-        resp = requests.get(url=parse.urljoin(rpi_address, API_PERF), timeout=REQUEST_TIMEOUT)
+        resp = session.get(url=rpi.url(API_PERF), timeout=REQUEST_TIMEOUT)
         printLog('--- {0} get perf returns {1}: {2} bytes ---'.format(rpi_testcase_ident, resp.status_code, len(resp.text)))
         fp.write(resp.text)
-        if resp.status_code != 200:
-            raise Exception("Failed get perf from {0} (code={1})".format(rpi_testcase_ident, resp.status_code))
+        check_response(resp, 'get perf from', rpi_testcase_ident)
+
+# combined 协议的请求体: 目标代码 + 输入
+def combined_payload(judge: dict):
+    target_type, file_upload = target_of(judge)
+    with open(file_upload, 'rb') as fp:
+        target = fp.read()
+    with open(judge['file_in'], 'rb') as fp:
+        data = fp.read()
+    return {'type': target_type, 'target': len(target)}, target + data
+
+def stage_on_pi(session: requests.Session, rpi: RaspberryPi, job: RpiJob):
+    params, body = combined_payload(job.judge)
+    resp = session.post(url=rpi.url(API_STAGE, id=job.id, **params), data=body, timeout=REQUEST_TIMEOUT)
+    check_response(resp, 'stage target to', 'rpi {0} @ {1}'.format(job.judge['case_fullname'], rpi.address))
+
+def run_combined_on_pi(session: requests.Session, rpi: RaspberryPi, job: RpiJob, staged: bool):
+    judge = job.judge
+    rpi_testcase_ident = 'rpi {name} @ {addr}'.format(name=judge['case_fullname'], addr=rpi.address)
+    if staged:
+        resp = session.post(url=rpi.url(API_RUN, id=job.id), timeout=REQUEST_TIMEOUT)
+    else:
+        params, body = combined_payload(judge)
+        resp = session.post(url=rpi.url(API_RUN, **params), data=body, timeout=REQUEST_TIMEOUT)
+    printLog('--- {0} run returns {1}: {2} bytes ---'.format(rpi_testcase_ident, resp.status_code, len(resp.content)))
+    check_response(resp, 'run on', rpi_testcase_ident)
+    result = resp.json()
+    with open(judge['file_out'], 'w') as fp:
+        fp.write(result['output'])
+    with open(judge['file_perf'], 'w') as fp:
+        fp.write(result['perf'])
 
-Executor: ThreadPoolExecutor = None
+rpi_boards = []
+rpi_jobs = queue.Queue()    # 等待分配给树莓派的任务
 
-rpi_idle_queue = queue.Queue()
+def fail_job(job: RpiJob, comment: str):
+    judge = job.judge
+    printLog('Runtime Error with Pi ({0}): {1}'.format(judge['case_fullname'], comment))
+    add_result(judge['work_dir'], {
+        'series_name': judge['series_name'], 'case_name': judge['case_name'], 'verdict': RUNTIME_ERROR,
+        'comment': comment, 'perf': '', 'perf_time': None, 'stdin': '', 'stdout': '', 'answer': '', 'durations': stage_durations(judge)
+    }, judge.get('variant', ''), target_label(judge))
+
+# 任务失败: 连接错误时将该树莓派移出并把任务交给其他树莓派重试，其他错误记为运行错误。调用者之后须调用 rpi_jobs.task_done()
+def handle_failure(rpi: RaspberryPi, job: RpiJob, e: Exception):
+    if isinstance(e, (requests.ConnectionError, requests.Timeout)):
+        rpi.evict(str(e))
+        job.attempts += 1
+        if job.attempts <= RPI_RETRIES:
+            printLog('Retry {0} on another pi ({1}/{2})'.format(job.judge['case_fullname'], job.attempts, RPI_RETRIES))
+            end_stage(job.judge)
+            rpi_jobs.put(job)
+            return
+    fail_job(job, str(e))
+
+def next_job(rpi: RaspberryPi) -> RpiJob:
+    while True:
+        rpi.admitted.wait()
+        job = rpi_jobs.get()
+        if rpi.admitted.is_set():
+            return job
+        rpi_jobs.put(job)   # 等待期间被移出，任务留给其他树莓派
+        rpi_jobs.task_done()
+
+def finish_job(rpi: RaspberryPi, job: RpiJob, run):
+    try:
+        begin_stage(job.judge, 'rpi')   # 不含等待空闲树莓派的时间
+        run()
+        end_stage(job.judge, 'rpi')
+        job.callback(job.judge)
+    except Exception as e:
+        handle_failure(rpi, job, e)
+    finally:
+        rpi_jobs.task_done()
+
+# split 协议或不预取时每块树莓派一个线程，依次完成上传、输入、运行、取回结果
+def rpi_worker(rpi: RaspberryPi):
+    session = requests.Session()
+    while True:
+        job = next_job(rpi)
+        if RpiProtocol == 'combined':
+            finish_job(rpi, job, lambda: run_combined_on_pi(session, rpi, job, False))
+        else:
+            finish_job(rpi, job, lambda: run_testcase_on_pi(session, rpi, job.judge))
+
+# 预取: 上传线程在树莓派运行当前任务时上传下一个任务，运行线程只等待运行结果
+def rpi_uploader(rpi: RaspberryPi, staged: queue.Queue):
+    session = requests.Session()
+    while True:
+        job = next_job(rpi)
+        try:
+            begin_stage(job.judge, 'rpi_upload')
+            stage_on_pi(session, rpi, job)
+            end_stage(job.judge, 'rpi_upload')
+        except Exception as e:
+            handle_failure(rpi, job, e)
+            rpi_jobs.task_done()
+            continue
+        staged.put(job)
+
+def rpi_runner(rpi: RaspberryPi, staged: queue.Queue):
+    session = requests.Session()
+    while True:
+        job = staged.get()
+        finish_job(rpi, job, lambda: run_combined_on_pi(session, rpi, job, True))
+
+# 定期检查所有树莓派 (包括已移出的)，恢复的重新加入；长时间没有可用的树莓派时放弃剩余任务
+def rpi_monitor():
+    session = requests.Session()
+    unavailable_since = None
+    while True:
+        time.sleep(RpiHealthInterval)
+        for rpi in rpi_boards:
+            if rpi.probe(session):
+                rpi.admit()
+            else:
+                rpi.evict('health check failed')
+        if any(rpi.admitted.is_set() for rpi in rpi_boards):
+            unavailable_since = None
+        elif unavailable_since is None:
+            unavailable_since = time.monotonic()
+        elif time.monotonic() - unavailable_since > RPI_UNAVAILABLE_SECS:
+            while True:
+                try:
+                    job = rpi_jobs.get_nowait()
+                except queue.Empty:
+                    break
+                fail_job(job, 'No available rpi')
+                rpi_jobs.task_done()
 
 def setup_rpi(addresses: list):
     if len(addresses) == 0:
         return
-    global Executor, rpi_idle_queue
-    real_addrs = []
+    session = requests.Session()
     for addr in addresses:
+        rpi = RaspberryPi(addr)
         # test this addr
-        try:
-            requests.get(url=addr, timeout=2)
-        except:
-            printLog('Invalid rpi address: {0}'.format(addr))
-            continue    # pi-side service is offline.
-        real_addrs.append(addr)
-        rpi_idle_queue.put(addr)
-    if len(real_addrs) == 0:
+        if rpi.probe(session):
+            rpi.admit()
+        else:
+            printLog('Invalid rpi address: {0}'.format(addr))  # pi-side service is offline, re-admitted by health check
+        rpi_boards.append(rpi)
+        if RpiProtocol == 'combined' and RpiPrefetch:
+            staged = queue.Queue(maxsize=1)
+            threading.Thread(target=rpi_uploader, args=(rpi, staged), name='rpi-upload-{0}'.format(addr), daemon=True).start()
+            threading.Thread(target=rpi_runner, args=(rpi, staged), name='rpi-run-{0}'.format(addr), daemon=True).start()
+        else:
+            threading.Thread(target=rpi_worker, args=(rpi,), name='rpi-{0}'.format(addr), daemon=True).start()
+    if not any(rpi.admitted.is_set() for rpi in rpi_boards):
         printLog('No available rpi')
-        return
-    Executor = ThreadPoolExecutor(max_workers=len(real_addrs))
+    threading.Thread(target=rpi_monitor, name='rpi-monitor', daemon=True).start()
 
 def submit_to_rpi(judge: dict, callback):
-    def wrapper(judge: dict, callback):
-        # printLog("wrapper {0}".format(judge))
-        rpi_addr = rpi_idle_queue.get()
-        try:
-            run_testcase_on_pi(rpi_addr, judge)
-            callback(judge)
-        except Exception as e:
-            comment = str(e)
-            printLog('Runtime Error with Pi ({0}): {1}'.format(judge['case_fullname'], comment))
-            add_result(judge['work_dir'], {
-                'series_name': judge['series_name'], 'case_name': judge['case_name'], 'verdict': RUNTIME_ERROR,
-                'comment': comment, 'perf': '', 'stdin': '', 'stdout': '', 'answer': ''
-            })
-        finally:
-            rpi_idle_queue.put(rpi_addr)
-    Executor.submit(wrapper, judge, callback)
+    if len(rpi_boards) == 0:
+        fail_job(RpiJob(judge, callback), 'No available rpi')
+        return
+    rpi_jobs.put(RpiJob(judge, callback))
     printLog('[Submit {0} to rpi waiting queue ...]'.format(judge['case_fullname']))
 
 def wait_rpi_all():
-    if Executor is not None:
-        Executor.shutdown(wait=True)
\ No newline at end of file
+    if len(rpi_boards) > 0:
+        rpi_jobs.join()
@@ -0,0 +1,162 @@
+import os
+import sys
+import json
+import shlex
+import argparse
+import tempfile
+import threading
+import subprocess
+from urllib import parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 本机模拟的树莓派评测服务，用于在一台 Linux 机器上测试 rpi / rpi-elf 评测的完整流程。
+#
+# 支持 rpi.py 使用的两种协议:
+#   split:    POST /elf 或 /asm 上传目标代码, POST /input 上传输入并运行, GET /output 与 GET /perf 取回结果
+#   combined: POST /run (上传并运行), POST /stage + POST /run?id= (预先上传, 之后运行)
+#
+# 与真实的树莓派一样同一时刻只运行一个程序。ELF 由 --runner 指定的命令执行 (例如 qemu-arm)，
+# 汇编代码由 --link 指定的命令链接。示例:
+#
+#     python3 rpi_server.py --port 9000 --runner 'qemu-arm -L /usr/arm-linux-gnueabihf' \
+#         --link 'arm-linux-gnueabihf-gcc -static -o {elf} {asm} /opt/sysy/libsysy.a'
+#
+# 然后在配置文件中设置 "rpi-addresses": ["http://127.0.0.1:9000"]。
+
+class Board:
+    def __init__(self, runner: str, link: str, timeout: int):
+        self.runner = runner
+        self.link = link
+        self.timeout = timeout
+        self.workdir = tempfile.mkdtemp(prefix='rpi_server_')
+        self.run_lock = threading.Lock()    # 同一时刻只运行一个程序
+        self.state_lock = threading.Lock()
+        self.target = None      # split 协议当前上传的 ELF
+        self.output = b''
+        self.perf = b''
+        self.staged = {}        # combined 协议预先上传的任务 {id: (ELF 路径, 输入)}
+        self.serial = 0
+
+    def new_path(self, suffix: str) -> str:
+        with self.state_lock:
+            self.serial += 1
+            return os.path.join(self.workdir, 'job_{0}{1}'.format(self.serial, suffix))
+
+    def save_target(self, type: str, data: bytes) -> str:
+        if type == 'elf':
+            elf = self.new_path('.elf')
+            with open(elf, 'wb') as fp:
+                fp.write(data)
+            os.chmod(elf, 0o755)
+            return elf
+        if not self.link:
+            raise Exception('asm upload is not supported, start the server with --link')
+        asm, elf = self.new_path('.S'), self.new_path('.elf')
+        with open(asm, 'wb') as fp:
+            fp.write(data)
+        ret = subprocess.run(self.link.format(asm=shlex.quote(asm), elf=shlex.quote(elf)), shell=True,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=self.timeout)
+        os.remove(asm)
+        if ret.returncode != 0:
+            raise Exception('link failed:\n' + ret.stdout.decode('utf-8', errors='replace'))
+        return elf
+
+    def run(self, elf: str, data: bytes):
+        """运行程序，输出末尾附加退出码 (与评测机容器中的运行脚本一致)，返回 (output, perf)"""
+        cmd = (shlex.split(self.runner) if self.runner else []) + [elf]
+        with self.run_lock:
+            try:
+                ret = subprocess.run(cmd, input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=self.timeout)
+                output, perf, code = ret.stdout, ret.stderr, ret.returncode
+            except subprocess.TimeoutExpired as e:
+                output, perf, code = e.stdout or b'', e.stderr or b'', 124
+        if code < 0:
+            code = 128 - code
+        if output and not output.endswith(b'\n'):
+            output += b'\n'
+        return output + str(code).encode() + b'\n', perf
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'   # 支持 keep-alive
+    board: Board = None
+
+    def reply(self, code: int, body: bytes, content_type: str='text/plain'):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_GET(self):
+        board, path = self.board, parse.urlparse(self.path).path
+        if path == '/':
+            self.reply(200, b'ok')
+        elif path == '/output':
+            self.reply(200, board.output)
+        elif path == '/perf':
+            self.reply(200, board.perf)
+        else:
+            self.reply(404, b'not found')
+
+    def do_POST(self):
+        board = self.board
+        url = parse.urlparse(self.path)
+        params = dict(parse.parse_qsl(url.query))
+        body = self.read_body()
+        try:
+            if url.path in ['/elf', '/asm']:
+                elf = board.save_target(url.path[1:], body)
+                with board.state_lock:
+                    old, board.target = board.target, elf
+                if old is not None:
+                    os.remove(old)
+                self.reply(200, b'uploaded')
+            elif url.path == '/input':
+                if board.target is None:
+                    raise Exception('no target uploaded')
+                board.output, board.perf = board.run(board.target, body)
+                self.reply(200, b'finished')
+            elif url.path == '/stage':
+                split = int(params['target'])
+                elf = board.save_target(params['type'], body[:split])
+                with board.state_lock:
+                    board.staged[params['id']] = (elf, body[split:])
+                self.reply(200, b'staged')
+            elif url.path == '/run':
+                if 'id' in params:
+                    with board.state_lock:
+                        elf, data = board.staged.pop(params['id'])
+                else:
+                    split = int(params['target'])
+                    elf, data = board.save_target(params['type'], body[:split]), body[split:]
+                try:
+                    output, perf = board.run(elf, data)
+                finally:
+                    os.remove(elf)
+                result = {'output': output.decode('utf-8', errors='replace'), 'perf': perf.decode('utf-8', errors='replace')}
+                self.reply(200, json.dumps(result).encode(), 'application/json')
+            else:
+                self.reply(404, b'not found')
+        except KeyError as e:
+            self.reply(400, 'missing {0}'.format(e).encode())
+        except Exception as e:
+            self.reply(500, str(e).encode())
+
+    def log_message(self, format, *args):
+        sys.stderr.write('[rpi-server] ' + (format % args) + '\n')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='local stand-in for the Raspberry Pi judge service')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--runner', default='', help='command prefix to execute an ELF, e.g. "qemu-arm -L /usr/arm-linux-gnueabihf"')
+    parser.add_argument('--link', default='', help='command to link uploaded assembly, with {asm} and {elf} placeholders')
+    parser.add_argument('--timeout', type=int, default=300)
+    args = parser.parse_args()
+    Handler.board = Board(args.runner, args.link, args.timeout)
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    print('rpi server listening on {0}:{1}'.format(args.host, args.port), file=sys.stderr)
+    server.serve_forever()
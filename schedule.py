@@ -0,0 +1,92 @@
+import os
+import json
+import hashlib
+
+from public import *
+from logger import printLog
+
+# 最长预计耗时优先调度: 按测试点名称排序时，少数耗时数秒的性能测试点往往最后才开始，其他线程空闲等待。
+# 每次评测结束后按编译器配置保存各测试点各阶段的耗时，下次评测按预计总耗时从长到短提交；
+# 没有历史记录的测试点按源文件和输入文件的大小估计耗时。
+
+HistoryDir = os.path.join(LogDirBase, '.history')
+HistorySmoothing = 0.5  # 新耗时的权重，平滑单次运行的波动
+
+# 历史记录按影响耗时的配置 (编译器源码位置、评测类型、编译和运行选项) 区分
+def history_path() -> str:
+    key = [os.path.realpath(CompilerSrc), RunType if len(RunTypes) == 1 else RunTypes, JvmOptions, OptOptions, Benchmark]
+    if Variants:
+        key.append(Variants)
+    key = json.dumps(key, sort_keys=True)
+    return os.path.join(HistoryDir, hashlib.sha1(key.encode('utf-8')).hexdigest()[:16] + '.json')
+
+# 测试点在历史记录中的名称，变体的测试点为 series/case/variant
+def history_name(series: str, case: str, variant: str='') -> str:
+    if variant:
+        return os.path.join(series, case, variant)
+    return os.path.join(series, case)
+
+def testcase_name(testcase: dict) -> str:
+    return history_name(testcase['series_name'], testcase['case_name'], testcase['variant']['name'] if 'variant' in testcase else '')
+
+def load_history() -> dict: # {series/case[/variant]: {stage: seconds}}
+    try:
+        with open(history_path(), 'r') as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return {}
+
+def save_history(results: list):
+    history = load_history()
+    # 多个评测类型的结果属于同一个测试点，各阶段耗时相加
+    totals = {}
+    for r in results:
+        durations = r.get('durations')
+        if not durations:
+            continue
+        total = totals.setdefault(history_name(r['series_name'], r['case_name'], r.get('variant', '')), {})
+        for stage, t in durations.items():
+            total[stage] = total.get(stage, 0.0) + t
+    for name, durations in totals.items():
+        old = history.get(name, {})
+        history[name] = {stage: t if stage not in old else old[stage] * (1 - HistorySmoothing) + t * HistorySmoothing
+            for stage, t in durations.items()}
+    os.makedirs(HistoryDir, exist_ok=True)
+    tmp_path = history_path() + '.tmp'
+    with open(tmp_path, 'w') as fp:
+        json.dump(history, fp=fp)
+    os.replace(tmp_path, history_path())
+
+def testcase_size(testcase: dict) -> int:
+    size = os.path.getsize(testcase['file_src'])
+    if os.path.exists(testcase['file_in']):
+        size += os.path.getsize(testcase['file_in'])
+    return size
+
+# 按预计耗时从长到短排序测试点
+def order_testcases(testcases: list) -> list:
+    history = load_history()
+    known, unknown = {}, []
+    for testcase in testcases:
+        name = testcase_name(testcase)
+        if name in history:
+            known[name] = sum(history[name].values())
+        else:
+            unknown.append(testcase)
+    # 以已知测试点的 耗时/文件大小 比例将未知测试点的文件大小换算为耗时
+    sizes = {testcase_name(t): testcase_size(t) for t in testcases}
+    known_size = sum(sizes[name] for name in known)
+    rate = sum(known.values()) / known_size if known_size > 0 else 1.0
+    estimate = dict(known)
+    for testcase in unknown:
+        name = testcase_name(testcase)
+        estimate[name] = sizes[name] * rate
+    printLog('schedule: {0} testcases with history, {1} estimated by size'.format(len(known), len(unknown)))
+    return sorted(testcases, key=lambda t: -estimate[testcase_name(t)])
+
+# 调度效率: 评测总耗时与各测试点各阶段耗时之和的对比
+def schedule_summary(wall_time: float, results: list, workers: int) -> str:
+    stage_time = sum(sum(r.get('durations', {}).values()) for r in results)
+    concurrency = stage_time / wall_time if wall_time > 0 else 0.0
+    return 'Wall time {0:.2f}s, sum of stage times {1:.2f}s, average concurrency {2:.2f} of {3} workers ({4:.1%}).'.format(
+        wall_time, stage_time, concurrency, workers, concurrency / workers if workers > 0 else 0.0)
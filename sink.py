@@ -0,0 +1,98 @@
+import os
+import json
+import time
+import threading
+
+from public import *
+from logger import printLog
+
+# 评测结果在完成时逐条追加到 result_<logName>.jsonl，进程被中断时已完成的结果仍保存在磁盘上。
+# 内存中只保留每条结果的排序键和在文件中的偏移，报告按排序后的偏移逐条读取生成。
+
+SinkFsyncBatch = 16     # 每写入多少条结果 fsync 一次
+SinkFsyncSecs = 1.0     # 距上次 fsync 超过该时间也会 fsync
+ProgressInterval = 2.0  # 进度行的最小输出间隔 (秒)
+
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return '{0}h{1:02d}m{2:02d}s'.format(seconds // 3600, seconds % 3600 // 60, seconds % 60)
+    if seconds >= 60:
+        return '{0}m{1:02d}s'.format(seconds // 60, seconds % 60)
+    return '{0}s'.format(seconds)
+
+class ResultSink:
+    def __init__(self, path: str):
+        self.path = path
+        self.fp = open(path, 'a')
+        self.lock = threading.Lock()
+        self.index = []     # [(series, case, variant, target, offset)]
+        self.pending = 0
+        self.last_sync = time.monotonic()
+        # 进度: 只统计本次评测的结果 (不含沿用的结果)
+        self.total = 0
+        self.done = 0
+        self.begin = time.monotonic()
+        self.last_progress = 0.0
+
+    def set_total(self, total: int):
+        self.total, self.done, self.begin = total, 0, time.monotonic()
+
+    def append(self, result: dict):
+        line = json.dumps(result) + '\n'
+        with self.lock:
+            offset = self.fp.tell()
+            self.fp.write(line)
+            self.fp.flush()
+            self.index.append((result['series_name'], result['case_name'], result.get('variant', ''), result.get('target', ''), offset))
+            self.pending += 1
+            if self.pending >= SinkFsyncBatch or time.monotonic() - self.last_sync >= SinkFsyncSecs:
+                self._sync()
+            if not result.get('carried_from'):
+                self.done += 1
+                self._progress()
+
+    def _sync(self):
+        os.fsync(self.fp.fileno())
+        self.pending = 0
+        self.last_sync = time.monotonic()
+
+    def _progress(self):
+        now = time.monotonic()
+        if self.total == 0 or (now - self.last_progress < ProgressInterval and self.done < self.total):
+            return
+        self.last_progress = now
+        elapsed = now - self.begin
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        eta = format_duration((self.total - self.done) / rate) if rate > 0 else '?'
+        printLog('progress: {0}/{1} ({2:.1%}), {3:.2f} cases/s, elapsed {4}, ETA {5}'.format(
+            self.done, self.total, self.done / self.total, rate, format_duration(elapsed), eta))
+    # 守护进程不从结果文件生成报告，没有正在评测的提交时清空内存中的索引 (结果文件不变)
+    # 守护进程不从结果文件生成报告，每次提交开始时清空内存中的索引 (结果文件不变)
+    def reset_index(self):
+        with self.lock:
+            self.index.clear()
+
+    def flush(self):
+        with self.lock:
+            self.fp.flush()
+            self._sync()
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    # 按 (测试集, 用例名称, 变体, 评测类型) 顺序逐条读取结果
+    def __iter__(self):
+        self.flush()
+        with self.lock:
+            index = sorted(self.index)
+        with open(self.path, 'r') as fp:
+            for _, _, _, _, offset in index:
+                fp.seek(offset)
+                yield json.loads(fp.readline())
+
+    def close(self):
+        self.flush()
+        self.fp.close()
+
+result_sink = ResultSink(os.path.join(logDir, 'result_' + logName + '.jsonl')) # {series, name, verdict, comment, perf, perf_time, stdin, stdout, answer, ...}
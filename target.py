@@ -0,0 +1,55 @@
+from const import *
+from public import *
+from compare import result_time
+from util import format_perf_time, verdict_cell, matrix_text, matrix_html
+
+# 多个评测类型 (run-type 为列表): 报告按用例列出各评测类型的结果，每个评测类型一列评测结果和运行时间
+
+# {rows: [{series_name, case_name, variant, cells: {target: {verdict, time}}}], passed: {target: 通过数量}}
+def target_matrix(results) -> dict:
+    rows = {}
+    passed = {target: 0 for target in RunTypes}
+    for r in results:
+        key = (r['series_name'], r['case_name'], r.get('variant', ''))
+        if key not in rows:
+            rows[key] = {'series_name': r['series_name'], 'case_name': r['case_name'], 'variant': r.get('variant', ''), 'cells': {}}
+        target = r.get('target', '')
+        rows[key]['cells'][target] = {'verdict': r['verdict'], 'time': result_time(r)}
+        if r['verdict'] == ACCEPTED and target in passed:
+            passed[target] += 1
+    return {'rows': [rows[key] for key in sorted(rows)], 'passed': passed}
+
+def target_summary(matrix: dict) -> str:
+    total = len(matrix['rows'])
+    parts = ['{0} {1}/{2}'.format(target, passed, total) for target, passed in matrix['passed'].items()]
+    return 'Targets passed: {0}.'.format(', '.join(parts))
+
+def row_case(row: dict) -> str:
+    return '{0} [{1}]'.format(row['case_name'], row['variant']) if row['variant'] else row['case_name']
+
+def target_cells(row: dict, target: str) -> list:
+    cell = row['cells'].get(target)
+    if cell is None:
+        return [('', None), ('', None)]
+    return [verdict_cell(cell['verdict']), (format_perf_time(cell['time']), None)]
+
+def target_header() -> list:
+    header = []
+    for target in RunTypes:
+        header += ['{0} verdict'.format(target), '{0} time'.format(target)]
+    return header
+
+def target_rows(matrix: dict) -> list:
+    rows = []
+    for row in matrix['rows']:
+        cells = [(row['series_name'], None), (row_case(row), None)]
+        for target in RunTypes:
+            cells += target_cells(row, target)
+        rows.append(cells)
+    return rows
+
+def target_text(matrix: dict) -> str:
+    return matrix_text(target_header(), target_rows(matrix), target_summary(matrix))
+
+def target_html(matrix: dict) -> str:
+    return matrix_html('Targets', target_header(), target_rows(matrix), target_summary(matrix))
@@ -1,32 +1,30 @@
 import docker
-from docker.models.containers import Container
 import os
+import re
+import json
+import hashlib
 import subprocess
 from logger import printLog
 
 from public import *
+from backend import get_backend
+from util import hash_file
+from timing import trace_span
 
-debug_container = False # if true, containers will not be removed after finished.
-
-def wrap_cmd(cmd: str) -> str:
-    return '/bin/sh -c "{0}"'.format(cmd.replace("\"", "\\\""))
-
-def container_wait(container: Container, name: str):
-    try:
-        exit: dict = container.wait(timeout=TimeoutSecs)
-    except Exception as e:
-        try:
-            container.kill()
-        except:
-            pass
-        raise e
-    finally:
-        if not debug_container:
-            container.remove()
-    if exit.get('Error') is not None:
-        raise Exception('{name}: container exit with error {err}'.format(name=name, err=exit['Error']))
-    elif exit['StatusCode'] != 0:
-        raise Exception('{name}: container exit with code {code}'.format(name=name, code=exit['StatusCode'])) # you should see logs dir for further information
+# 列出依赖库目录下的所有 jar 包 (相对路径)
+def list_jars(lib_path: str) -> list:
+    if not lib_path:
+        return []
+    __ret = subprocess.run(['find', '.', '-type', 'f', '-name', '*.jar'], stdout=subprocess.PIPE, cwd=lib_path)
+    __ret.check_returncode()
+    return [x.decode('utf-8').strip() for x in __ret.stdout.strip().splitlines()]
+
+# 运行一个阶段，由配置的执行后端 (docker 容器、容器池或本机进程) 执行，见 backend.py。
+# 返回资源使用 (见 usage.py，未统计时为 None)，失败时抛出的 TaskFailed 同样带有资源使用
+def run_container(client: docker.DockerClient, image: str, cmd: str, container_name: str, stage: str, working_dir: str, volumes: dict, static_volumes: dict={},
+        timeout: int=None, cpuset: str=None, pooled: bool=True) -> dict:
+    with trace_span(stage, 'task', container=container_name):
+        return get_backend(client).run(image, cmd, container_name, stage, working_dir, volumes, static_volumes, timeout, cpuset, pooled)
 
 JavaImage = 'openjdk:17-oracle'
 
@@ -37,41 +35,142 @@ CmdCompileARM   = 'java {jvm} {lib} Compiler -S -o test.S test.sy {opt} 2>/outpu
 CmdCompileRISCV = 'java {jvm} {lib} Compiler -S -o test.S test.sy {opt} 2>/output/compile.log; r=$?; cp test.S /output/; exit $r'
 CmdCompileAll   = 'java {jvm} {lib} Compiler -emit-llvm -o test.ll -S -o test.S test.sy {opt} 2>/output/compile.log; r=$?; cp test.S test.ll /output/; exit $r'
 
-CmdCompileAndRunInterpreter = 'java {jvm} {lib} Compiler -I test.sy {opt} < input.txt >/output/output.txt 2>/output/perf.txt'
+RunInterpreter = 'java {jvm} {lib} Compiler -I test.sy {opt}'
+CmdCompileAndRunInterpreter = '{capture}; exit $r'
+
+# AppCDS 归档 (见 appcds.py) 挂载到 /compiler/cds，使用时以其中打包的 compiler.jar 代替构建目录作为类路径。
+# 归档不可用时 -Xshare:auto 静默回退，JVM 的日志输出到 stderr 以免混入解释执行的输出
+CdsDir = '/compiler/cds'
+CdsJar = CdsDir + '/compiler.jar'
+CdsOptions = '-XX:SharedArchiveFile=' + CdsDir + '/app.jsa -Xshare:auto -Xlog:disable -Xlog:all=warning:stderr'
+
+# 编译器构建目录、依赖库和 AppCDS 归档的挂载，不随测试点变化
+def compiler_mounts(compiler_path: str, lib_path: str, cds: dict=None) -> dict:
+    static_volumes = {os.path.realpath(compiler_path): {'bind': '/compiler/compiler', 'mode': 'ro'}}
+    if lib_path:
+        static_volumes[os.path.realpath(lib_path)] = {'bind': '/compiler/lib', 'mode': 'ro'}
+    if cds is not None:
+        static_volumes[os.path.realpath(cds['dir_host'])] = {'bind': CdsDir, 'mode': 'ro'}
+    return static_volumes
+
+# 编译器的类路径: 构建目录 (或 AppCDS 的 compiler.jar) 与依赖库中的 jar 包
+def compiler_classpath(lib_path: str, cds: dict=None) -> str:
+    classpath = [CdsJar if cds is not None else '/compiler/compiler'] + [os.path.join('/compiler/lib', x) for x in list_jars(lib_path)]
+    return '-classpath ' + ':'.join(classpath)
 
 SysyImage = "sysy:tobisc"
+OutputLimitFile = 'output_limit.txt'    # 程序输出超出限制时写入 output 目录，内容为终止前写入的字节数
 CmdGenElf = 'ARCH={arch} sysy-asm2elf.sh test.S 2>/output/genelf.log'
-CmdRunLLVM = 'sysy-run-llvm.sh test.ll <input.txt >output.txt 2>/output/perf.txt; r=$?; \
-    if [ ! -z "$(tail -c 1 output.txt)" ]; then echo >> output.txt; fi; echo $r >> output.txt; cp output.txt /output/'
-CmdRunQemu = 'ARCH={arch} sysy-run-elf.sh test.elf <input.txt >output.txt 2>/output/perf.txt; r=$?; \
-    if [ ! -z "$(tail -c 1 output.txt)" ]; then echo >> output.txt; fi; echo $r >> output.txt; cp output.txt /output/'
+# 运行程序并将其输出写入 {out}，退出码保存在 $r 中 (见 capture_output)
+CmdCapture = '{run} <input.txt >{out} 2>{perf}; r=$?'
+# 限制输出大小: 输出经 head 写入文件，超出 {limit} 字节后 head 退出，程序再写输出时被 SIGPIPE 终止 (不必等到超时)。
+# 程序的退出码经 .rc 文件取回，超出限制时将截止时写入的字节数记录在 /output/output_limit.txt
+CmdCaptureLimited = '{{ {run} <input.txt 2>{perf}; echo $? >.rc; }} | head -c {cap} >{out}; r=$(cat .rc); \
+    n=$(wc -c <{out}); if [ $n -gt {limit} ]; then echo $n >/output/' + OutputLimitFile + '; fi'
+CmdRunOnce = '{capture}; if [ ! -z "$(tail -c 1 output.txt)" ]; then echo >> output.txt; fi; echo $r >> output.txt; cp output.txt /output/'
+# 重复运行 {n} 次，第 i 次的输出保存为 output_i.txt 与 perf_i.txt，最后一次同时保存为 output.txt 与 perf.txt
+CmdRunRepeat = 'i=1; while [ $i -le {n} ]; do {capture}; \
+    if [ ! -z "$(tail -c 1 output.txt)" ]; then echo >> output.txt; fi; echo $r >> output.txt; cp output.txt /output/output_$i.txt; i=$((i+1)); done; \
+    cp /output/output_{n}.txt /output/output.txt; cp /output/perf_{n}.txt /output/perf.txt'
+RunLLVM = 'sysy-run-llvm.sh test.ll'
+RunQemu = 'ARCH={arch} sysy-run-elf.sh test.elf'
+
+# limit 为输出大小的上限 (字节)，0 表示不限制
+def capture_output(run: str, out: str, perf: str, limit: int) -> str:
+    if limit <= 0:
+        return CmdCapture.format(run=run, out=out, perf=perf)
+    return CmdCaptureLimited.format(run=run, out=out, perf=perf, cap=limit + 1, limit=limit)
+
+BuildStateFile = 'build.json'   # 构建目录下记录构建指纹及各源文件哈希的文件
+build_fingerprints = {}         # 本进程中构建 (或确认未改变) 的编译器的指纹 {(构建目录, 依赖库目录): 指纹}，守护进程中可能有多个构建目录
+
+def build_key(artifact_path: str, library_path: str) -> tuple:
+    return os.path.realpath(artifact_path), os.path.realpath(library_path) if library_path else ''
+
+def compiler_fingerprint(artifact_path: str, library_path: str) -> str:
+    """该构建目录由 build_compiler 构建时的指纹，本进程没有构建过时返回 None"""
+    return build_fingerprints.get(build_key(artifact_path, library_path))
+
+# 扫描编译器源代码和依赖库, 返回 ({源文件相对路径: 哈希}, {jar 相对路径: 哈希}, 构建指纹)
+def scan_compiler_source(source_path: str, library_path: str):
+    sources = {}
+    for root, dirs, files in os.walk(source_path):
+        for file in files:
+            if file.endswith('.java'):
+                path = os.path.join(root, file)
+                sources[os.path.relpath(path, source_path)] = hash_file(path).hexdigest()
+    libs = {x: hash_file(os.path.join(library_path, x)).hexdigest() for x in list_jars(library_path)}
+    hasher = hashlib.sha256(JavaImage.encode('utf-8'))
+    for kind, files in [('src', sources), ('lib', libs)]:
+        for rel in sorted(files):
+            hasher.update('{0}:{1}:{2}\n'.format(kind, rel, files[rel]).encode('utf-8'))
+    return sources, libs, hasher.hexdigest()
+
+# 需要重新编译的源文件: 修改或新增的文件，以及 (传递地) 引用了其中类名的文件
+def files_to_rebuild(source_path: str, sources: dict, changed: list) -> list:
+    idents = {}
+    for rel in sources:
+        with open(os.path.join(source_path, rel), 'r', encoding='utf-8', errors='replace') as fp:
+            idents[rel] = set(re.findall(r'[A-Za-z_$][\w$]*', fp.read()))
+    rebuild = set(changed)
+    names = {os.path.splitext(os.path.basename(rel))[0] for rel in rebuild}
+    while len(names) > 0:
+        dependents = {rel for rel in sources if rel not in rebuild and len(idents[rel] & names) > 0}
+        rebuild |= dependents
+        names = {os.path.splitext(os.path.basename(rel))[0] for rel in dependents}
+    return sorted(rebuild)
 
 # 构建编译器, project_path 和 artifact_path 均为主机的路径 (使用 -v 选项挂载)
+# 源代码和依赖库均未改变时跳过构建；只有源文件修改或新增时只编译这些文件及其依赖者，其余情况完整构建。返回是否执行了构建
 def build_compiler(client: docker.DockerClient, source_path: str, artifact_path: str, library_path: str) -> bool:
     container_name = 'compiler_{0}_build'.format(os.getpid())
-    # cmd = '/bin/sh -ce "cd src; ls -la"'
-    printLog('building compiler ......')
+    sources, libs, fingerprint = scan_compiler_source(source_path, library_path)
+    state_file = os.path.join(artifact_path, BuildStateFile)
+    state = None
+    if os.path.exists(state_file):
+        with open(state_file, 'r') as fp:
+            state = json.load(fp)
+    if state is not None and state['fingerprint'] == fingerprint:
+        build_fingerprints[build_key(artifact_path, library_path)] = fingerprint
+        printLog('compiler unchanged (fingerprint {0}), skip building.'.format(fingerprint))
+        return False
+    incremental = state is not None and state['libs'] == libs and set(state['sources']) <= set(sources)
+    if incremental:
+        changed = [rel for rel, h in sources.items() if state['sources'].get(rel) != h]
+        files = files_to_rebuild(source_path, sources, changed)
+        printLog('building compiler incrementally: {0} files changed, {1} files to compile ......'.format(len(changed), len(files)))
+    else:
+        files = sorted(sources)
+        if state is not None:
+            # 删除了源文件或依赖库改变: 清除旧的 class 文件后完整构建
+            for root, dirs, names in os.walk(artifact_path):
+                for name in names:
+                    if name.endswith('.class'):
+                        os.remove(os.path.join(root, name))
+        printLog('building compiler ......')
     # 首先在 src 下生成 src.txt。这样可以避免在容器中执行 find 命令（我发现 find 命令不可用）
     with open(os.path.join(artifact_path, 'src.txt'), 'w') as fp:
-        subprocess.run(['find', 'src', '-type', 'f', '-name', '*.java'], stdout=fp, cwd=os.path.dirname(source_path)).check_returncode()
-    libs = ''
+        for rel in files:
+            fp.write(os.path.join('src', rel) + '\n')
     volumes = {
         os.path.realpath(source_path): {'bind': '/project/src', 'mode': 'ro'},
         os.path.realpath(artifact_path): {'bind': '/project/target', 'mode': 'rw'}
     }
+    # 增量构建时未改变的类从已有的构建目录中解析
+    classpath = (['target'] if incremental else []) + [os.path.join('/project/lib', x) for x in libs]
+    libs_option = '-classpath ' + ':'.join(classpath) if len(classpath) > 0 else ''
     if library_path:
-        __ret = subprocess.run(['find', '.', '-type', 'f', '-name', '*.jar'], stdout=subprocess.PIPE, cwd=library_path)
-        __ret.check_returncode()
-        __libs = __ret.stdout.strip().splitlines()
-        if len(__libs) > 0:
-            libs = '-classpath ' + ':'.join([os.path.join('/project/lib', x.decode('utf-8').strip()) for x in __libs])
         volumes[os.path.realpath(library_path)] = {'bind': '/project/lib', 'mode': 'ro'}
-    container: Container = client.containers.run(JavaImage, command=wrap_cmd(CmdBuildCompiler.format(lib=libs)),
-        detach=True, name=container_name, working_dir='/project', volumes=volumes, mem_limit=MemoryLimit)
-    container_wait(container, 'build_compiler')
-    printLog('compiler build finished.')
+    run_container(client, JavaImage, CmdBuildCompiler.format(lib=libs_option), container_name, 'build_compiler', '/project', volumes, pooled=False)
+    with open(state_file, 'w') as fp:
+        json.dump({'fingerprint': fingerprint, 'sources': sources, 'libs': libs}, fp=fp)
+    build_fingerprints[build_key(artifact_path, library_path)] = fingerprint
+    printLog('compiler build finished (fingerprint {0}).'.format(fingerprint))
+    return True
 
-def compile_testcase(client: docker.DockerClient, case_fullname: str, compiler_path: str, sy_path: str, output_path: str, lib_path: str='', type: str='arm'):
+# cds 为编译器构建的 AppCDS 归档 (appcds.cds_archive)，为 None 时直接使用构建目录
+def compile_testcase(client: docker.DockerClient, case_fullname: str, compiler_path: str, sy_path: str, output_path: str, lib_path: str='', type: str='arm',
+        jvm_options: str=JvmOptions, opt_options: str=OptOptions, cds: dict=None, timeout: int=None):
     container_name = 'compiler_{pid}_compile_{type}_{name}'.format(pid=os.getpid(), type=type, name=case_fullname.replace('/', '_'))
     printLog('{0} - compiling'.format(case_fullname))
     if type == 'llvm':
@@ -84,78 +183,79 @@ def compile_testcase(client: docker.DockerClient, case_fullname: str, compiler_p
         cmd = CmdCompileRISCV
         if EmitLLVM:
             cmd = CmdCompileAll
+    elif type == 'all':
+        cmd = CmdCompileAll     # 多个评测类型同时需要 LLVM IR 和汇编
     else:
         raise Exception("compile type {0} not support yet".format(type))
-    libs = '-classpath /compiler/compiler'
+    libs = compiler_classpath(lib_path, cds)
     volumes = {
-        os.path.realpath(compiler_path): {'bind': '/compiler/compiler', 'mode': 'ro'},
         os.path.realpath(sy_path): {'bind': '/compiler/test.sy', 'mode': 'ro'},
         os.path.realpath(output_path): {'bind': '/output/', 'mode': 'rw'}
     }
-    if lib_path:
-        __ret = subprocess.run(['find', '.', '-type', 'f', '-name', '*.jar'], stdout=subprocess.PIPE, cwd=lib_path)
-        __ret.check_returncode()
-        __libs = __ret.stdout.strip().splitlines()
-        if len(__libs) > 0:
-            libs = '-classpath /compiler/compiler:' + ':'.join([os.path.join('/compiler/lib', x.decode('utf-8').strip()) for x in __libs])
-        volumes[os.path.realpath(lib_path)] = {'bind': '/compiler/lib', 'mode': 'ro'}
-    container: Container = client.containers.run(JavaImage, command=wrap_cmd(cmd.format(jvm=JvmOptions, opt=OptOptions, lib=libs)),
-        detach=True, name=container_name, working_dir='/compiler', volumes=volumes, mem_limit=MemoryLimit)
-    container_wait(container, 'compile')
+    static_volumes = compiler_mounts(compiler_path, lib_path, cds)
+    if cds is not None:
+        jvm_options = ' '.join([CdsOptions, jvm_options])
+    usage = run_container(client, JavaImage, cmd.format(jvm=jvm_options, opt=opt_options, lib=libs), container_name, 'compile', '/compiler', volumes, static_volumes,
+        timeout=timeout)
     printLog('{0} - compile finish.'.format(case_fullname))
+    return usage
 
-def genelf_testcase(client: docker.DockerClient, case_fullname: str, code_path: str, elf_path: str, output_path: str, arch: str):
+def genelf_testcase(client: docker.DockerClient, case_fullname: str, code_path: str, elf_path: str, output_path: str, arch: str, timeout: int=None):
     container_name = 'compiler_{pid}_genelf_{name}'.format(pid=os.getpid(), name=case_fullname.replace('/', '_'))
     assert code_path.endswith('.S')
     printLog('{0} - elf generate begin'.format(case_fullname))
-    container: Container = client.containers.run(image=SysyImage, command=wrap_cmd(CmdGenElf.format(arch=arch)), detach=True, name=container_name, working_dir='/compiler', volumes={
+    usage = run_container(client, SysyImage, CmdGenElf.format(arch=arch), container_name, 'genelf', '/compiler', {
         os.path.realpath(code_path): {'bind': '/compiler/test.S', 'mode': 'ro'},
         os.path.realpath(elf_path): {'bind': '/compiler/test.elf', 'mode': 'rw'},
         os.path.realpath(output_path): {'bind': '/output/', 'mode': 'rw'}
-    }, mem_limit=MemoryLimit)
-    container_wait(container, 'genelf')
+    }, timeout=timeout)
     printLog('{0} - elf generated.'.format(case_fullname))
+    return usage
 
-def run_testcase(client: docker.DockerClient, case_fullname: str, code_path: str, input_path: str, output_path: str, type: str):
+# repeat > 1 时在同一个容器中重复运行 (性能测试)，cpuset 指定容器可使用的 CPU。
+# timeout 为每次运行的超时 (缺省为 timeout 配置)，output_limit 为每次运行的输出大小上限 (字节)
+def run_testcase(client: docker.DockerClient, case_fullname: str, code_path: str, input_path: str, output_path: str, type: str, repeat: int=1, cpuset: str=None,
+        timeout: int=None, output_limit: int=0):
     _, extension_name = os.path.basename(code_path).split('.')
     container_name = 'compiler_{pid}_run_{name}'.format(pid=os.getpid(), type=type, name=case_fullname.replace('/', '_'))
     printLog('{0} - running'.format(case_fullname))
     if type == 'llvm':
-        cmd = CmdRunLLVM
+        run = RunLLVM
     elif type == 'qemu-arm':
-        cmd = CmdRunQemu.format(arch='arm')
+        run = RunQemu.format(arch='arm')
     elif type == 'qemu-riscv':
-        cmd = CmdRunQemu.format(arch='riscv')
+        run = RunQemu.format(arch='riscv')
     else:
         raise Exception("run type {0} not support yet".format(type))
-    container: Container = client.containers.run(image=SysyImage, command=wrap_cmd(cmd), detach=True, name=container_name, working_dir='/compiler', volumes={
+    if repeat > 1:
+        cmd = CmdRunRepeat.format(n=repeat, capture=capture_output(run, 'output.txt', '/output/perf_$i.txt', output_limit))
+    else:
+        cmd = CmdRunOnce.format(capture=capture_output(run, 'output.txt', '/output/perf.txt', output_limit))
+    usage = run_container(client, SysyImage, cmd, container_name, 'run', '/compiler', {
         os.path.realpath(code_path): {'bind': '/compiler/test.' + extension_name, 'mode': 'ro'},
         os.path.realpath(input_path): {'bind': '/compiler/input.txt', 'mode': 'ro'},
         os.path.realpath(output_path): {'bind': '/output/', 'mode': 'rw'}
-    }, mem_limit=MemoryLimit)
-    container_wait(container, 'run')
+    }, timeout=(timeout or TimeoutSecs) * repeat, cpuset=cpuset)
     printLog('{0} - run finish.'.format(case_fullname))
+    return usage
 
-def run_interpreter(client: docker.DockerClient, case_fullname: str, compiler_path: str, sy_path: str, input_path: str, output_path: str, lib_path: str=''):
+def run_interpreter(client: docker.DockerClient, case_fullname: str, compiler_path: str, sy_path: str, input_path: str, output_path: str, lib_path: str='',
+        jvm_options: str=JvmOptions, opt_options: str=OptOptions, cds: dict=None, timeout: int=None, output_limit: int=0):
     _, extension_name = os.path.basename(sy_path).split('.')
     assert extension_name == 'sy'
     container_name = 'compiler_{pid}_interpret_{name}'.format(pid=os.getpid(), name=case_fullname.replace('/', '_'))
     printLog('{0} - interpret begin.'.format(case_fullname))
-    libs = '-classpath /compiler/compiler'
+    libs = compiler_classpath(lib_path, cds)
     volumes={
-        os.path.realpath(compiler_path): {'bind': '/compiler/compiler', 'mode': 'ro'},
         os.path.realpath(sy_path): {'bind': '/compiler/test.sy', 'mode': 'ro'},
         os.path.realpath(input_path): {'bind': '/compiler/input.txt', 'mode': 'ro'},
         os.path.realpath(output_path): {'bind': '/output/', 'mode': 'rw'}
     }
-    if lib_path:
-        __ret = subprocess.run(['find', '.', '-type', 'f', '-name', '*.jar'], stdout=subprocess.PIPE, cwd=lib_path)
-        __ret.check_returncode()
-        __libs = __ret.stdout.strip().splitlines()
-        if len(__libs) > 0:
-            libs = '-classpath /compiler/compiler:' + ':'.join([os.path.join('/compiler/lib', x.decode('utf-8').strip()) for x in __libs])
-        volumes[os.path.realpath(lib_path)] = {'bind': '/compiler/lib', 'mode': 'ro'}
-    container: Container = client.containers.run(image=JavaImage, command=wrap_cmd(CmdCompileAndRunInterpreter.format(jvm=JvmOptions, opt=OptOptions, lib=libs)),
-        detach=True, name=container_name, working_dir='/compiler', volumes=volumes, mem_limit=MemoryLimit)
-    container_wait(container, 'interpret')
+    static_volumes = compiler_mounts(compiler_path, lib_path, cds)
+    if cds is not None:
+        jvm_options = ' '.join([CdsOptions, jvm_options])
+    run = RunInterpreter.format(jvm=jvm_options, opt=opt_options, lib=libs)
+    cmd = CmdCompileAndRunInterpreter.format(capture=capture_output(run, '/output/output.txt', '/output/perf.txt', output_limit))
+    usage = run_container(client, JavaImage, cmd, container_name, 'interpret', '/compiler', volumes, static_volumes, timeout=timeout)
     printLog('{0} - interpret done.'.format(case_fullname))
+    return usage
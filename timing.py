@@ -0,0 +1,75 @@
+import os
+import math
+import time
+import json
+import html
+import threading
+import prettytable
+from contextlib import contextmanager
+
+from public import *
+
+# 评测耗时分析: 记录各阶段 (容器创建/启动/等待/删除、编译、生成 ELF、运行、文件准备、排队等待) 的起止时间 (单调时钟)，
+# 评测结束后汇总为每个阶段的 p50/p95/max，并导出为 Chrome trace event 格式 (可用 chrome://tracing 或 Perfetto 打开)。
+
+trace_lock = threading.Lock()
+trace_events = []   # [(name, category, tid, begin, end, args)]
+trace_threads = {}  # thread ident -> (tid, thread name)
+trace_origin = time.monotonic()
+
+def trace_event(name: str, category: str, begin: float, end: float, args: dict=None):
+    if not Trace:
+        return
+    thread = threading.current_thread()
+    with trace_lock:
+        if thread.ident not in trace_threads:
+            trace_threads[thread.ident] = (len(trace_threads) + 1, thread.name)
+        trace_events.append((name, category, trace_threads[thread.ident][0], begin, end, args or {}))
+
+# 守护进程不生成 trace 文件，每次提交开始时清空，避免常驻进程中的事件无限增长
+def reset_trace():
+    with trace_lock:
+        trace_events.clear()
+
+@contextmanager
+def trace_span(name: str, category: str, **args):
+    begin = time.monotonic()
+    try:
+        yield
+    finally:
+        trace_event(name, category, begin, time.monotonic(), args)
+
+def percentile(values: list, p: float) -> float:
+    """values 已排序，最近秩法"""
+    return values[max(0, math.ceil(p * len(values)) - 1)]
+
+def trace_summary() -> list: # [{category, name, count, total, p50, p95, max}]
+    groups = {}
+    with trace_lock:
+        for name, category, _, begin, end, _ in trace_events:
+            groups.setdefault((category, name), []).append(end - begin)
+    summary = []
+    for (category, name), durations in sorted(groups.items()):
+        durations.sort()
+        summary.append({'category': category, 'name': name, 'count': len(durations), 'total': sum(durations),
+            'p50': percentile(durations, 0.5), 'p95': percentile(durations, 0.95), 'max': durations[-1]})
+    return summary
+
+def trace_summary_text() -> str:
+    table = prettytable.PrettyTable(field_names=['category', 'stage', 'count', 'total', 'p50', 'p95', 'max'])
+    for s in trace_summary():
+        table.add_row((s['category'], s['name'], s['count']) + tuple('{0:.3f}s'.format(s[k]) for k in ['total', 'p50', 'p95', 'max']))
+    return str(table)
+
+def trace_summary_html() -> str:
+    return '<h3>Timing</h3>\n<pre>{0}</pre>'.format(html.escape(trace_summary_text()))
+
+def write_chrome_trace(path: str):
+    pid = os.getpid()
+    with trace_lock:
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}} for tid, name in trace_threads.values()]
+        for name, category, tid, begin, end, args in trace_events:
+            events.append({'name': name, 'cat': category, 'ph': 'X', 'pid': pid, 'tid': tid,
+                'ts': int((begin - trace_origin) * 1e6), 'dur': int((end - begin) * 1e6), 'args': args})
+    with open(path, 'w') as fp:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fp=fp)
@@ -0,0 +1,94 @@
+import os
+
+# 资源统计: 每个任务 (容器或本机进程) 的内存峰值、CPU 用户态/内核态时间和是否因内存不足被杀死。
+#   docker: 命令结束后在容器内读取自身 cgroup 的统计文件 (cgroup v2，或 v1 的 memory/cpuacct 控制器)
+#   容器池: 容器的 cgroup 由多个任务共用，统计任务前后 CPU 时间和 OOM 次数之差，不统计内存峰值
+#   native: wait4 返回的 rusage，配置了 native-cgroup 时以任务 cgroup 的统计为准
+# usage: {peak_rss: 字节, cpu_user: 秒, cpu_sys: 秒, oom_killed: bool}，无法统计的项为 None
+
+UsageMarker = '__sysy_usage__'
+CgroupRoot = '/sys/fs/cgroup'
+UsageFiles = ['memory.peak', 'memory.events', 'cpu.stat',
+    'memory/memory.max_usage_in_bytes', 'memory/memory.oom_control', 'cpuacct/cpuacct.stat']
+UserHZ = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+class TaskFailed(Exception):
+    """任务失败 (非零退出码、超时)，附带已统计的资源使用"""
+    def __init__(self, message: str, usage: dict):
+        super().__init__(message)
+        self.usage = usage
+
+def empty_usage() -> dict:
+    return {'peak_rss': None, 'cpu_user': None, 'cpu_sys': None, 'oom_killed': False}
+
+# 在容器内输出 cgroup 统计的 shell 片段，每行为 "<文件名> <文件中的一行>"
+def usage_probe() -> str:
+    return "echo {marker}; for f in {files}; do [ -r {root}/$f ] && while read l; do echo \"$f $l\"; done < {root}/$f; done".format(
+        marker=UsageMarker, files=' '.join(UsageFiles), root=CgroupRoot)
+
+# 解析 usage_probe 的输出 (或本机 cgroup 目录下的文件)，返回 {peak_rss, cpu_user, cpu_sys, oom_kills}
+def parse_usage(lines: list) -> dict:
+    stats = {'peak_rss': None, 'cpu_user': None, 'cpu_sys': None, 'oom_kills': 0}
+    for line in lines:
+        parts = line.split()
+        if len(parts) < 2:
+            continue
+        name = os.path.basename(parts[0])
+        try:
+            if name in ['memory.peak', 'memory.max_usage_in_bytes']:
+                stats['peak_rss'] = int(parts[1])
+            elif name in ['memory.events', 'memory.oom_control'] and parts[1] == 'oom_kill':
+                stats['oom_kills'] = int(parts[2])
+            elif name == 'cpu.stat' and parts[1] in ['user_usec', 'system_usec']:
+                stats['cpu_user' if parts[1] == 'user_usec' else 'cpu_sys'] = int(parts[2]) / 1e6
+            elif name == 'cpuacct.stat' and parts[1] in ['user', 'system']:
+                stats['cpu_user' if parts[1] == 'user' else 'cpu_sys'] = int(parts[2]) / UserHZ
+        except (ValueError, IndexError):
+            continue
+    return stats
+
+def probe_output(text: str) -> list:
+    if UsageMarker not in text:
+        return []
+    return text[text.rindex(UsageMarker) + len(UsageMarker):].splitlines()
+
+# 单独一个容器的统计
+def container_usage(text: str, oom_killed: bool) -> dict:
+    stats = parse_usage(probe_output(text))
+    usage = empty_usage()
+    usage.update(peak_rss=stats['peak_rss'], cpu_user=stats['cpu_user'], cpu_sys=stats['cpu_sys'],
+        oom_killed=oom_killed or stats['oom_kills'] > 0)
+    return usage
+
+# 容器池中一个任务前后两次统计之差
+def delta_usage(before: list, after: list, oom_killed: bool) -> dict:
+    old, new = parse_usage(before), parse_usage(after)
+    usage = empty_usage()
+    for key in ['cpu_user', 'cpu_sys']:
+        if old[key] is not None and new[key] is not None:
+            usage[key] = new[key] - old[key]
+    usage['oom_killed'] = oom_killed or new['oom_kills'] > old['oom_kills']
+    return usage
+
+def read_cgroup_usage(path: str) -> dict:
+    lines = []
+    for name in ['memory.peak', 'memory.events', 'cpu.stat']:
+        try:
+            with open(os.path.join(path, name), 'r') as fp:
+                lines += ['{0} {1}'.format(name, line) for line in fp]
+        except OSError:
+            pass
+    return parse_usage(lines)
+
+# 本机进程: rusage 的 ru_maxrss 单位为 KB
+def native_usage(rusage, cgroup: str) -> dict:
+    usage = empty_usage()
+    if rusage is not None:
+        usage.update(peak_rss=rusage.ru_maxrss * 1024, cpu_user=rusage.ru_utime, cpu_sys=rusage.ru_stime)
+    if cgroup is not None:
+        stats = read_cgroup_usage(cgroup)
+        for key in ['peak_rss', 'cpu_user', 'cpu_sys']:
+            if stats[key] is not None:
+                usage[key] = stats[key]
+        usage['oom_killed'] = stats['oom_kills'] > 0
+    return usage
@@ -1,42 +1,210 @@
 import os
+import re
+import fcntl
+import shutil
+import time
 import json
 import html
+import hashlib
 import tarfile
+import statistics
 import prettytable
 
 from const import *
-from public import results
+from sink import result_sink
+from timing import trace_event
 from logger import printLog
 
-# 遍历测试点
-def walk_testcase(baseDir: str, dirs: list): # [{series_name, case_name, file_src, file_in, file_ans}]
-    testcase_list = []
-    for dir in dirs:
-        _, _, files = os.walk(os.path.join(baseDir, dir)).__next__()
-        for file in files:
-            file: str
-            if file.endswith('.sy'):
-                name = file.split('.')[0]
-                file_src = os.path.realpath(os.path.join(baseDir, dir, file))
-                file_in = os.path.realpath(os.path.join(baseDir, dir, name + '.in'))
-                file_out = os.path.realpath(os.path.join(baseDir, dir, name + '.out'))
-                testcase_list.append({'series_name': dir, 'case_name': name, 'file_src': file_src, 'file_in': file_in, 'file_ans': file_out})
-    return sorted(testcase_list, key=lambda x : (x['series_name'], x['case_name']))
-
-# 答案检查
+CheckChunkSize = 1 << 16  # 答案检查每次读取的字节数
+CheckLineKeep = 4096        # 每行保留的最大字节数 (用于逐字比较和显示)，超出部分只参与哈希比较
+CheckContext = 20           # 不一致处前后显示的字符数
+ExcerptBytes = 100          # 报告中摘录的输入输出的头部/尾部字节数
+
+class Line:
+    """去除首尾空白后的一行: head 为前 CheckLineKeep 字节, 超长的行额外记录整行的哈希"""
+    __slots__ = ['head', 'length', 'hasher']
+
+    def __init__(self):
+        self.head = b''
+        self.length = 0
+        self.hasher = None
+
+    def feed(self, data: bytes):
+        if self.length + len(data) > CheckLineKeep and self.hasher is None:
+            self.hasher = hashlib.sha1(self.head)
+        if self.hasher is not None:
+            self.hasher.update(data)
+        if self.length < CheckLineKeep:
+            self.head += data[:CheckLineKeep - self.length]
+        self.length += len(data)
+
+    def __eq__(self, other) -> bool:
+        if self.length != other.length or self.head != other.head:
+            return False
+        return self.hasher is None or self.hasher.digest() == other.hasher.digest()
+
+def iter_lines(path: str):
+    """按固定大小的块读取文件，逐行产出去除首尾空白的 Line，内存占用与文件大小无关"""
+    with open(path, 'rb') as fp:
+        line, started, pending, has_data = Line(), False, b'', False
+        while True:
+            chunk = fp.read(CheckChunkSize)
+            if not chunk:
+                break
+            pieces = chunk.split(b'\n')
+            for i, piece in enumerate(pieces):
+                if piece:
+                    has_data = True
+                    if not started:
+                        piece = piece.lstrip()
+                        started = len(piece) > 0
+                    if started:
+                        body = piece.rstrip()
+                        if body:
+                            line.feed(pending + body)
+                            pending = piece[len(body):]
+                        else:
+                            pending += piece
+                if i < len(pieces) - 1:     # 遇到换行符，一行结束
+                    yield line
+                    line, started, pending, has_data = Line(), False, b'', False
+        if has_data:    # 最后一行没有换行符
+            yield line
+
+def count_lines(lines) -> int:
+    return sum(1 for _ in lines)
+
+def files_identical(file1: str, file2: str) -> bool:
+    if os.path.getsize(file1) != os.path.getsize(file2):
+        return False
+    with open(file1, 'rb') as fp1, open(file2, 'rb') as fp2:
+        while True:
+            chunk1, chunk2 = fp1.read(CheckChunkSize), fp2.read(CheckChunkSize)
+            if chunk1 != chunk2:
+                return False
+            if not chunk1:
+                return True
+
+def diff_context(text: bytes, column: int, total: int) -> str:
+    begin = max(0, column - CheckContext)
+    s = text[begin:column + CheckContext].decode('utf-8', errors='replace')
+    if begin > 0:
+        s = '...' + s
+    if column + CheckContext < total:
+        s = s + '...'
+    return s
+
+# 答案检查: 逐行比较 (忽略行首尾空白)，遇到第一处不一致即停止
 def answer_check(ans_file: str, out_file: str): # (correct: bool, comment: str)
-    with open(ans_file, 'r') as fp:
-        ans_lines = fp.readlines()
-    with open(out_file, 'r') as fp:
-        out_lines = fp.readlines()
-    if len(ans_lines) != len(out_lines):
-        return False, 'We got {0} lines when we expected {1} lines.'.format(len(out_lines), len(ans_lines))
-    l = len(ans_lines)
-    for i in range(l):
-        ans_line, out_line = ans_lines[i].strip(), out_lines[i].strip()
-        if ans_line != out_line:
-            return False, 'We got\n{0}\nWhen we expected\n{1}\nAt line {2}.'.format(reduce_text(out_line, 20), reduce_text(ans_line, 20), i + 1)
-    return True, 'Correct!'
+    if files_identical(ans_file, out_file):
+        return True, 'Correct!'
+    ans_lines, out_lines = iter_lines(ans_file), iter_lines(out_file)
+    i = 0
+    while True:
+        ans_line, out_line = next(ans_lines, None), next(out_lines, None)
+        if ans_line is None or out_line is None:
+            break
+        i += 1
+        if not ans_line == out_line:
+            column = 0
+            while column < min(len(ans_line.head), len(out_line.head)) and ans_line.head[column] == out_line.head[column]:
+                column += 1
+            return False, 'We got\n{0}\nWhen we expected\n{1}\nAt line {2}, column {3}.'.format(
+                diff_context(out_line.head, column, out_line.length), diff_context(ans_line.head, column, ans_line.length), i, column + 1)
+    if ans_line is None and out_line is None:
+        return True, 'Correct!'
+    ans_count = i + (count_lines(ans_lines) + 1 if ans_line is not None else 0)
+    out_count = i + (count_lines(out_lines) + 1 if out_line is not None else 0)
+    return False, 'We got {0} lines when we expected {1} lines.'.format(out_count, ans_count)
+
+# 读取文件的头部和尾部摘录，避免将大文件整个读入内存
+def read_excerpt(path: str, limit: int=ExcerptBytes) -> str:
+    size = os.path.getsize(path)
+    with open(path, 'rb') as fp:
+        if size <= 2 * limit:
+            return fp.read().decode('utf-8', errors='replace')
+        head = fp.read(limit)
+        fp.seek(size - limit)
+        tail = fp.read(limit)
+    return '{0}\n(... total {1} bytes ...)\n{2}'.format(head.decode('utf-8', errors='replace'), size, tail.decode('utf-8', errors='replace'))
+
+# SysY 运行时库输出的计时结果，例如 TOTAL: 0H-0M-1S-123456us
+PerfTimeRegex = re.compile(r'TOTAL:\s*(\d+)H-(\d+)M-(\d+)S-(\d+)us')
+
+def parse_perf_time(text: str): # seconds (float) or None
+    matches = PerfTimeRegex.findall(text)
+    if len(matches) == 0:
+        return None
+    h, m, s, us = map(int, matches[-1])
+    return h * 3600 + m * 60 + s + us / 1000000
+
+# 分块扫描 perf.txt，取最后一个 TOTAL 计时
+def read_perf_time(path: str):
+    perf_time, carry = None, ''
+    with open(path, 'r', errors='replace') as fp:
+        while True:
+            chunk = fp.read(CheckChunkSize)
+            if not chunk:
+                break
+            text = carry + chunk
+            t = parse_perf_time(text)
+            if t is not None:
+                perf_time = t
+            carry = text[-64:]  # 保留块尾，避免计时行被块边界截断
+    return perf_time
+
+def format_perf_time(t) -> str:
+    return '' if t is None else '{0:.6f}s'.format(t)
+
+# 按用例列出多组结果 (变体、评测类型) 的对比表。rows 为每行的单元格 [(文本, 颜色)]，前两列为测试集和用例名称，颜色只用于 html 报告
+def verdict_cell(verdict: str) -> tuple:
+    return verdict, None if not verdict else 'green' if verdict == ACCEPTED else 'red'
+
+def matrix_text(header: list, rows: list, summary: str) -> str:
+    table = prettytable.PrettyTable(field_names=['series', 'case_name'] + header)
+    for cells in rows:
+        table.add_row([text for text, _ in cells])
+    return '\n'.join([str(table), summary])
+
+def matrix_html(title: str, header: list, rows: list, summary: str) -> str:
+    def render(text: str, color: str) -> str:
+        return '<font color="{0}">{1}</font>'.format(color, html.escape(text)) if color else html.escape(text)
+    table_rows = ['<tr>{0}</tr>'.format(''.join(['<td>{0}</td>'.format(render(text, color)) for text, color in cells])) for cells in rows]
+    header = ''.join(['<th>{0}</th>'.format(html.escape(s)) for s in ['series', 'name'] + header])
+    return '''<h3>{title}</h3>
+<p>{summary}</p>
+<table border="1">
+<tr>{header}</tr>
+{body}
+</table>'''.format(title=html.escape(title), summary=html.escape(summary), header=header, body='\n'.join(table_rows))
+
+# 多次运行的计时统计
+def bench_stats(times: list) -> dict:
+    times = [t for t in times if t is not None]
+    stats = {'runs': len(times), 'times': times, 'min': None, 'median': None, 'mean': None, 'stddev': None}
+    if len(times) > 0:
+        stats.update({'min': min(times), 'median': statistics.median(times), 'mean': statistics.mean(times),
+            'stddev': statistics.stdev(times) if len(times) > 1 else 0.0})
+    return stats
+
+def format_result_time(result: dict) -> str:
+    bench = result.get('bench')
+    if bench and bench['runs'] > 0:
+        return 'median {0} (min {1}, mean {2}, stddev {3}, {4} runs)'.format(format_perf_time(bench['median']), format_perf_time(bench['min']),
+            format_perf_time(bench['mean']), format_perf_time(bench['stddev']), bench['runs'])
+    return format_perf_time(result.get('perf_time'))
+
+# 各任务的资源使用 {任务: {peak_rss, cpu_user, cpu_sys, oom_killed}}，见 usage.py
+def format_resources(result: dict) -> str:
+    lines = []
+    for stage, usage in result.get('resources', {}).items():
+        line = '{0}: peak {1}'.format(stage, '?' if usage['peak_rss'] is None else format_size(usage['peak_rss']))
+        if usage['cpu_user'] is not None:
+            line += ', cpu {0:.2f}s user + {1:.2f}s sys'.format(usage['cpu_user'], usage['cpu_sys'] or 0.0)
+        if usage['oom_killed']:
+            line += ', OOM killed'
+        lines.append(line)
+    return '\n'.join(lines)
 
 # 折叠过长的输入输出
 def reduce_text(txt: str, limit: int=100):
@@ -45,44 +213,153 @@ def reduce_text(txt: str, limit: int=100):
         return txt[:limit] + "(... total {0} bytes)".format(l)
     return txt
 
-def get_summary(results: list) -> str:
-    total_cases = len(results)
-    passed_cases = len(list(filter(lambda x : x['verdict'] == ACCEPTED, results)))
+FICLONE = 0x40049409    # linux/fs.h, 写时复制克隆整个文件 (btrfs, xfs 等)
+
+def reflink(src: str, dst: str) -> bool:
+    try:
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        return True
+    except OSError:
+        if os.path.exists(dst):
+            os.remove(dst)
+        return False
+
+# 依次尝试 reflink、硬链接，文件系统都不支持时复制
+def link_or_copy(src: str, dst: str):
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if reflink(src, dst):
+        return
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
+
+# 解析 '256m', '2g' 形式的大小
+def parse_size(size) -> int:
+    if isinstance(size, int):
+        return size
+    size = str(size).strip().lower()
+    units = {'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30, 't': 1 << 40}
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+def format_size(size: float) -> str:
+    for unit in ['', 'k', 'm', 'g']:
+        if abs(size) < 1024:
+            return '{0:.0f}{1}'.format(size, unit)
+        size /= 1024
+    return '{0:.1f}t'.format(size)
+
+def hash_file(path: str, hasher=None):
+    hasher = hasher or hashlib.sha256()
+    with open(path, 'rb') as fp:
+        while True:
+            chunk = fp.read(1 << 20)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    return hasher
+
+def hash_tree(path: str, hasher=None):
+    """按相对路径顺序哈希目录下的所有文件"""
+    hasher = hasher or hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for file in sorted(files):
+            file_path = os.path.join(root, file)
+            hasher.update(os.path.relpath(file_path, path).encode('utf-8') + b'\0')
+            hash_file(file_path, hasher)
+    return hasher
+
+# 各阶段耗时 (秒) 记录在 judge['durations']，正在进行的阶段记录在 judge['stage_begin']
+def add_duration(judge: dict, stage: str, seconds: float):
+    durations = judge.setdefault('durations', {})
+    durations[stage] = durations.get(stage, 0.0) + seconds
+
+def begin_stage(judge: dict, stage: str):
+    judge.setdefault('stage_begin', {})[stage] = time.monotonic()
+
+# 结束指定阶段，stage 为 None 时结束所有进行中的阶段 (在记录评测结果前调用)
+def end_stage(judge: dict, stage: str=None):
+    begins: dict = judge.get('stage_begin', {})
+    for name in ([stage] if stage is not None else list(begins.keys())):
+        begin = begins.pop(name, None)
+        if begin is not None:
+            end = time.monotonic()
+            add_duration(judge, name, end - begin)
+            trace_event(name, 'judge', begin, end, {'case': judge.get('case_fullname')})
+
+def stage_durations(judge: dict) -> dict:
+    end_stage(judge)
+    return dict(judge.get('durations', {}))
+
+# 多个评测类型 (run-type 为列表) 时结果中记录评测类型
+def target_label(judge: dict) -> str:
+    return judge['target'] if len(judge['targets']) > 1 else ''
+
+def get_summary(results) -> str:
+    total_cases, passed_cases, carried_cases = 0, 0, 0
+    for r in results:
+        total_cases += 1
+        passed_cases += r['verdict'] == ACCEPTED
+        carried_cases += bool(r.get('carried_from'))
     summary = 'Total {0} testcases, passed {1}.'.format(total_cases, passed_cases)
+    if carried_cases > 0:
+        summary += ' {0} results carried over from previous runs (marked *).'.format(carried_cases)
     return summary
 
-# 生成 HTML 评测结果
-def display_result(results: list, title: str):
+# 变体 (variants) 的结果在用例名称后标注变体名称，多个评测类型时再标注评测类型
+def format_case(result: dict) -> str:
+    name = result['case_name']
+    if result.get('variant'):
+        name = '{0} [{1}]'.format(name, result['variant'])
+    if result.get('target'):
+        name = '{0} ({1})'.format(name, result['target'])
+    return name
+
+# 沿用之前评测记录的结果在评测结果后加 * 标记
+def format_verdict(result: dict) -> str:
+    if result.get('carried_from'):
+        return '{0}* ({1})'.format(result['verdict'], result['carried_from'])
+    return result['verdict']
+
+# 生成 HTML 评测结果，逐段产出以便边读取结果边写入文件。
+# results 为已排序、可多次遍历的结果 (例如 result_sink)，第一遍统计摘要，第二遍生成表格
+def display_result(results, title: str, extra: str=''):
     summary = get_summary(results)
-    # (series, name, verdict, comment, perf, stdin, stdout, answer)
-    table_rows = []
-    for result in sorted(results, key=lambda r: (r['series_name'], r['case_name'])):
-        result_out = [result[k] for k in ['series_name', 'case_name', 'verdict', 'comment', 'perf', 'stdin', 'stdout', 'answer']]
-        result_out = list(map(lambda s : html.escape(str(s)).replace('\n', '<br>'), result_out))
-        # 评测结果颜色
-        if result['verdict'] == ACCEPTED:
-            result_out[2] = "<font color=\"green\">" + result_out[2] + "</font>"
-        else:
-            result_out[2] = "<font color=\"red\">" + result_out[2] + "</font>"
-        table_rows.append("".join(['<td>{0}</td>'.format(s) for s in result_out]))
-    text = '''<html>
+    yield '''<html>
 <head>
 <title>{title}</title>
 </head>
 <body>
 <p>{summary}</p>
 <table border="1">
-<tr> <th>series</th> <th>name</th> <th>verdict</th> <th>comment</th> <th>perf</th> <th>stdin</th> <th>stdout</th> <th>answer</th> </tr>
-{body}
-</table>
+<tr> <th>series</th> <th>name</th> <th>verdict</th> <th>comment</th> <th>time</th> <th>perf</th> <th>resources</th> <th>stdin</th> <th>stdout</th> <th>answer</th> </tr>
+'''.format(title=title, summary=summary)
+    # (series, name, verdict, comment, time, perf, resources, stdin, stdout, answer)
+    for result in results:
+        result_out = [result['series_name'], format_case(result), format_verdict(result), result['comment'], format_result_time(result), result['perf'],
+            format_resources(result)] + [result[k] for k in ['stdin', 'stdout', 'answer']]
+        result_out = list(map(lambda s : html.escape(str(s)).replace('\n', '<br>'), result_out))
+        # 评测结果颜色
+        if result['verdict'] == ACCEPTED:
+            result_out[2] = "<font color=\"green\">" + result_out[2] + "</font>"
+        else:
+            result_out[2] = "<font color=\"red\">" + result_out[2] + "</font>"
+        yield '<tr>{0}</tr>\n'.format("".join(['<td>{0}</td>'.format(s) for s in result_out]))
+    yield '''</table>
+{extra}
 </body>
-</html>'''.format(title=title, summary=summary, body="\n".join(['<tr>{0}</tr>'.format(s) for s in table_rows]))
-    return text
+</html>'''.format(extra=extra)
 
-def pretty_result(results: list):
-    table = prettytable.PrettyTable(field_names=['series', 'case_name', 'verdict', 'comment', 'perf'])
-    for r in sorted(results, key=lambda r: (r['series_name'], r['case_name'])):
-        table.add_row((r['series_name'], r['case_name'], r['verdict'], r['comment'], reduce_text(r['perf'])))
+# 文本表格只保留每条结果的简短字段
+def pretty_result(results):
+    table = prettytable.PrettyTable(field_names=['series', 'case_name', 'verdict', 'comment', 'time', 'perf'])
+    for r in results:
+        table.add_row((r['series_name'], format_case(r), format_verdict(r), r['comment'], format_result_time(r), reduce_text(r['perf'])))
     summary = get_summary(results)
     return "\n".join([str(table), summary])
 
@@ -90,14 +367,16 @@ def archive_source(src_dir: str, dst_file: str):
     with tarfile.open(dst_file, "w:gz") as tar:
         tar.add(src_dir, arcname=os.path.basename(src_dir))
 
-def add_result(workDir: str, result: dict):
+def add_result(workDir: str, result: dict, variant: str='', target: str=''):
+    if variant:
+        result['variant'] = variant
+    if target:
+        result['target'] = target
     for k in result:
         if type(result[k]) == str:
             result[k] = result[k].strip()
-    results.append(result)
-    # 省略太长的输出
-    for k in ['perf', 'stdin', 'stdout', 'answer']:
-        result[k] = reduce_text(result[k], 100)
-    printLog("{series}/{name}: {verdict}".format(series=result['series_name'], name=result['case_name'], verdict=result['verdict']))
+    # perf, stdin, stdout, answer 由调用者通过 read_excerpt 截取，长度有限
+    printLog("{series}/{name}: {verdict}".format(series=result['series_name'], name=format_case(result), verdict=result['verdict']))
+    result_sink.append(result)
     with open(os.path.join(workDir, 'result.json'), "w") as fp:
         json.dump(result, fp=fp)
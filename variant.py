@@ -0,0 +1,103 @@
+import re
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+from const import *
+from public import *
+from judge import prepare_testcase, add_testcase_error
+from compare import result_time, format_speedup
+from util import format_perf_time, verdict_cell, matrix_text, matrix_html
+from logger import printLog
+
+# A/B 对比模式: 配置 variants 后每个测试点在每个变体 (编译器构建、opt-options、jvm-options) 下分别编译运行。
+# 测试点文件只放入评测记录一次，各变体在同一个调度队列中评测；报告按用例列出各变体的结果，
+# 以第一个变体为基准计算其他变体的加速比 (基准时间 / 变体时间)。
+
+def check_variants():
+    names = [v['name'] for v in Variants]
+    for name in names:
+        if not re.fullmatch(r'[A-Za-z0-9][A-Za-z0-9_.-]*', name):
+            raise Exception('invalid variant name {0!r}, use letters, digits, "_", "." and "-"'.format(name))
+    if len(set(names)) != len(names):
+        raise Exception('duplicate variant names: {0}'.format(', '.join(names)))
+    if RerunFailed or ChangedSince:
+        raise Exception('--rerun-failed and --changed-since are not supported with variants')
+
+# 放入测试点文件，出错时为每个变体记录其他错误并返回 None
+def stage_testcase(testcase: dict) -> dict:
+    try:
+        return prepare_testcase(testcase)
+    except Exception as e:
+        comment = 'prepare: {0}'.format(str(e))
+        printLog('Prepare error ({0}/{1}): {2}'.format(testcase['series_name'], testcase['case_name'], comment))
+        for variant in Variants:
+            add_testcase_error(dict(testcase, variant=variant), OTHER_ERROR, comment)
+        return None
+
+# 将每个测试点展开为每个变体一个评测任务，准备失败的测试点不再评测
+def expand_variants(testcases: list) -> list:
+    check_variants()
+    with ThreadPoolExecutor(max_workers=NumParallel) as pool:
+        staged = list(pool.map(stage_testcase, testcases))
+    printLog('variants: {0} testcases x {1} variants ({2})'.format(len(testcases), len(Variants), ', '.join(v['name'] for v in Variants)))
+    return [dict(testcase, variant=variant, staged=judge) for testcase, judge in zip(testcases, staged) if judge is not None for variant in Variants]
+
+# {rows: [{series_name, case_name, target, cells: {variant: {verdict, time, speedup}}}], geomean: {variant: 加速比几何平均}}
+# 多个评测类型时每个评测类型一行
+def variant_matrix(results) -> dict:
+    baseline = Variants[0]['name']
+    rows = {}
+    for r in results:
+        key = (r['series_name'], r['case_name'], r.get('target', ''))
+        if key not in rows:
+            rows[key] = {'series_name': r['series_name'], 'case_name': r['case_name'], 'target': r.get('target', ''), 'cells': {}}
+        rows[key]['cells'][r.get('variant', '')] = {'verdict': r['verdict'], 'time': result_time(r), 'speedup': None}
+    speedups = {v['name']: [] for v in Variants[1:]}
+    for row in rows.values():
+        base = row['cells'].get(baseline)
+        if base is None or base['verdict'] != ACCEPTED or not base['time']:
+            continue
+        for name, cell in row['cells'].items():
+            if name != baseline and cell['verdict'] == ACCEPTED and cell['time']:
+                cell['speedup'] = base['time'] / cell['time']
+                speedups[name].append(cell['speedup'])
+    geomean = {name: math.exp(sum(map(math.log, s)) / len(s)) if len(s) > 0 else None for name, s in speedups.items()}
+    return {'rows': [rows[key] for key in sorted(rows)], 'geomean': geomean}
+
+def variant_summary(matrix: dict) -> str:
+    parts = ['{0} {1}'.format(name, format_speedup(g) or 'n/a') for name, g in matrix['geomean'].items()]
+    return 'Variants against baseline {0}, geometric mean speedup: {1}.'.format(Variants[0]['name'], ', '.join(parts) or 'n/a')
+
+def row_case(row: dict) -> str:
+    return '{0} ({1})'.format(row['case_name'], row['target']) if row.get('target') else row['case_name']
+
+def variant_cells(row: dict, name: str, baseline: bool) -> list:
+    cell = row['cells'].get(name)
+    if cell is None:
+        return [('', None)] * (2 if baseline else 3)
+    cells = [verdict_cell(cell['verdict']), (format_perf_time(cell['time']), None)]
+    if baseline:
+        return cells
+    speedup = cell['speedup']
+    return cells + [(format_speedup(speedup), None if speedup is None else 'green' if speedup > 1 else 'red')]
+
+def variant_header() -> list:
+    header = []
+    for i, v in enumerate(Variants):
+        header += ['{0} verdict'.format(v['name']), '{0} time'.format(v['name'])] + ([] if i == 0 else ['{0} speedup'.format(v['name'])])
+    return header
+
+def variant_rows(matrix: dict) -> list:
+    rows = []
+    for row in matrix['rows']:
+        cells = [(row['series_name'], None), (row_case(row), None)]
+        for i, v in enumerate(Variants):
+            cells += variant_cells(row, v['name'], i == 0)
+        rows.append(cells)
+    return rows
+
+def variant_text(matrix: dict) -> str:
+    return matrix_text(variant_header(), variant_rows(matrix), variant_summary(matrix))
+
+def variant_html(matrix: dict) -> str:
+    return matrix_html('Variants', variant_header(), variant_rows(matrix), variant_summary(matrix))
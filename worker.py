@@ -0,0 +1,245 @@
+import os
+import re
+import sys
+import json
+import uuid
+import shutil
+import tarfile
+import hmac
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from options import use_config
+
+# 分布式评测的 worker: 接收协调端 (配置了 workers 的 main.py) 分发的测试点，使用本机的配置文件 (后端、镜像、超时、并发数等) 评测并返回结果。
+# 协议见 distributed.py。在一台机器上测试时可以用不同的配置文件和端口启动多个 worker，例如:
+#
+#     python3 worker.py worker.json --port 9100
+#
+# worker 的配置文件中 compiler-src、compiler-build 不会被使用 (编译器由协调端上传)，run-type 必须与协调端一致。
+# worker 会运行协调端上传的编译器，配置文件中必须设置 worker-token，只接受带有相同令牌的请求；缺省只监听 127.0.0.1。
+
+worker_parser = argparse.ArgumentParser(description='SysY compiler judge worker')
+worker_parser.add_argument('config', help='config file of this worker')
+worker_parser.add_argument('--host', default='127.0.0.1', help='address to listen on, use 0.0.0.0 to accept remote coordinators')
+worker_parser.add_argument('--port', type=int, default=9100)
+worker_args = worker_parser.parse_args()
+use_config(worker_args.config)
+
+from const import *
+from public import *
+import judge
+from judge import prepare_testcase, variant_judge, test_one_case
+from util import link_or_copy
+from logger import printLog
+
+if RunType in [TYPE_RPI, TYPE_RPI_ELF]:
+    raise Exception('worker does not support run-type {0}'.format(RunType))
+if len(RunTypes) > 1:
+    raise Exception('worker does not support multiple run-types')
+if not WorkerToken:
+    raise Exception('worker requires worker-token in its config')
+if judge.staging == 'bind':
+    judge.staging = 'link'  # 收到的测试点文件不在 testcase-base 下，无法按 testcase-base-host 挂载
+
+WorkerDir = os.path.realpath(os.path.join(LogDirBase, '.worker'))
+WorkerDirHost = os.path.realpath(os.path.join(LogDirHostBase, '.worker'))   # 编译器目录需要挂载到容器中
+judge_slots = threading.Semaphore(NumParallel)
+
+def compiler_dir(digest: str) -> str:
+    if not re.fullmatch(r'[0-9a-f]{64}', digest):
+        raise KeyError(digest)
+    return os.path.join(WorkerDir, 'compiler', digest)
+
+def save_compiler(digest: str, data: bytes):
+    target = compiler_dir(digest)
+    if os.path.isdir(target):
+        return
+    tmp = '{0}.tmp.{1}'.format(target, uuid.uuid4().hex)
+    os.makedirs(tmp)
+    archive = tmp + '.tar.gz'
+    with open(archive, 'wb') as fp:
+        fp.write(data)
+    try:
+        with tarfile.open(archive, 'r:gz') as tar:
+            for member in tar.getmembers():
+                if member.name.startswith('/') or '..' in member.name.split('/') or not (member.isfile() or member.isdir()):
+                    raise Exception('invalid compiler archive member {0}'.format(member.name))
+            tar.extractall(tmp)
+        try:
+            os.rename(tmp, target)
+        except OSError:
+            if not os.path.isdir(target):
+                raise   # 否则为其他协调端同时上传了相同的编译器
+    finally:
+        os.remove(archive)
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def file_path(digest: str) -> str:
+    if not re.fullmatch(r'[0-9a-f]{64}', digest):
+        raise KeyError(digest)
+    return os.path.join(WorkerDir, 'files', digest)
+
+# 从请求流式写入测试点文件，内容的 sha256 必须与 digest 一致
+def save_file(digest: str, stream, length: int):
+    target = file_path(digest)
+    tmp = '{0}.tmp.{1}'.format(target, uuid.uuid4().hex)
+    hasher = hashlib.sha256()
+    try:
+        with open(tmp, 'wb') as fp:
+            while length > 0:
+                chunk = stream.read(min(length, 1 << 20))
+                if not chunk:
+                    raise Exception('incomplete upload of file {0}'.format(digest))
+                hasher.update(chunk)
+                fp.write(chunk)
+                length -= len(chunk)
+        if hasher.hexdigest() != digest:
+            raise ValueError('file content does not match digest {0}'.format(digest))
+        os.replace(tmp, target)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def use_file(path: str, digest: str):
+    if digest is None:
+        return  # 没有输入文件
+    if not os.path.exists(file_path(digest)):
+        raise Exception('file {0} not uploaded'.format(digest))
+    link_or_copy(file_path(digest), path)
+
+# 评测一个测试点，返回评测结果
+def judge_request(request: dict) -> dict:
+    digest = request['compiler']
+    if not os.path.isdir(compiler_dir(digest)):
+        raise Exception('compiler {0} not uploaded'.format(digest))
+    lib = os.path.join(compiler_dir(digest), 'lib')
+    compiler = {
+        'name': request.get('variant', ''),
+        'compiler-build': os.path.join(WorkerDirHost, 'compiler', digest, 'build'),
+        'compiler-lib': os.path.join(WorkerDirHost, 'compiler', digest, 'lib') if os.path.isdir(lib) else '',
+        'opt-options': request['opt-options'], 'jvm-options': request['jvm-options'],
+    }
+    series_name, case_name = request['series_name'], request['case_name']
+    incoming = os.path.join(WorkerDir, 'incoming', uuid.uuid4().hex)
+    os.makedirs(incoming)
+    try:
+        testcase = {'series_name': series_name, 'case_name': case_name, 'file_src': os.path.join(incoming, case_name + '.sy'),
+            'file_in': os.path.join(incoming, case_name + '.in'), 'file_ans': os.path.join(incoming, case_name + '.out')}
+        use_file(testcase['file_src'], request['sy'])
+        use_file(testcase['file_in'], request['in'])
+        use_file(testcase['file_ans'], request['out'])
+        with judge_slots:
+            case = prepare_testcase(testcase)
+            if compiler['name']:
+                case = variant_judge(case, compiler)
+            else:
+                case['compiler'] = compiler
+            testcase['judge'] = case
+            test_one_case(testcase)
+        with open(os.path.join(case['work_dir'], 'result.json'), 'r') as fp:
+            return json.load(fp)
+    finally:
+        shutil.rmtree(incoming, ignore_errors=True)
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'   # 支持 keep-alive
+
+    def reply(self, code: int, body: bytes, content_type: str='text/plain'):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def reply_json(self, obj):
+        self.reply(200, json.dumps(obj).encode(), 'application/json')
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    # 请求须带有与配置相同的令牌，否则读取并丢弃请求体后返回 401
+    def authorized(self) -> bool:
+        if hmac.compare_digest(self.headers.get('X-Judge-Token', '').encode(), WorkerToken.encode()):
+            return True
+        self.read_body()
+        self.reply(401, b'unauthorized')
+        return False
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        try:
+            if self.path == '/':
+                self.reply_json({'run-type': RunType, 'parallel': NumParallel})
+            elif self.path.startswith('/compiler/'):
+                found = os.path.isdir(compiler_dir(self.path[len('/compiler/'):]))
+                self.reply(200 if found else 404, b'found' if found else b'not found')
+            elif self.path.startswith('/file/'):
+                found = os.path.exists(file_path(self.path[len('/file/'):]))
+                self.reply(200 if found else 404, b'found' if found else b'not found')
+            else:
+                self.reply(404, b'not found')
+        except KeyError:
+            self.reply(400, b'invalid digest')
+
+    def do_PUT(self):
+        if not self.authorized():
+            return
+        if self.path.startswith('/file/'):
+            self.put_file(self.path[len('/file/'):])
+            return
+        body = self.read_body()
+        try:
+            if not self.path.startswith('/compiler/'):
+                self.reply(404, b'not found')
+                return
+            save_compiler(self.path[len('/compiler/'):], body)
+            self.reply(200, b'saved')
+        except KeyError:
+            self.reply(400, b'invalid compiler digest')
+        except Exception as e:
+            self.reply(500, str(e).encode())
+
+    # 测试点文件可能很大，直接从连接写入文件；上传中断时连接的状态未知，回复后关闭连接
+    def put_file(self, digest: str):
+        try:
+            file_path(digest)
+        except KeyError:
+            self.read_body()
+            self.reply(400, b'invalid digest')
+            return
+        try:
+            save_file(digest, self.rfile, int(self.headers.get('Content-Length', 0)))
+            self.reply(200, b'saved')
+        except ValueError as e:
+            self.reply(400, str(e).encode())
+        except Exception as e:
+            self.close_connection = True
+            self.reply(500, str(e).encode())
+
+    def do_POST(self):
+        if not self.authorized():
+            return
+        body = self.read_body()
+        if self.path != '/judge':
+            self.reply(404, b'not found')
+            return
+        try:
+            request = json.loads(body)
+            result = judge_request(request)
+            self.reply_json(result)
+        except Exception as e:
+            printLog('worker: judge failed: {0}'.format(str(e)))
+            self.reply(500, str(e).encode())
+
+    def log_message(self, format, *args):
+        pass    # 评测过程已记录在日志中
+
+if __name__ == '__main__':
+    os.makedirs(os.path.join(WorkerDir, 'compiler'), exist_ok=True)
+    os.makedirs(os.path.join(WorkerDir, 'files'), exist_ok=True)
+    server = ThreadingHTTPServer((worker_args.host, worker_args.port), Handler)
+    printLog('worker listening on {0}:{1}, run-type {2}, {3} parallel, log {4}'.format(worker_args.host, worker_args.port, RunType, NumParallel, logName))
+    server.serve_forever()